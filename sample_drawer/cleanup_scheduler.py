@@ -0,0 +1,108 @@
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("cleanup_scheduler")
+
+# removal may be delayed by up to that many seconds, so files expiring
+# at about the same time are removed together
+BATCH_WINDOW = 1.0
+
+
+class CleanupScheduler:
+    """Removes temporary files after given timeouts.
+
+    A single daemon thread waits for the earliest deadline in a heap (plus
+    the batch window) and then unlinks all the files which have expired, so
+    any number of scheduled files costs one thread and few wake-ups.
+
+    `clock` returns the current time in seconds, time.monotonic() by
+    default."""
+
+    def __init__(self, batch_window=BATCH_WINDOW, clock=time.monotonic):
+        self.batch_window = batch_window
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def schedule(self, path, timeout):
+        """Schedule removal of a file after `timeout` seconds."""
+        self.schedule_many([path], timeout)
+
+    def schedule_many(self, paths, timeout):
+        """Schedule removal of many files after `timeout` seconds."""
+        deadline = self.clock() + timeout
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Cleanup scheduler stopped")
+            for path in paths:
+                heapq.heappush(self._heap, (deadline, next(self._counter), path))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="CleanupScheduler",
+                                                daemon=True)
+                self._thread.start()
+            else:
+                self._cond.notify()
+
+    def stop(self, remove_pending=False):
+        """Stop the scheduler thread.
+
+        Files still waiting for their deadline are removed only if
+        `remove_pending` is True."""
+        with self._cond:
+            self._stopped = True
+            if remove_pending:
+                pending = [path for _, _, path in self._heap]
+            else:
+                pending = []
+            self._heap = []
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._remove(pending)
+
+    def _run(self):
+        logger.debug("cleanup thread started")
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] + self.batch_window - self.clock()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                if self._stopped:
+                    break
+                limit = self.clock()
+                batch = []
+                while self._heap and self._heap[0][0] <= limit:
+                    batch.append(heapq.heappop(self._heap)[2])
+            self._remove(batch)
+        logger.debug("cleanup thread finished")
+
+    @staticmethod
+    def _remove(paths):
+        if paths:
+            logger.debug("removing %i expired files", len(paths))
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                logger.debug("%r: %s", path, err)
@@ -1,6 +1,10 @@
 
 import copy
 
+from .file_copy import DEFAULT_COPY_METHODS
+from .folder_watcher import DEBOUNCE, SCAN_INTERVAL
+from .library_verifier import DEFAULT_MAX_AGE
+
 DEFAULT_IMPORT_RULES = [
         ("_path", r"^(.*/)?([^/]*?)(\.[^/.]*)?$", {"_name": "{2}"}),
         ("_auto_category", r"^/.*$", {"_tags": "{_tags} {0}"}),
@@ -12,7 +16,40 @@ DEFAULT_CONFIG = {
                 "name": "Name from filename, tags from folder",
                 "rules": DEFAULT_IMPORT_RULES,
                 },
-            }
+            },
+        "library": {
+            # methods used to copy files into the library or a workplace
+            "copy_methods": DEFAULT_COPY_METHODS,
+            },
+        "prefetch": {
+            # entries before and after the selected one analyzed in advance
+            "neighbours": 0,
+            # maximum total size of the files prefetched at once, in bytes
+            "max_size": 64 * 1024 * 1024,
+            },
+        "scrubber": {
+            # background library verification in the GUI
+            "enabled": True,
+            # seconds after start-up and between the passes
+            "start_delay": 120,
+            "interval": 6 * 3600,
+            # maximum bytes read per second, 0 for no limit
+            "rate": 4 * 1024 * 1024,
+            # unchanged files are verified again after that many seconds
+            "max_age": DEFAULT_MAX_AGE,
+            },
+        "watch": {
+            # folders imported from by '--watch'
+            "folders": [],
+            # key of the rewrite rules used
+            "rules": "default",
+            # seconds a file must stay unchanged before it is imported
+            "debounce": DEBOUNCE,
+            # seconds between scans when inotify is not available
+            "scan_interval": SCAN_INTERVAL,
+            # files imported in one transaction
+            "batch_size": 20,
+            },
         }
 
 
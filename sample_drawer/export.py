@@ -0,0 +1,121 @@
+
+import json
+import logging
+
+from .metadata import FIXED_METADATA_D, FIXED_METADATA_KEYS, VALID_KEY_RE
+
+logger = logging.getLogger("export")
+
+DEFAULT_FIELDS = ["_name", "_format", "_duration", "tags"]
+
+# pseudo-fields, not stored in the metadata
+TAGS_FIELD = "tags"
+PATH_FIELD = "path"
+
+
+def parse_fields(arg):
+    """Parse comma-separated list of fields to output.
+
+    Fixed metadata keys may be given with or without the leading '_',
+    the same way as for the '--set' option."""
+    fields = []
+    for field in arg.split(","):
+        field = field.strip()
+        if not field:
+            continue
+        if field in (TAGS_FIELD, PATH_FIELD):
+            fields.append(field)
+        elif field in FIXED_METADATA_KEYS:
+            fields.append(field)
+        elif field in FIXED_METADATA_D:
+            fields.append("_" + field)
+        elif VALID_KEY_RE.match(field):
+            fields.append(field.lower())
+        else:
+            raise ValueError("{!r} is not a valid field".format(field))
+    if not fields:
+        raise ValueError("no fields selected")
+    return fields
+
+
+class ItemWriter:
+    """Writes selected fields of library items to a text stream."""
+    format_name = None
+    formats = {}
+
+    def __init__(self, stream, fields):
+        self.stream = stream
+        self.fields = list(fields)
+
+    @classmethod
+    def register_format(cls):
+        ItemWriter.formats[cls.format_name] = cls
+
+    @classmethod
+    def for_format(cls, format_name, stream, fields):
+        try:
+            writer_class = cls.formats[format_name]
+        except KeyError:
+            raise ValueError("Unknown output format: {!r}".format(format_name))
+        return writer_class(stream, fields)
+
+    def get_values(self, metadata, path=None):
+        values = []
+        for field in self.fields:
+            if field == TAGS_FIELD:
+                values.append(sorted(metadata.get_tags()))
+            elif field == PATH_FIELD:
+                values.append(path)
+            else:
+                values.append(metadata.get(field))
+        return values
+
+    def write_header(self):
+        pass
+
+    def write_item(self, metadata, path=None):
+        raise NotImplementedError
+
+
+class JSONLinesWriter(ItemWriter):
+    format_name = "jsonl"
+
+    def write_item(self, metadata, path=None):
+        values = self.get_values(metadata, path)
+        record = dict(zip(self.fields, values))
+        self.stream.write(json.dumps(record, ensure_ascii=False))
+        self.stream.write("\n")
+
+
+JSONLinesWriter.register_format()
+
+
+class TSVWriter(ItemWriter):
+    format_name = "tsv"
+
+    @staticmethod
+    def _escape(value):
+        if value is None:
+            return ""
+        if isinstance(value, list):
+            value = " ".join(value)
+        elif isinstance(value, float):
+            value = "{:.6g}".format(value)
+        else:
+            value = str(value)
+        return (value.replace("\\", "\\\\")
+                .replace("\t", "\\t")
+                .replace("\n", "\\n")
+                .replace("\r", "\\r"))
+
+    def write_header(self):
+        self.stream.write("\t".join(self.fields))
+        self.stream.write("\n")
+
+    def write_item(self, metadata, path=None):
+        values = self.get_values(metadata, path)
+        self.stream.write("\t".join(self._escape(value) for value in values))
+        self.stream.write("\n")
+
+
+TSVWriter.register_format()
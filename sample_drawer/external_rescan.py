@@ -0,0 +1,244 @@
+
+import logging
+import os
+import time
+
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .library_verifier import FileToVerify, hash_files
+
+logger = logging.getLogger("external_rescan")
+
+# number of threads calling stat() or listing directories
+STAT_THREADS = 16
+
+# changes applied in one write transaction
+UPDATE_BATCH_SIZE = 500
+
+ExternalItem = namedtuple("ExternalItem", "item_id name md5 path size mtime_ns")
+
+
+def _stat_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _list_dir(dir_path):
+    """Return subdirectories and (path, size, mtime_ns) of files in a directory."""
+    subdirs = []
+    files = []
+    try:
+        entries = list(os.scandir(dir_path))
+    except OSError as err:
+        logger.warning("Cannot list %r: %s", dir_path, err)
+        return subdirs, files
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        except OSError as err:
+            logger.debug("%r: %s", entry.path, err)
+    return subdirs, files
+
+
+class ExternalRescanner:
+    """Brings items imported without copying in sync with their files.
+
+    Size and modification time of all the external files are checked
+    in `STAT_THREADS` parallel threads and compared with the ones stored
+    in the database (at import or by the previous rescan). Only files
+    that changed are read again, by `jobs` worker processes: if the
+    checksum differs, the item checksum is updated (the other metadata is
+    left as it was).
+
+    Items with files missing are looked for in the `search_roots`
+    directories: files of the same size as the missing one (if known) are
+    hashed and the item is pointed to the file with a matching checksum.
+    Missing files which are not found are only reported – the
+    '--check-db' verification offers removing such items.
+
+    `db` is the database connection to use, when not the one of the
+    library."""
+
+    def __init__(self, app, search_roots=(), jobs=None, db=None):
+        self.lib = app.library
+        self.search_roots = [os.path.abspath(path) for path in search_roots]
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        self.jobs = max(jobs, 1)
+        self.db = db if db is not None else self.lib.db
+        self.stats = Counter()
+        self.missing = []
+
+    def rescan(self):
+        """Run the rescan, return the statistics Counter.
+
+        Counted keys: 'unchanged', 'verified' (changed signature, same
+        content), 'modified', 'relocated', 'missing' and 'failed'."""
+        self.stats = Counter()
+        self.missing = []
+        items = self._read_items()
+        logger.info("Checking %i external files", len(items))
+        to_hash = self._check_signatures(items)
+        logger.info("%i files changed, verifying their contents", len(to_hash))
+        self._hash_changed(items, to_hash)
+        if self.missing and self.search_roots:
+            logger.info("Looking for %i missing files in %s", len(self.missing),
+                        ", ".join(repr(path) for path in self.search_roots))
+            known_paths = set(item.path for item in items.values())
+            self._relocate(known_paths)
+        for item in self.missing:
+            logger.warning("Item #%i %r – file %r missing", item.item_id, item.name, item.path)
+        self.stats["missing"] = len(self.missing)
+        return self.stats
+
+    def _read_items(self):
+        db = self.db
+        if db.in_transaction:
+            # committing it here could commit somebody else's changes
+            raise RuntimeError("Database connection in the middle of a transaction")
+        with db:
+            cur = db.execute("SELECT item.id, item.name, item.md5, item.path,"
+                             " f.size, f.mtime_ns"
+                             " FROM items item"
+                             " LEFT JOIN item_files f ON (f.item_id = item.id)"
+                             " WHERE item.workplace_id IS NULL AND item.path IS NOT NULL")
+            return {row[0]: ExternalItem(*row) for row in cur}
+
+    def _check_signatures(self, items):
+        """Stat all the files, return FileToVerify list of the changed ones."""
+        items = list(items.values())
+        to_hash = []
+        with ThreadPoolExecutor(max_workers=STAT_THREADS) as executor:
+            signatures = executor.map(_stat_signature, [item.path for item in items])
+            for item, signature in zip(items, signatures):
+                if signature is None:
+                    self.missing.append(item)
+                elif signature == (item.size, item.mtime_ns):
+                    self.stats["unchanged"] += 1
+                else:
+                    to_hash.append(FileToVerify(item.path, item.item_id, item.md5,
+                                                *signature))
+        return to_hash
+
+    def _hash_changed(self, items, to_hash):
+        verified = []
+        modified = []
+        for file_to_verify, md5, error in hash_files(to_hash, self.jobs):
+            if error is not None:
+                logger.error("Cannot read %r: %s", file_to_verify.path, error)
+                self.stats["failed"] += 1
+            elif md5 == file_to_verify.md5:
+                verified.append(file_to_verify)
+            else:
+                logger.info("%r modified", file_to_verify.path)
+                modified.append((file_to_verify, md5))
+        self._store_signatures(verified)
+        self.stats["verified"] += len(verified)
+        self._update_checksums(items, modified)
+
+    def _update_checksums(self, items, modified):
+        """Update checksums of the modified files, unless already in the library."""
+        existing = self.lib.find_md5s([md5 for file_to_verify, md5 in modified], self.db)
+        updates = []
+        for file_to_verify, md5 in modified:
+            if md5 in existing:
+                logger.error("%r (item #%i %r) now has the same content as %r",
+                             file_to_verify.path, file_to_verify.item_id,
+                             items[file_to_verify.item_id].name, existing[md5])
+                self.stats["failed"] += 1
+                continue
+            existing[md5] = items[file_to_verify.item_id].name
+            updates.append((file_to_verify, md5))
+        for start in range(0, len(updates), UPDATE_BATCH_SIZE):
+            batch = updates[start:start + UPDATE_BATCH_SIZE]
+            with self.db:
+                for file_to_verify, md5 in batch:
+                    cur = self.db.execute("UPDATE items SET md5 = ? WHERE id = ? AND md5 = ?",
+                                          (md5, file_to_verify.item_id, file_to_verify.md5))
+                    if cur.rowcount:
+                        self.stats["modified"] += 1
+                self._store_signatures_in_transaction([f for f, md5 in batch])
+
+    def _relocate(self, known_paths):
+        """Look for the missing files in the search roots, by checksum."""
+        wanted = {}
+        sizes = set()
+        any_size = False
+        for item in self.missing:
+            wanted.setdefault(item.md5, []).append(item)
+            if item.size is None:
+                any_size = True
+            else:
+                sizes.add(item.size)
+        candidates = []
+        for path, size, mtime_ns in self._list_trees(self.search_roots):
+            if path in known_paths:
+                continue
+            if any_size or size in sizes:
+                candidates.append(FileToVerify(path, None, None, size, mtime_ns))
+        logger.debug("%i candidate files", len(candidates))
+        relocated = []
+        results = hash_files(candidates, self.jobs)
+        try:
+            for found, md5, error in results:
+                if error is not None:
+                    logger.debug("Cannot read %r: %s", found.path, error)
+                    continue
+                if not wanted.get(md5):
+                    continue
+                item = wanted[md5].pop()
+                logger.info("Item #%i %r: %r moved to %r", item.item_id, item.name,
+                            item.path, found.path)
+                relocated.append((item, found))
+                if not any(wanted.values()):
+                    break
+        finally:
+            results.close()
+        found_ids = set()
+        for start in range(0, len(relocated), UPDATE_BATCH_SIZE):
+            batch = relocated[start:start + UPDATE_BATCH_SIZE]
+            with self.db:
+                files = []
+                for item, found in batch:
+                    cur = self.db.execute("UPDATE items SET path = ? WHERE id = ? AND path = ?",
+                                          (found.path, item.item_id, item.path))
+                    if cur.rowcount:
+                        files.append(found._replace(item_id=item.item_id))
+                        found_ids.add(item.item_id)
+                self._store_signatures_in_transaction(files)
+        self.stats["relocated"] += len(found_ids)
+        self.missing = [item for item in self.missing if item.item_id not in found_ids]
+
+    def _list_trees(self, roots):
+        """Yield (path, size, mtime_ns) of all files under the roots.
+
+        Directories are listed in parallel threads."""
+        with ThreadPoolExecutor(max_workers=STAT_THREADS) as executor:
+            pending = set(executor.submit(_list_dir, root) for root in roots)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subdirs, files = future.result()
+                    pending.update(executor.submit(_list_dir, path) for path in subdirs)
+                    yield from files
+
+    def _store_signatures(self, files):
+        for start in range(0, len(files), UPDATE_BATCH_SIZE):
+            with self.db:
+                self._store_signatures_in_transaction(files[start:start + UPDATE_BATCH_SIZE])
+
+    def _store_signatures_in_transaction(self, files):
+        # items might have been removed in the meantime
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO item_files"
+                            "(item_id, size, mtime_ns, verified_at)"
+                            " SELECT id, ?, ?, ? FROM items WHERE id = ?",
+                            [(f.size, f.mtime_ns, now, f.item_id) for f in files])
@@ -2,35 +2,174 @@
 import hashlib
 import os
 import logging
+import sys
 
 from functools import cached_property
 
 from soundfile import SoundFile
 
 from .dsp import compute_peak_level, compute_waveform
-from .lru_cache import LRUCache
+from .lru_cache import LRUCache, ShardedLRUCache
 from .metadata import Metadata
 
 READ_BLOCK_SIZE = 16*1024*1024
 
+# memory budget of the analysis results cache, in bytes
+FILE_INFO_CACHE_SIZE = 64*1024*1024
+
+# stat results from directory scans are trusted for that many seconds
+STAT_TTL = 5.0
+STAT_CACHE_SIZE = 100000
+
 logger = logging.getLogger("file_analyzer")
 
 
+def md5_file(file_obj):
+    """Compute MD5 checksum of data read from a binary file object."""
+    md5_hash = hashlib.md5()
+    while True:
+        data = file_obj.read(READ_BLOCK_SIZE)
+        if not data:
+            break
+        md5_hash.update(data)
+    return md5_hash.hexdigest()
+
+
+def compute_md5(path):
+    """Compute MD5 checksum of a file, without decoding it."""
+    with open(str(path), "rb") as file_obj:
+        return md5_file(file_obj)
+
+
+def file_info_weight(file_info):
+    """Estimate memory used by a file_info dictionary, in bytes."""
+    weight = sys.getsizeof(file_info)
+    for key, value in file_info.items():
+        weight += sys.getsizeof(key) + sys.getsizeof(value)
+        # the waveform is a numpy array, getsizeof() includes the data
+        # only if the array owns it, not for a view
+        if getattr(value, "base", None) is not None:
+            weight += value.nbytes
+    return weight
+
+
+class StatProvider:
+    """Source of file stats (and real paths) for FileKey objects.
+
+    Whole directories may be scanned in advance with `prefetch_dir()` or
+    `walk()`: one os.scandir() call lists a directory and the real path of
+    each file is derived from the real path of the directory, instead of
+    resolving every path separately. The results are then shared by all
+    users of the provider for `ttl` seconds. Paths not prefetched are
+    checked with os.stat() every time.
+
+    The cached stats are good enough for listing files and estimating
+    sizes. Where a file must not be mistaken for its older version (FileKey
+    identity), `stat(path, fresh=True)` is used."""
+
+    def __init__(self, ttl=STAT_TTL, maxsize=STAT_CACHE_SIZE):
+        # path -> (real path, stat result), used by many threads at once
+        self._cache = ShardedLRUCache(maxsize=maxsize, ttl=ttl)
+
+    def _scan_dir(self, dir_path):
+        """Prefetch files in a directory, return their names and subdirectory names."""
+        files = []
+        subdirs = []
+        try:
+            scandir_it = os.scandir(dir_path)
+        except OSError as err:
+            logger.debug("Cannot scan %r: %s", dir_path, err)
+            return files, subdirs
+        real_dir = os.path.realpath(dir_path)
+        with scandir_it:
+            for entry in scandir_it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if entry.is_symlink():
+                        real_path = os.path.realpath(entry.path)
+                    else:
+                        real_path = os.path.join(real_dir, entry.name)
+                except OSError as err:
+                    logger.debug("%r: %s", entry.path, err)
+                    continue
+                record = (real_path, stat)
+                self._cache.put(entry.path, record)
+                self._cache.put(real_path, record)
+                files.append(entry.name)
+        return files, subdirs
+
+    def prefetch_dir(self, dir_path):
+        """Prefetch stats of all files in a directory.
+
+        Returns list of paths of the regular files found."""
+        dir_path = os.fspath(dir_path)
+        files, _ = self._scan_dir(dir_path)
+        return [os.path.join(dir_path, name) for name in files]
+
+    def walk(self, top):
+        """Like os.walk(), but prefetching file stats.
+
+        Yields (dirpath, filenames) tuples, `filenames` listing regular
+        files only."""
+        stack = [os.fspath(top)]
+        while stack:
+            dir_path = stack.pop()
+            files, subdirs = self._scan_dir(dir_path)
+            yield dir_path, files
+            stack += [os.path.join(dir_path, name) for name in reversed(subdirs)]
+
+    def realpath(self, path):
+        path = os.fspath(path)
+        record = self._cache.get(path)
+        if record is not None:
+            return record[0]
+        return os.path.realpath(path)
+
+    def stat(self, path, fresh=False):
+        """Return stat of the file, from the cache unless `fresh` is set.
+
+        A fresh stat also replaces the cached one."""
+        record = self._cache.get(path)
+        if not fresh and record is not None:
+            return record[1]
+        stat = os.stat(path)
+        if record is not None:
+            self._cache.put(path, (record[0], stat))
+        return stat
+
+
+# shared by the file browser, the analyzers and the importers
+STAT_PROVIDER = StatProvider()
+
+
 class FileKey:
     """For reliably using filenames as keys in a cache.
 
     When hashed for the first time (e.g. used as a dictionary key) file stat will be checked
     and used together with the absolute path for hashing and comparison. This
     way a file modified on disk won't be considered to be the same as the one
-    stored in cache.
+    stored in cache. File size, modification time (in nanoseconds), inode
+    and device numbers are compared.
+
+    The real path comes from `stat_provider`, by default the shared
+    STAT_PROVIDER. The stat is always fresh, not one cached by the provider.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, stat_provider=None):
+        if stat_provider is None:
+            stat_provider = STAT_PROVIDER
+        self._stat_provider = stat_provider
         if isinstance(path, FileKey):
             self.path = path.path
             self.stat = path.stat
         else:
-            self.path = os.path.realpath(path)
+            self.path = stat_provider.realpath(path)
 
     def __repr__(self):
         return "FileKey({!r})".format(self.path)
@@ -41,25 +180,31 @@ class FileKey:
     @cached_property
     def stat(self):
         try:
-            stat = os.stat(self.path)
+            stat = self._stat_provider.stat(self.path, fresh=True)
             logger.debug("FileKey: %r: %r", self.path, stat)
             return stat
         except OSError as err:
             logger.debug("FileKey: %r: %s", self.path, err)
             return None
 
+    @cached_property
+    def _identity(self):
+        stat = self.stat
+        if stat is None:
+            return None
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
     def __hash__(self):
-        if self.stat:
-            return hash((self.path, self.stat.st_size, self.stat.st_mtime))
+        if self._identity:
+            return hash((self.path, self._identity))
 
         return hash(self.path)
 
     def __eq__(self, other):
         if isinstance(other, FileKey):
-            return (self.path == other.path
-                    and self.stat
-                    and self.stat.st_size == other.stat.st_size
-                    and self.stat.st_mtime == other.stat.st_mtime)
+            return bool(self.path == other.path
+                        and self._identity
+                        and self._identity == other._identity)
 
         return self.path == other
 
@@ -101,13 +246,7 @@ class FileAnalyzer:
                 file_info["waveform"] = compute_waveform(frames, samplerate)
 
             source_file.seek(0)
-            md5_hash = hashlib.md5()
-            while True:
-                data = source_file.read(READ_BLOCK_SIZE)
-                if not data:
-                    break
-                md5_hash.update(data)
-            file_info["md5"] = md5_hash.hexdigest()
+            file_info["md5"] = md5_file(source_file)
         return file_info
 
     def get_file_metadata(self, path):
@@ -116,8 +255,11 @@ class FileAnalyzer:
 
 
 class CachedFileAnalyzer(FileAnalyzer):
+    """File analyzer with results cache, safe to share between threads."""
     def __init__(self):
-        self._cache = LRUCache()
+        self._cache = LRUCache(maxsize=None,
+                               maxweight=FILE_INFO_CACHE_SIZE,
+                               weight=file_info_weight)
 
     def get_file_info(self, path):
         if not isinstance(path, FileKey):
@@ -125,4 +267,5 @@ class CachedFileAnalyzer(FileAnalyzer):
         file_info = self._cache.get(path)
         if file_info is None:
             file_info = super().get_file_info(path)
+            self._cache.put(path, file_info)
         return file_info
@@ -0,0 +1,141 @@
+"""File copying with filesystem-specific fast paths."""
+
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("file_copy")
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+SENDFILE_CHUNK = 64 * 1024 * 1024
+
+# methods in the preferred order
+COPY_METHODS = ["reflink", "hardlink", "copy_file_range", "sendfile", "copy"]
+
+# hard links share the data with the original file, so changes made to the
+# source would also change the library copy – not used unless allowed
+DEFAULT_COPY_METHODS = ["reflink", "copy_file_range", "sendfile", "copy"]
+
+
+class CopyMethodUnavailable(Exception):
+    """Raised when a copy method cannot be used for given files."""
+    pass
+
+
+# errors meaning 'this method does not work here', not 'the copy failed'
+FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                   errno.ENOTTY, errno.EPERM, errno.EMLINK, errno.EBADF}
+
+
+def _reflink(source, target):
+    if fcntl is None:
+        raise CopyMethodUnavailable("no fcntl module")
+    with open(source, "rb") as source_f:
+        with open(target, "wb") as target_f:
+            fcntl.ioctl(target_f.fileno(), FICLONE, source_f.fileno())
+
+
+def _hardlink(source, target):
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        os.unlink(target)
+        os.link(source, target)
+
+
+def _copy_file_range(source, target):
+    if not hasattr(os, "copy_file_range"):
+        raise CopyMethodUnavailable("os.copy_file_range() not available")
+    with open(source, "rb") as source_f:
+        with open(target, "wb") as target_f:
+            size = os.fstat(source_f.fileno()).st_size
+            while size > 0:
+                copied = os.copy_file_range(source_f.fileno(), target_f.fileno(), size)
+                if not copied:
+                    break
+                size -= copied
+
+
+def _sendfile(source, target):
+    if not hasattr(os, "sendfile"):
+        raise CopyMethodUnavailable("os.sendfile() not available")
+    with open(source, "rb") as source_f:
+        with open(target, "wb") as target_f:
+            offset = 0
+            while True:
+                sent = os.sendfile(target_f.fileno(), source_f.fileno(),
+                                   offset, SENDFILE_CHUNK)
+                if not sent:
+                    break
+                offset += sent
+
+
+def _copy(source, target):
+    shutil.copyfile(source, target)
+
+
+_METHOD_FUNCTIONS = {
+        "reflink": _reflink,
+        "hardlink": _hardlink,
+        "copy_file_range": _copy_file_range,
+        "sendfile": _sendfile,
+        "copy": _copy,
+        }
+
+
+def check_methods(methods):
+    """Validate a list of copy method names."""
+    methods = list(methods)
+    for method in methods:
+        if method not in _METHOD_FUNCTIONS:
+            raise ValueError("Unknown copy method: {!r}".format(method))
+    if not methods:
+        raise ValueError("No copy methods")
+    return methods
+
+
+def copy_file(source, target, methods=None):
+    """Copy `source` to `target` using the first method that works.
+
+    Methods are tried in the given order, falling back to the next one when
+    the method is not supported by the platform or the filesystem(s).
+    Permission bits are copied too, like `shutil.copy()` does.
+
+    Returns name of the method used."""
+    if methods is None:
+        methods = DEFAULT_COPY_METHODS
+    last_error = None
+    for method in methods:
+        function = _METHOD_FUNCTIONS[method]
+        try:
+            function(source, target)
+        except CopyMethodUnavailable as err:
+            logger.debug("%s unavailable: %s", method, err)
+            continue
+        except OSError as err:
+            if method == "copy" or err.errno not in FALLBACK_ERRNOS:
+                raise
+            logger.debug("%s %r to %r failed: %s", method, source, target, err)
+            last_error = err
+            if method != "hardlink":
+                # remove the partial copy
+                try:
+                    os.unlink(target)
+                except OSError:
+                    pass
+            continue
+        if method != "hardlink":
+            shutil.copymode(source, target)
+        logger.debug("%r copied to %r using %s", source, target, method)
+        return method
+    if last_error is not None:
+        raise last_error
+    raise OSError("Cannot copy {!r} to {!r}: no usable copy method".format(source, target))
@@ -0,0 +1,272 @@
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+logger = logging.getLogger("folder_watcher")
+
+# seconds without changes before a file is reported
+DEBOUNCE = 2.0
+
+# seconds between scans when inotify is not available
+SCAN_INTERVAL = 30.0
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class _Inotify:
+    """Minimal inotify binding using ctypes."""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is Linux-only")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init1 = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify not supported by the C library")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Yield (wd, mask, name) for the events available."""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class FolderWatcher:
+    """Reports new and modified files in directory trees.
+
+    Changes are watched with inotify when available; otherwise (or after
+    the event queue overflowed) the trees are scanned every
+    `scan_interval` seconds. A file is reported once it has not changed for
+    `debounce` seconds, so files still being written are not picked up."""
+
+    def __init__(self, paths, debounce=DEBOUNCE, scan_interval=SCAN_INTERVAL,
+                 use_inotify=True):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.debounce = debounce
+        self.scan_interval = scan_interval
+        self._inotify = None
+        self._use_inotify = use_inotify
+        self._watches = {}
+        self._watched_dirs = set()
+        self._signatures = {}
+        self._pending = {}
+        self._next_scan = None
+
+    def start(self):
+        """Start watching, return list of the files already there."""
+        if self._use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except OSError as err:
+                logger.info("inotify not available (%s), will scan for changes", err)
+        result = []
+        for top in self.paths:
+            result += self._scan_tree(top)
+        if self._inotify is None:
+            self._next_scan = time.monotonic() + self.scan_interval
+        return result
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _scan_tree(self, top):
+        """Record signatures of all the files under `top`, return their paths.
+
+        With inotify, directories are watched before they are listed, so
+        no file created in the meantime is missed."""
+        result = []
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            if self._inotify is not None and directory not in self._watched_dirs:
+                try:
+                    wd = self._inotify.add_watch(directory, WATCH_MASK)
+                    self._watches[wd] = directory
+                    self._watched_dirs.add(directory)
+                except OSError as err:
+                    logger.warning("Cannot watch %r: %s", directory, err)
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as err:
+                logger.warning("Cannot list %r: %s", directory, err)
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        self._signatures[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                        result.append(entry.path)
+                except OSError as err:
+                    logger.debug("%r: %s", entry.path, err)
+        return result
+
+    def _rescan(self):
+        """Find files changed since the last scan."""
+        old_signatures = self._signatures
+        self._signatures = {}
+        now = time.monotonic()
+        for top in self.paths:
+            for path in self._scan_tree(top):
+                if self._signatures[path] != old_signatures.get(path):
+                    self._pending[path] = now + self.debounce
+
+    def _changed(self, path):
+        self._pending[path] = time.monotonic() + self.debounce
+
+    def _process_events(self):
+        overflow = False
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # directory removed
+                del self._watches[wd]
+                self._watched_dirs.discard(directory)
+                continue
+            if not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    for file_path in self._scan_tree(path):
+                        self._changed(file_path)
+                elif mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._pending.pop(path, None)
+                self._signatures.pop(path, None)
+            else:
+                self._changed(path)
+        if overflow:
+            logger.warning("Too many file system events, rescanning")
+            self._rescan()
+
+    def _unwatch_tree(self, top):
+        """Stop watching a directory tree moved away."""
+        prefix = top + os.sep
+        for wd, directory in list(self._watches.items()):
+            if directory == top or directory.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+                self._watched_dirs.discard(directory)
+
+    def wait(self, timeout=None):
+        """Wait for files to settle, return their paths.
+
+        Returns an empty list if nothing is ready within `timeout` seconds
+        (None: wait until something is)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            ready = self._ready(now)
+            if ready:
+                return ready
+            delays = []
+            if self._pending:
+                delays.append(min(self._pending.values()) - now)
+            if self._next_scan is not None:
+                delays.append(self._next_scan - now)
+            if deadline is not None:
+                if now >= deadline:
+                    return []
+                delays.append(deadline - now)
+            delay = max(min(delays), 0) if delays else None
+            if self._inotify is not None:
+                readable = select.select([self._inotify.fd], [], [], delay)[0]
+                if readable:
+                    self._process_events()
+            else:
+                time.sleep(delay)
+                if time.monotonic() >= self._next_scan:
+                    self._rescan()
+                    self._next_scan = time.monotonic() + self.scan_interval
+
+    def _ready(self, now):
+        result = []
+        for path, settle_time in list(self._pending.items()):
+            if settle_time > now:
+                continue
+            del self._pending[path]
+            signature = _signature(path)
+            if signature is None:
+                # gone
+                self._signatures.pop(path, None)
+                continue
+            if self._inotify is None and signature != self._signatures.get(path):
+                # still changing
+                self._signatures[path] = signature
+                self._pending[path] = now + self.debounce
+                continue
+            self._signatures[path] = signature
+            if os.path.isfile(path):
+                result.append(path)
+        return result
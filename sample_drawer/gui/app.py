@@ -2,13 +2,14 @@
 import logging
 import os
 
-from PySide2.QtCore import QResource
+from PySide2.QtCore import QResource, QThread
 from PySide2.QtGui import QIcon
 from PySide2.QtWidgets import QApplication
 
 from .signal_handler import SignalHandler
 from .main_window import MainWindow
 from .log_window import LogWindow
+from .scrubber import Scrubber
 from ..audiodrivers import get_audio_driver, AudioDriverError
 
 from . import __path__ as PKG_PATH
@@ -28,6 +29,7 @@ class GUIApplication:
         self.library = app.library
         self.workplace = app.workplace
         self.analyzer = app.analyzer
+        self.scrubber = None
         logging.debug("qt_argv: %r", self.args.qt_argv)
         self.qapp = QApplication(self.args.qt_argv)
         self.qapp.setApplicationName("Sample Drawer")
@@ -53,6 +55,8 @@ class GUIApplication:
         self.log_window = LogWindow(self)
         self.main_window = MainWindow(self)
         self.main_window.show()
+        self.qapp.aboutToQuit.connect(self.main_window.import_jobs.stop)
+        self.start_scrubber()
         signal_handler = SignalHandler()
         signal_handler.activate()
         self.qapp.aboutToQuit.connect(signal_handler.deactivate)
@@ -62,6 +66,23 @@ class GUIApplication:
         finally:
             self.started = False
 
+    def start_scrubber(self):
+        config = self.config["scrubber"]
+        if not config["enabled"] or not self.args.scrubber:
+            logger.debug("Background library check disabled")
+            return
+        self.scrubber = Scrubber(self,
+                                 rate=config["rate"],
+                                 start_delay=config["start_delay"],
+                                 interval=config["interval"],
+                                 max_age=config["max_age"])
+        self.qapp.aboutToQuit.connect(self.scrubber.stop)
+        self.scrubber.start(QThread.IdlePriority)
+
+    def pause_scrubber(self, reason, paused=True):
+        if self.scrubber:
+            self.scrubber.set_paused(reason, paused)
+
     def exit(self, code):
         if self.qapp and self.started:
             self.qapp.exit(code)
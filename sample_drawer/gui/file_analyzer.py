@@ -6,24 +6,37 @@ from functools import partial
 from PySide2.QtCore import QObject, Signal, QRunnable, QThreadPool
 
 from ..lru_cache import LRUCache
-from ..file_analyzer import FileAnalyzer, FileKey
+from ..file_analyzer import FileAnalyzer, FileKey, file_info_weight
 from ..metadata import Metadata
 
 logger = logging.getLogger("gui.file_analyzer")
 
+# memory budget for cached analysis results (mostly waveforms), in bytes
+CACHE_SIZE = 32*1024*1024
+
+# analysis request priorities, higher first
+PRIORITY_BULK = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_INTERACTIVE = 2
+
 
 class FileAnalyzerWorker(QRunnable, FileAnalyzer):
 
     def __init__(self, path):
         QRunnable.__init__(self)
         FileAnalyzer.__init__(self)
+        # kept alive by AsyncFileAnalyzer until the result is delivered,
+        # so it is still there when tryTake() is called
+        self.setAutoDelete(False)
         self.path = path
+        self.started = False
         self.signals = self.Signals()
 
     def run(self):
         """
         Gather sample meta-data in the background.
         """
+        self.started = True
         logger.debug("Thread start for %r", self.path)
         try:
             file_info = self.get_file_info(self.path)
@@ -38,14 +51,36 @@ class FileAnalyzerWorker(QRunnable, FileAnalyzer):
         error = Signal(str)
 
 
+class AnalysisRequest:
+    """Handle of a pending analysis request, for cancelling it."""
+    def __init__(self, file_key, callback):
+        self.file_key = file_key
+        self.callback = callback
+
+
 class AsyncFileAnalyzer(QObject):
+    """Analyzes files in a thread pool, caching the results.
+
+    Queued requests are served by priority: PRIORITY_INTERACTIVE (the
+    default, e.g. the file just selected) first, then PRIORITY_PREFETCH and
+    PRIORITY_BULK (e.g. import). Requesting a file already queued with
+    a lower priority moves it up.
+
+    Requests not answered from the cache return an AnalysisRequest, which
+    can be passed to `cancel()` when the result is not needed any more.
+    A file is not analyzed at all when all requests for it are cancelled
+    before the analysis starts."""
     def __init__(self):
         QObject.__init__(self)
         self.threadpool = QThreadPool()
         self._waiting_for_info = {}
-        self._cache = LRUCache(maxsize=10)
+        # file_key -> (worker, priority) for analysis queued or running
+        self._workers = {}
+        self._cache = LRUCache(maxsize=None,
+                               maxweight=CACHE_SIZE,
+                               weight=file_info_weight)
 
-    def request_waveform(self, path, callback=None):
+    def request_waveform(self, path, callback=None, priority=PRIORITY_INTERACTIVE):
         if isinstance(path, FileKey):
             file_key = path
         else:
@@ -54,16 +89,16 @@ class AsyncFileAnalyzer(QObject):
         if file_info is not None:
             waveform = file_info.get("waveform")
             callback(file_key, waveform)
-            return
+            return None
 
         def our_callback(path, file_info):
             if file_info:
                 waveform = file_info.get("waveform")
                 callback(path, waveform)
 
-        self._request_info(path, callback=our_callback)
+        return self._request_info(file_key, our_callback, priority)
 
-    def request_file_metadata(self, path, callback=None):
+    def request_file_metadata(self, path, callback=None, priority=PRIORITY_INTERACTIVE):
         if isinstance(path, FileKey):
             file_key = path
         else:
@@ -72,7 +107,7 @@ class AsyncFileAnalyzer(QObject):
         if file_info is not None:
             metadata = Metadata.from_file_info(file_info)
             callback(file_key, metadata)
-            return
+            return None
 
         def our_callback(path, file_info):
             if file_info:
@@ -81,35 +116,67 @@ class AsyncFileAnalyzer(QObject):
                 metadata = None
             callback(path, metadata)
 
-        self._request_info(path, callback=our_callback)
+        return self._request_info(file_key, our_callback, priority)
 
-    def _request_info(self, file_key, callback):
+    def _request_info(self, file_key, callback, priority):
         logger.debug("File info for %r not known yet", str(file_key))
+        request = AnalysisRequest(file_key, callback)
         waiting_list = self._waiting_for_info.get(file_key)
-        if waiting_list:
+        if waiting_list is not None:
             logger.debug("Already requested, adding to the waiting list")
-            waiting_list.append(callback)
+            waiting_list.append(request)
+            worker, old_priority = self._workers[file_key]
+            if (priority > old_priority and not worker.started
+                    and self.threadpool.tryTake(worker)):
+                logger.debug("Raising priority of %r to %r", str(file_key), priority)
+                self._workers[file_key] = (worker, priority)
+                self.threadpool.start(worker, priority)
         else:
             worker = FileAnalyzerWorker(file_key)
             our_callback = partial(self._file_info_received, file_key)
             our_error_callback = partial(self._file_info_error, file_key)
-            self._waiting_for_info[file_key] = [callback]
+            self._waiting_for_info[file_key] = [request]
+            self._workers[file_key] = (worker, priority)
             worker.signals.finished.connect(our_callback)
             worker.signals.error.connect(our_error_callback)
-            self.threadpool.start(worker)
+            self.threadpool.start(worker, priority)
+        return request
+
+    def cancel(self, request):
+        """Cancel a request returned by one of the request_*() methods.
+
+        The callback will not be called. Does nothing if the request has
+        been completed already (or request is None)."""
+        if request is None:
+            return
+        file_key = request.file_key
+        waiting_list = self._waiting_for_info.get(file_key)
+        if not waiting_list or request not in waiting_list:
+            return
+        waiting_list.remove(request)
+        if waiting_list:
+            return
+        worker = self._workers[file_key][0]
+        if not worker.started and self.threadpool.tryTake(worker):
+            logger.debug("Analysis of %r cancelled", str(file_key))
+            del self._waiting_for_info[file_key]
+            del self._workers[file_key]
+        # else already running, the result will still be cached
 
     def _file_info_received(self, file_key, file_info):
         logger.debug("file_info_received for %r called with %r", file_key, file_info)
         self._cache.put(file_key, file_info)
-        callbacks = self._waiting_for_info.pop(file_key)
-        for callback in callbacks:
-            callback(file_key, file_info)
+        self._workers.pop(file_key, None)
+        requests = self._waiting_for_info.pop(file_key, [])
+        for request in requests:
+            request.callback(file_key, file_info)
 
     def _file_info_error(self, file_key, err):
         logger.debug("file_info_error for %r called with %r", file_key, err)
-        callbacks = self._waiting_for_info.pop(file_key)
-        for callback in callbacks:
-            callback(file_key, None)
+        self._workers.pop(file_key, None)
+        requests = self._waiting_for_info.pop(file_key, [])
+        for request in requests:
+            request.callback(file_key, None)
 
     def get_file_info(self, path):
         if not isinstance(path, FileKey):
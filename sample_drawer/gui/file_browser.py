@@ -3,11 +3,13 @@ import logging
 import os
 
 from PySide2.QtCore import Slot, Signal, QTimer, QObject, QItemSelection, Qt, QDir, QFileInfo, \
-                           QModelIndex
+                           QModelIndex, QRunnable, QThreadPool
 from PySide2.QtGui import QIcon
 from PySide2.QtWidgets import QFileSystemModel, QAbstractItemView
 from PySide2.QtWidgets import QFileIconProvider
 
+from ..file_analyzer import STAT_PROVIDER
+
 logger = logging.getLogger("file_browser")
 
 KNOWN_EXTENSIONS = ["wav", "flac", "ogg", "oga", "aif", "aiff", "au"]
@@ -30,6 +32,16 @@ class FileIconProvider(QFileIconProvider):
             return super().icon(info)
 
 
+class DirPrefetchWorker(QRunnable):
+    """Prefetches file stats of a directory in a pool thread."""
+    def __init__(self, path):
+        QRunnable.__init__(self)
+        self.path = path
+
+    def run(self):
+        STAT_PROVIDER.prefetch_dir(self.path)
+
+
 class FileBrowser(QObject):
     file_selected = Signal(str)
     file_activated = Signal(str)
@@ -41,6 +53,10 @@ class FileBrowser(QObject):
         self.show_hidden_chk = window.show_hidden
         self.name_filter_combo = window.name_filter
         self.model = QFileSystemModel(self.view)
+        self.prefetcher = None
+        # one thread, so directories are not scanned in parallel
+        self.threadpool = QThreadPool()
+        self.threadpool.setMaxThreadCount(1)
         self.icon_provider = FileIconProvider()
         if app.args.root:
             self.model.setRootPath(app.args.root)
@@ -86,17 +102,23 @@ class FileBrowser(QObject):
         if show:
             flags |= QDir.Hidden
         self.model.setFilter(flags)
+        if self.prefetcher:
+            self.prefetcher.cancel()
         QTimer.singleShot(100, self.scroll_to_current)
 
     @Slot()
     def apply_name_filters(self):
         filters = self.name_filter_combo.currentData()
         self.model.setNameFilters(filters)
+        if self.prefetcher:
+            self.prefetcher.cancel()
         QTimer.singleShot(100, self.scroll_to_current)
 
     @Slot(str)
     def directory_loaded(self, path):
         logger.debug("directory loaded: %s", path)
+        # files listed are likely to be selected soon
+        self.threadpool.start(DirPrefetchWorker(path))
         if path == self.current_path:
             logger.debug("requesting scrolling")
             QTimer.singleShot(100, self.scroll_to_current)
@@ -120,6 +142,13 @@ class FileBrowser(QObject):
             if os.path.isfile(path):
                 self.file_selected.emit(path)
             self.current_path = path
+            if self.prefetcher:
+                self.prefetcher.prefetch_around(self.view, index, self.get_file_path)
+
+    def get_file_path(self, index):
+        if self.model.isDir(index):
+            return None
+        return self.model.filePath(index)
 
     @Slot(QModelIndex)
     def double_clicked(self, index):
@@ -2,14 +2,19 @@
 import logging
 import os
 
+from collections import deque
 from functools import partial
 
 from PySide2.QtCore import Qt, QFile, QRegExp, QTimer
 from PySide2.QtUiTools import QUiLoader
 from PySide2.QtWidgets import QDialogButtonBox, QAbstractItemView
-from PySide2.QtGui import QStandardItemModel, QStandardItem, QRegExpValidator
+from PySide2.QtGui import QRegExpValidator
 
-from ..library import LibraryConflictError
+from ..metadata import RewriteRules
+from .file_analyzer import PRIORITY_BULK
+from .import_job import ImportJob
+from .import_preview import PreviewModel, FILE_COLUMN
+from .scrubber import PAUSE_IMPORT
 
 from . import __path__ as PKG_PATH
 
@@ -21,12 +26,19 @@ logger = logging.getLogger("import_dialog")
 
 UI_FILENAME = os.path.join(PKG_PATH[0], "import_dialog.ui")
 
+# analysis requests queued at once, per analyzer thread
+REQUESTS_PER_THREAD = 2
+
 
 class ImportDialog:
     def __init__(self, main_window):
         self.main_window = main_window
         self.app = main_window.app
+        # (path, metadata) pairs, metadata is None until analyzed
         self.items = []
+        self._pending = deque()
+        self._in_flight = {}
+        self._requesting = False
         self.extra_tags = []
         self.loading = False
         self.exitting = False
@@ -37,13 +49,13 @@ class ImportDialog:
         self.window = loader.load(ui_file, main_window.window)
         self.window.setModal(True)
         self.preview = self.window.preview
-        self.preview_model = QStandardItemModel()
-        self.preview_model.setColumnCount(3)
-        self.set_preview_header()
+        self.preview_model = PreviewModel(self.window)
         self.preview.setHeaderHidden(False)
         self.preview.setIndentation(0)
+        self.preview.setUniformRowHeights(True)
         self.preview.setModel(self.preview_model)
-        self.preview.sortByColumn(0, Qt.AscendingOrder)
+        # sorting by name would need all the names computed up front
+        self.preview.sortByColumn(FILE_COLUMN, Qt.AscendingOrder)
         self.preview.setDragEnabled(False)
         self.preview.setAcceptDrops(False)
         self.preview.setSortingEnabled(True)
@@ -75,14 +87,15 @@ class ImportDialog:
 
     def rules_selected_changed(self, index):
         key = self.rewrite_rules_combo.itemData(index)
-        self.rewrite_rules = self.app.config["rewrite_rules"][key]["rules"]
+        self.rewrite_rules = RewriteRules(self.app.config["rewrite_rules"][key]["rules"])
+        self.update_preview()
 
     def tags_input_edited(self, text):
         tags_input = self.window.extra_tags_input
         if tags_input.hasAcceptableInput():
             text = text.replace(",", "").replace(";", "")
             self.extra_tags = text.split()
-            self.preview_timer.start(600)
+            self.preview_timer.start(300)
         self.enable_disable_ok()
 
     def enable_disable_ok(self):
@@ -96,91 +109,102 @@ class ImportDialog:
         logger.debug("load_files%r", (paths, root, base_folder))
         if not root:
             root = "/"
-        self.items = []
+        paths = sorted(paths)
+        self.items = [(path, None) for path in paths]
         self.extra_tags = []
         self.loading = True
         self.ok_button.setEnabled(False)
-        self.cancel_button.setEnabled(False)
         self.window.root_input.setText(root)
         self.window.root_tag_input.setText(base_folder)
+        # names and tags come from the paths, so they can be shown at once
+        self.preview_model.set_items(self.items)
+        self.update_preview()
         self.window.show()
 
-        self.app.qapp.setOverrideCursor(Qt.WaitCursor)
-        self.app.qapp.processEvents()
-        paths = sorted(paths)
-        path, paths = paths[0], paths[1:]
-        logger.debug("requesting %r", path)
-        callback = partial(self._add_file_metadata, remaining=paths)
-        self.main_window.file_analyzer.request_file_metadata(path, callback)
-        self.cancel_button.setEnabled(True)
-        self.window.exec_()
-
-    def _add_file_metadata(self, path, metadata, remaining):
-        logger.debug("_add_file_metadata%r", (path, metadata, remaining))
-        if self.exitting:
+        self.app.qapp.setOverrideCursor(Qt.BusyCursor)
+        self._pending = deque(range(len(paths)))
+        self._in_flight = {}
+        self._request_analysis()
+        self.app.pause_scrubber(PAUSE_IMPORT)
+        try:
+            self.window.exec_()
+        finally:
+            self.app.pause_scrubber(PAUSE_IMPORT, False)
+
+    def _request_analysis(self):
+        """Keep the analyzer busy, but with a bounded number of requests queued."""
+        if self._requesting:
+            # called back synchronously, for a cached result – the loop
+            # below will continue with the next files
             return
-        if metadata:
-            self.items.append((path, metadata))
-            self.add_preview_item(path, metadata)
-        if remaining:
-            self.app.qapp.processEvents()
-            callback = partial(self._add_file_metadata,
-                               remaining=remaining[1:])
-            self.main_window.file_analyzer.request_file_metadata(remaining[0],
-                                                                 callback)
-        else:
-            logger.debug("all files added")
+        analyzer = self.main_window.file_analyzer
+        limit = REQUESTS_PER_THREAD * analyzer.threadpool.maxThreadCount()
+        self._requesting = True
+        try:
+            while self._pending and len(self._in_flight) < limit and not self.exitting:
+                index = self._pending.popleft()
+                path = self.items[index][0]
+                logger.debug("requesting %r", path)
+                callback = partial(self._file_analyzed, index)
+                request = analyzer.request_file_metadata(path, callback, PRIORITY_BULK)
+                if request:
+                    self._in_flight[index] = request
+        finally:
+            self._requesting = False
+        if not self._pending and not self._in_flight and self.loading:
+            logger.debug("all files analyzed")
+            self.loading = False
+            self.items = [(path, metadata) for path, metadata in self.items if metadata]
+            self.preview_model.set_items(self.items, keep_cache=True)
             self.preview.resizeColumnToContents(1)
             self.preview.resizeColumnToContents(0)
             self.app.qapp.restoreOverrideCursor()
-            self.loading = False
             self.enable_disable_ok()
 
+    def _file_analyzed(self, index, path, metadata):
+        logger.debug("_file_analyzed%r", (index, path, metadata))
+        self._in_flight.pop(index, None)
+        if self.exitting:
+            return
+        path = self.items[index][0]
+        if metadata:
+            self.items[index] = (path, metadata)
+            self.preview_model.item_updated(index)
+        else:
+            logger.warning("Cannot import %r: analysis failed", str(path))
+        self._request_analysis()
+
+    def _cancel_analysis(self):
+        analyzer = self.main_window.file_analyzer
+        self._pending.clear()
+        for request in self._in_flight.values():
+            analyzer.cancel(request)
+        self._in_flight = {}
+
     def load_workplace_items(self, items, root="/"):
         self.window.show()
 
     def update_preview(self):
-        self.preview_model.clear()
-        self.set_preview_header()
-        for path, metadata in self.items:
-            self.add_preview_item(path, metadata)
-        self.preview.resizeColumnToContents(1)
-        self.preview.resizeColumnToContents(0)
-
-    def set_preview_header(self):
-        self.preview_model.setHorizontalHeaderLabels(["Name", "Tags", "File"])
-
-    def add_preview_item(self, path, metadata):
-        root = self.window.root_input.text()
-        metadata = metadata.rewrite(self.rewrite_rules, root=root)
-        metadata.add_tags(self.extra_tags)
-        item1 = QStandardItem(metadata.name)
-        item2 = QStandardItem(", ".join(metadata.get_tags()))
-        item3 = QStandardItem(str(path))
-        self.preview_model.appendRow([item1, item2, item3])
+        self.preview_model.set_rules(self.rewrite_rules, self.window.root_input.text())
+        self.preview_model.set_extra_tags(self.extra_tags)
 
     def ok_clicked(self):
         logger.debug("OK clicked")
         self.exitting = True
         self.cancel_button.setEnabled(False)
         self.ok_button.setEnabled(False)
-        self.app.qapp.setOverrideCursor(Qt.WaitCursor)
-        try:
-            root = self.window.root_input.text()
-            for path, metadata in self.items:
-                metadata = metadata.rewrite(self.rewrite_rules, root=root)
-                metadata.add_tags(self.extra_tags)
-                try:
-                    self.app.library.import_file(metadata)
-                except LibraryConflictError as err:
-                    logger.info("File %r (%r) already in the library, known as %r. Ignoring it.",
-                                path, err.md5, err.existing_name)
-        finally:
-            self.app.qapp.restoreOverrideCursor()
-            self.window.close()
+        job = ImportJob(self.app,
+                        [metadata for path, metadata in self.items],
+                        rules=self.rewrite_rules,
+                        root=self.window.root_input.text(),
+                        extra_tags=list(self.extra_tags))
+        self.main_window.import_jobs.add(job)
+        self.window.close()
 
     def cancel_clicked(self):
         logger.debug("Cancel clicked")
         self.exitting = True
-        self.app.qapp.restoreOverrideCursor()
+        self._cancel_analysis()
+        if self.loading:
+            self.app.qapp.restoreOverrideCursor()
         self.window.close()
@@ -0,0 +1,181 @@
+
+import logging
+import threading
+import time
+import traceback
+
+from collections import Counter, deque
+
+from PySide2.QtCore import QObject, QThread, Signal, Slot
+from PySide2.QtWidgets import QLabel, QProgressBar, QPushButton
+
+from ..file_analyzer import STAT_PROVIDER
+from ..library import (LibraryConflictError, LibraryError, IMPORT_BATCH_SIZE,
+                       format_import_stats)
+from .scrubber import PAUSE_IMPORT_JOB
+
+logger = logging.getLogger("gui.import_job")
+
+# minimum seconds between progress updates
+PROGRESS_INTERVAL = 0.2
+
+
+class ImportJob(QThread):
+    """Imports analyzed files into the library in the background.
+
+    The metadata is rewritten with the rules and the files added in
+    batches, each in a single transaction on the job's own database
+    connection, with the files copied in parallel (see
+    Library.import_files()). Cancelling stops the job after the current
+    batch, files imported so far stay in the library.
+
+    Messages are logged in the GUI thread, through the `message` signal."""
+    progress = Signal(int, int, float, float)
+    message = Signal(int, str)
+
+    def __init__(self, app, items, rules, root, extra_tags):
+        QThread.__init__(self)
+        self.app = app
+        self.items = items
+        self.rules = rules
+        self.root = root
+        self.extra_tags = extra_tags
+        self.stats = Counter()
+        self._cancelled = threading.Event()
+        self.message.connect(self._log_message)
+
+    def cancel(self):
+        """Stop after the current batch. Thread-safe."""
+        self._cancelled.set()
+
+    def run(self):
+        db = None
+        try:
+            db = self.app.library.open_connection()
+            self._import(db)
+        except (LibraryError, OSError) as err:
+            self._log(logging.ERROR, "Import failed: %s", err)
+        except Exception:
+            self._log(logging.ERROR, "Import failed\n%s", traceback.format_exc().rstrip())
+        finally:
+            if db is not None:
+                db.close()
+            self._log(logging.INFO, "%s", format_import_stats(self.stats))
+
+    def _log(self, level, msg, *args):
+        """Log a message from the job thread, via the GUI thread."""
+        self.message.emit(level, msg % args)
+
+    @Slot(int, str)
+    def _log_message(self, level, message):
+        logger.log(level, "%s", message)
+
+    def _import(self, db):
+        total = len(self.items)
+        done = 0
+        bytes_done = 0
+        start = last_progress = time.monotonic()
+        for first in range(0, total, IMPORT_BATCH_SIZE):
+            if self._cancelled.is_set():
+                self._log(logging.INFO, "Import cancelled, %i files not imported",
+                          total - done)
+                break
+            batch = list(self.rules.apply_all(self.items[first:first + IMPORT_BATCH_SIZE],
+                                              root=self.root))
+            for metadata in batch:
+                metadata.add_tags(self.extra_tags)
+            results = self.app.library.import_files(batch, db=db)
+            for metadata, result in zip(batch, results):
+                path = metadata.path
+                if isinstance(result, LibraryConflictError):
+                    self._log(logging.INFO, "File %r (%r) already in the library, known as %r."
+                              " Ignoring it.", path, result.md5, result.existing_name)
+                    self.stats["skipped"] += 1
+                    continue
+                elif isinstance(result, OSError):
+                    self._log(logging.ERROR, "Cannot copy %r to the library: %s",
+                              path, result)
+                    self.stats["failed"] += 1
+                    continue
+                self.stats["imported"] += 1
+                if result:
+                    self.stats["copy:" + result] += 1
+                try:
+                    bytes_done += STAT_PROVIDER.stat(path).st_size
+                except OSError:
+                    pass
+            done += len(batch)
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL or done == total:
+                elapsed = max(now - start, 0.001)
+                self.progress.emit(done, total, done / elapsed, bytes_done / elapsed)
+                last_progress = now
+
+
+class ImportJobs(QObject):
+    """Runs import jobs one after another, showing progress in the status bar."""
+    all_finished = Signal()
+
+    def __init__(self, app, statusbar):
+        QObject.__init__(self)
+        self.app = app
+        self.current = None
+        self._queue = deque()
+        self.label = QLabel()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton("Cancel import")
+        self.cancel_button.clicked.connect(self.cancel)
+        for widget in (self.label, self.progress_bar, self.cancel_button):
+            statusbar.addPermanentWidget(widget)
+            widget.hide()
+
+    def add(self, job):
+        self._queue.append(job)
+        if self.current is None:
+            self._start_next()
+
+    def cancel(self):
+        """Cancel the running job and all the queued ones."""
+        self._queue.clear()
+        if self.current is not None:
+            self.current.cancel()
+            self.label.setText("Cancelling import…")
+
+    def stop(self):
+        """Cancel all the jobs and wait for the running one to finish."""
+        job = self.current
+        self.cancel()
+        if job is not None:
+            job.wait()
+
+    def _start_next(self):
+        job = self.current = self._queue.popleft()
+        job.progress.connect(self._job_progress)
+        job.finished.connect(self._job_finished)
+        self.progress_bar.setRange(0, len(job.items))
+        self.progress_bar.setValue(0)
+        self.label.setText("Importing {} files…".format(len(job.items)))
+        for widget in (self.label, self.progress_bar, self.cancel_button):
+            widget.show()
+        self.app.pause_scrubber(PAUSE_IMPORT_JOB)
+        job.start()
+
+    @Slot(int, int, float, float)
+    def _job_progress(self, done, total, files_per_second, bytes_per_second):
+        self.progress_bar.setValue(done)
+        self.label.setText("Importing: {}/{} files, {:.1f} files/s, {:.1f} MiB/s"
+                           .format(done, total, files_per_second,
+                                   bytes_per_second / (1024 * 1024)))
+
+    @Slot()
+    def _job_finished(self):
+        logger.debug("import job finished")
+        self.current = None
+        if self._queue:
+            self._start_next()
+            return
+        for widget in (self.label, self.progress_bar, self.cancel_button):
+            widget.hide()
+        self.app.pause_scrubber(PAUSE_IMPORT_JOB, False)
+        self.all_finished.emit()
@@ -0,0 +1,149 @@
+
+import logging
+
+from PySide2.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+from ..metadata import Metadata
+
+logger = logging.getLogger("gui.import_preview")
+
+HEADER = ["Name", "Tags", "File"]
+NAME_COLUMN, TAGS_COLUMN, FILE_COLUMN = range(3)
+
+
+class PreviewModel(QAbstractTableModel):
+    """Import preview: names and tags the files will get.
+
+    Rows are computed only when the view asks for them (that is, when they
+    are visible) and the rewrite rule results are cached per path, so only
+    a change of the rules or of the file metadata requires running the
+    rules again. Extra tags are added when a row is displayed."""
+
+    def __init__(self, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        self.items = []
+        self.rules = []
+        self.root = None
+        self.extra_tags = set()
+        self._order = []
+        self._rows = {}
+        self._cache = {}
+        self._sort_column = None
+        self._sort_order = Qt.AscendingOrder
+
+    def set_items(self, items, keep_cache=False):
+        """Set the (path, metadata) list. metadata may be None if not known yet.
+
+        Cached rule results may be kept if the metadata did not change."""
+        self.beginResetModel()
+        self.items = items
+        self._order = list(range(len(items)))
+        self._rows = {item_index: item_index for item_index in self._order}
+        if not keep_cache:
+            self._cache = {}
+        self.endResetModel()
+        self._resort()
+
+    def set_rules(self, rules, root):
+        if rules == self.rules and root == self.root:
+            return
+        self.rules = rules
+        self.root = root
+        self._cache = {}
+        self._columns_changed(NAME_COLUMN, TAGS_COLUMN)
+        self._resort()
+
+    def set_extra_tags(self, tags):
+        tags = set(tags)
+        if tags == self.extra_tags:
+            return
+        self.extra_tags = tags
+        self._columns_changed(TAGS_COLUMN, TAGS_COLUMN)
+        if self._sort_column == TAGS_COLUMN:
+            self._resort()
+
+    def item_updated(self, item_index):
+        """Metadata of `self.items[item_index]` changed."""
+        path = self.items[item_index][0]
+        self._cache.pop(path, None)
+        # the row is not moved even if sorted by name or tags, re-sorting on
+        # every analysis result would be too expensive
+        row = self._rows[item_index]
+        self.dataChanged.emit(self.index(row, NAME_COLUMN), self.index(row, TAGS_COLUMN))
+
+    def _columns_changed(self, first, last):
+        if self._order:
+            self.dataChanged.emit(self.index(0, first),
+                                  self.index(len(self._order) - 1, last))
+
+    def _rewritten(self, item_index):
+        """Return name and tags after the rewrite rules for an item."""
+        path, metadata = self.items[item_index]
+        result = self._cache.get(path)
+        if result is None:
+            if metadata is None:
+                # not analyzed yet
+                metadata = Metadata({"_path": str(path)})
+            metadata = metadata.rewrite(self.rules, root=self.root)
+            result = (metadata.name or "", frozenset(metadata.get_tags()))
+            self._cache[path] = result
+        return result
+
+    def _tags_text(self, item_index):
+        tags = self._rewritten(item_index)[1] | self.extra_tags
+        return ", ".join(sorted(tags))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._order)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(HEADER)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return HEADER[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        item_index = self._order[index.row()]
+        column = index.column()
+        if column == NAME_COLUMN:
+            return self._rewritten(item_index)[0]
+        elif column == TAGS_COLUMN:
+            return self._tags_text(item_index)
+        else:
+            return str(self.items[item_index][0])
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self._sort_column = column
+        self._sort_order = order
+        self._resort()
+
+    def _resort(self):
+        column = self._sort_column
+        if column is None:
+            return
+        if column == NAME_COLUMN:
+            def key(i):
+                return self._rewritten(i)[0]
+        elif column == TAGS_COLUMN:
+            key = self._tags_text
+        else:
+            def key(i):
+                return str(self.items[i][0])
+        self.layoutAboutToBeChanged.emit()
+        old_order = self._order
+        self._order = sorted(old_order, key=key,
+                             reverse=(self._sort_order == Qt.DescendingOrder))
+        self._rows = {item_index: row for row, item_index in enumerate(self._order)}
+        from_list = self.persistentIndexList()
+        to_list = [self.index(self._rows[old_order[index.row()]], index.column())
+                   for index in from_list]
+        self.changePersistentIndexList(from_list, to_list)
+        self.layoutChanged.emit()
@@ -66,10 +66,7 @@ class ItemMimeData(QMimeData):
 
         paths = self._paths
         if paths is None:
-            paths = []
-            for item in self._items:
-                path = self._app.library.get_pretty_path(item, timeout=60)
-                paths.append(path)
+            paths = self._app.library.get_pretty_paths(self._items, timeout=60)
             self._paths = paths
 
         if mime_type == "text/plain":
@@ -154,6 +151,7 @@ class LibraryItems(QObject):
         self.items = []
         self.items_incomplete = False
         self.model = ItemModel(self.app)
+        self.prefetcher = None
         self.model.setColumnCount(1)
         self.compl_model = QStandardItemModel()
         self.compl_model.setColumnCount(1)
@@ -179,6 +177,8 @@ class LibraryItems(QObject):
         self.run_query()
 
     def reload(self):
+        if self.prefetcher:
+            self.prefetcher.cancel()
         self.model.clear()
         self.item_selected.emit(None)
         icon = QIcon.fromTheme("audio-x-generic")
@@ -205,6 +205,14 @@ class LibraryItems(QObject):
         else:
             metadata = None
         self.item_selected.emit(metadata)
+        if metadata and self.prefetcher:
+            self.prefetcher.prefetch_around(self.view, index, self.get_item_path)
+
+    def get_item_path(self, index):
+        metadata = self.model.itemFromIndex(index).data()
+        if not metadata:
+            return None
+        return self.library.get_item_path(metadata)
 
     @Slot(QModelIndex)
     def double_clicked(self, index):
@@ -12,10 +12,13 @@ from .lib_items import LibraryItems
 from .player import Player
 from ..metadata import Metadata
 from .file_analyzer import AsyncFileAnalyzer, FileKey
+from ..file_analyzer import STAT_PROVIDER
 from .metadata_browser import MetadataBrowser
 from .waveform import WaveformWidget
 from .workplace import WorkplaceItems
 from .import_dialog import ImportDialog
+from .import_job import ImportJobs
+from .prefetcher import Prefetcher
 
 from . import __path__ as PKG_PATH
 
@@ -74,8 +77,17 @@ class MainWindow:
         self.lib_items = LibraryItems(app, self.window, self.lib_tree)
         self.sample_player = Player(app, self.window)
         self.file_analyzer = AsyncFileAnalyzer()
+        neighbours = app.args.prefetch
+        if neighbours is None:
+            neighbours = app.config["prefetch"]["neighbours"]
+        if neighbours:
+            max_size = app.config["prefetch"]["max_size"]
+            self.file_browser.prefetcher = Prefetcher(self.file_analyzer, neighbours, max_size)
+            self.lib_items.prefetcher = Prefetcher(self.file_analyzer, neighbours, max_size)
         self.workplace_items = WorkplaceItems(app, self.window, self.file_analyzer)
         self.metadata_browser = MetadataBrowser(self.window.metadata_view)
+        self.import_jobs = ImportJobs(app, self.window.statusbar)
+        self.import_jobs.all_finished.connect(self.lib_tree.reload)
         self.file_browser.file_selected.connect(self.sample_player.file_selected)
         self.file_browser.file_selected.connect(self.file_selected)
         self.file_browser.file_activated.connect(self.file_activated)
@@ -86,6 +98,7 @@ class MainWindow:
         log_window = self.app.log_window.window
         self.window.action_log_window.toggled.connect(log_window.setVisible)
         self.current_file = None
+        self._analysis_requests = []
 
     def set_stylesheet(self):
         palette = self.window.palette()
@@ -111,7 +124,19 @@ class MainWindow:
     def show(self):
         self.window.show()
 
+    def cancel_analysis_requests(self):
+        """Cancel analysis of previously selected files, not needed any more."""
+        for request in self._analysis_requests:
+            self.file_analyzer.cancel(request)
+        self._analysis_requests = []
+
+    def request_waveform(self, path):
+        request = self.file_analyzer.request_waveform(path, self.waveform_received)
+        if request:
+            self._analysis_requests.append(request)
+
     def file_selected(self, path):
+        self.cancel_analysis_requests()
         if not path:
             self.current_file = None
             return
@@ -120,8 +145,10 @@ class MainWindow:
         self.window.waveform.set_waveform(None)
         self.window.waveform.set_duration(0)
         self.window.waveform.set_cursor_position(-1)
-        self.file_analyzer.request_waveform(path, self.waveform_received)
-        self.file_analyzer.request_file_metadata(path, self.metadata_received)
+        self.request_waveform(path)
+        request = self.file_analyzer.request_file_metadata(path, self.metadata_received)
+        if request:
+            self._analysis_requests.append(request)
 
     def file_activated(self, path):
         path = FileKey(path)
@@ -131,6 +158,7 @@ class MainWindow:
 
     def item_selected(self, metadata):
         logger.debug("library item selected: %r", metadata)
+        self.cancel_analysis_requests()
         if metadata:
             path = self.app.library.get_item_path(metadata)
             self.window.waveform.set_duration(metadata.duration)
@@ -140,7 +168,7 @@ class MainWindow:
         self.window.waveform.set_waveform(None)
         self.window.waveform.set_cursor_position(-1)
         if path:
-            self.file_analyzer.request_waveform(path, self.waveform_received)
+            self.request_waveform(path)
         self.metadata_browser.set_metadata(metadata)
         self.sample_player.file_selected(path)
 
@@ -156,6 +184,7 @@ class MainWindow:
         else:
             metadata = None
         logger.debug("workplace item selected: %r", metadata)
+        self.cancel_analysis_requests()
         if metadata:
             path = self.app.workplace.get_item_path(metadata)
             self.window.waveform.set_duration(metadata.duration)
@@ -165,7 +194,7 @@ class MainWindow:
         self.window.waveform.set_waveform(None)
         self.window.waveform.set_cursor_position(-1)
         if path:
-            self.file_analyzer.request_waveform(path, self.waveform_received)
+            self.request_waveform(path)
         self.metadata_browser.set_metadata(metadata)
         self.sample_player.file_selected(path)
 
@@ -201,7 +230,7 @@ class MainWindow:
         file_paths = []
         for path in paths:
             if os.path.isdir(path):
-                for dirpath, dirnames, filenames in os.walk(path):
+                for dirpath, filenames in STAT_PROVIDER.walk(path):
                     for filename in filenames:
                         file_paths.append(os.path.join(dirpath, filename))
             elif os.path.isfile(path):
@@ -209,7 +238,7 @@ class MainWindow:
             else:
                 logger.warning("Cannot import %r: is not a regular file", path)
         if file_paths:
+            # the library tree is reloaded when the import job finishes
             dialog.load_files(file_paths, root)
-            self.lib_tree.reload()
         else:
             logger.warning("Nothing to import")
@@ -6,6 +6,7 @@ from PySide2.QtGui import QIcon
 from cffi import FFI
 
 from ..audiodrivers.driver import AudioState
+from .scrubber import PAUSE_AUDITION
 
 ffi = FFI()
 logger = logging.getLogger("player")
@@ -34,6 +35,7 @@ class Player:
         self.window.waveform.set_cursor_position(pos)
 
     def audio_state_changed(self, state):
+        self.app.pause_scrubber(PAUSE_AUDITION, state == AudioState.PLAYING)
         if state == AudioState.PLAYING:
             self.window.stop_btn.setEnabled(False)
             self.window.play_btn.setIcon(self.pause_icon)
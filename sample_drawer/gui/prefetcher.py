@@ -0,0 +1,74 @@
+
+import logging
+
+from .file_analyzer import PRIORITY_PREFETCH
+from ..file_analyzer import STAT_PROVIDER
+
+logger = logging.getLogger("gui.prefetcher")
+
+
+class Prefetcher:
+    """Analyzes entries around the selected one in advance.
+
+    On each selection the next and previous `neighbours` entries visible in
+    the view are requested with the prefetch priority, nearest first, as
+    long as their total file size does not exceed `max_size` (memory
+    needed for the analysis is proportional to it). Requests from the
+    previous selection are cancelled."""
+
+    def __init__(self, file_analyzer, neighbours, max_size):
+        self.file_analyzer = file_analyzer
+        self.neighbours = neighbours
+        self.max_size = max_size
+        self._requests = []
+
+    def cancel(self):
+        for request in self._requests:
+            self.file_analyzer.cancel(request)
+        self._requests = []
+
+    def prefetch_around(self, view, index, get_path):
+        """Prefetch neighbours of `index` in a tree or list view.
+
+        `get_path` returns file path for a model index, or None for entries
+        which are not files."""
+        self.cancel()
+        if not self.neighbours or not index.isValid():
+            return
+        below = above = index
+        paths = []
+        for i in range(self.neighbours):
+            below, below_path = self._next_file(view.indexBelow, below, get_path)
+            above, above_path = self._next_file(view.indexAbove, above, get_path)
+            paths += [path for path in (below_path, above_path) if path]
+        total_size = 0
+        for path in paths:
+            try:
+                total_size += STAT_PROVIDER.stat(path).st_size
+            except OSError as err:
+                logger.debug("Cannot prefetch %r: %s", path, err)
+                continue
+            if total_size > self.max_size:
+                logger.debug("prefetch memory budget exhausted")
+                break
+            request = self.file_analyzer.request_file_metadata(path, self._ignore_result,
+                                                               PRIORITY_PREFETCH)
+            if request:
+                self._requests.append(request)
+        logger.debug("%i files requested for prefetch", len(self._requests))
+
+    @staticmethod
+    def _next_file(step, index, get_path):
+        """Find the next file entry in given direction, return its index and path."""
+        while index.isValid():
+            index = step(index)
+            if not index.isValid():
+                break
+            path = get_path(index)
+            if path:
+                return index, path
+        return index, None
+
+    def _ignore_result(self, file_key, metadata):
+        # the result is cached by the analyzer
+        pass
@@ -0,0 +1,215 @@
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from PySide2.QtCore import QThread, Signal, Slot
+
+from ..library_verifier import LibraryVerifier, logger as verifier_logger
+
+logger = logging.getLogger("gui.scrubber")
+
+# separate from the '--check-db' one, so interactive runs are not affected
+SCRUB_CHECKPOINT_FILENAME = "scrub_checkpoint.json"
+
+# seconds to wait for the database locked by the GUI (e.g. during an import)
+SCRUB_DB_TIMEOUT = 60
+
+# reasons to pause
+PAUSE_AUDITION = "audition"
+PAUSE_IMPORT = "import"
+PAUSE_IMPORT_JOB = "import job"
+
+
+class ScrubberStopped(Exception):
+    pass
+
+
+class ForwardingLogHandler(logging.Handler):
+    """Passes log records to a Qt signal, to be handled in another thread."""
+    def __init__(self, signal):
+        logging.Handler.__init__(self)
+        self.signal = signal
+
+    def emit(self, record):
+        self.signal.emit(record)
+
+
+class Scrubber(QThread):
+    """Verifies the library in the background.
+
+    Runs non-interactive LibraryVerifier passes every `interval` seconds,
+    reading files at most `rate` bytes per second (no limit if 0), in one
+    low-priority thread with its own database connection. Nothing is
+    fixed, problems found are only reported in the log.
+
+    The check waits while paused for any reason (see `set_paused()`). An
+    interrupted pass continues where it stopped next time.
+
+    Messages from the thread, including the ones logged by the verifier,
+    are logged in the GUI thread, through signals."""
+    problem_found = Signal(str)
+    pass_finished = Signal(dict)
+    message = Signal(int, str)
+    log_record = Signal(object)
+
+    def __init__(self, app, rate, start_delay, interval, max_age):
+        QThread.__init__(self)
+        self.app = app
+        self.rate = rate
+        self.start_delay = start_delay
+        self.interval = interval
+        self.max_age = max_age
+        self.checkpoint_path = os.path.join(app.library.base_path,
+                                            SCRUB_CHECKPOINT_FILENAME)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._pause_reasons = set()
+        self._budget_start = None
+        self._budget_bytes = 0
+        self.problem_found.connect(self._report_problem)
+        self.pass_finished.connect(self._report_pass)
+        self.message.connect(self._log_message)
+        self.log_record.connect(self._handle_log_record)
+
+    def set_paused(self, reason, paused):
+        """Pause or un-pause the check for given reason. Thread-safe."""
+        with self._cond:
+            if paused:
+                self._pause_reasons.add(reason)
+            else:
+                self._pause_reasons.discard(reason)
+            self._cond.notify_all()
+
+    def stop(self):
+        """Stop the check and wait for the thread to finish."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self.wait()
+
+    def run(self):
+        # the verifier is not used in the GUI thread meanwhile
+        log_handler = ForwardingLogHandler(self.log_record)
+        verifier_logger.addHandler(log_handler)
+        verifier_logger.propagate = False
+        try:
+            self._run()
+        finally:
+            verifier_logger.removeHandler(log_handler)
+            verifier_logger.propagate = True
+
+    def _run(self):
+        self._lower_priority()
+        db = None
+        try:
+            db = self.app.library.open_connection(timeout=SCRUB_DB_TIMEOUT)
+            self._sleep(self.start_delay)
+            while True:
+                try:
+                    self._run_pass(db)
+                except sqlite3.OperationalError as err:
+                    # most likely 'database is locked', the checkpoint is
+                    # saved, so the next pass continues from here
+                    self._log(logging.WARNING, "Background library check interrupted: %s",
+                              err)
+                    if db.in_transaction:
+                        db.rollback()
+                self._sleep(self.interval)
+        except ScrubberStopped:
+            self._log(logging.DEBUG, "scrubber stopped")
+        except Exception:
+            self._log(logging.ERROR, "Background library check failed\n%s",
+                      traceback.format_exc().rstrip())
+        finally:
+            if db is not None:
+                db.close()
+
+    def _run_pass(self, db):
+        self._log(logging.DEBUG, "starting background library check")
+        self._wait_if_paused()
+        verifier = LibraryVerifier(self.app,
+                                   jobs=1,
+                                   max_age=self.max_age,
+                                   resume=os.path.exists(self.checkpoint_path),
+                                   db=db,
+                                   throttle=self._throttle,
+                                   checkpoint_name=SCRUB_CHECKPOINT_FILENAME)
+        progress_iter = verifier.verify()
+        try:
+            for progress in progress_iter:
+                if progress.error:
+                    self.problem_found.emit(progress.error)
+                if progress.question:
+                    progress.question.answer("No")
+                self._wait_if_paused()
+        finally:
+            # saves the checkpoint when interrupted
+            progress_iter.close()
+        self.pass_finished.emit(verifier.report)
+
+    def _lower_priority(self):
+        if not sys.platform.startswith("linux"):
+            # elsewhere this would apply to the whole process
+            return
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError) as err:
+            self._log(logging.DEBUG, "Cannot lower scrubber thread priority: %s", err)
+
+    def _sleep(self, timeout):
+        with self._cond:
+            if not self._stopping:
+                self._cond.wait_for(lambda: self._stopping, timeout)
+            if self._stopping:
+                raise ScrubberStopped()
+
+    def _wait_if_paused(self):
+        with self._cond:
+            if self._pause_reasons and not self._stopping:
+                self._log(logging.DEBUG, "scrubber paused: %r", self._pause_reasons)
+                self._cond.wait_for(lambda: self._stopping or not self._pause_reasons)
+                # do not catch up after the pause
+                self._budget_start = None
+            if self._stopping:
+                raise ScrubberStopped()
+
+    def _throttle(self, size):
+        self._wait_if_paused()
+        if not self.rate:
+            return
+        now = time.monotonic()
+        if self._budget_start is None:
+            self._budget_start = now
+            self._budget_bytes = 0
+        delay = self._budget_start + self._budget_bytes / self.rate - now
+        self._budget_bytes += size
+        if delay > 0:
+            self._sleep(delay)
+            self._wait_if_paused()
+
+    def _log(self, level, msg, *args):
+        """Log a message from the scrubber thread, via the GUI thread."""
+        self.message.emit(level, msg % args)
+
+    @Slot(int, str)
+    def _log_message(self, level, message):
+        logger.log(level, "%s", message)
+
+    @Slot(object)
+    def _handle_log_record(self, record):
+        # not propagated from the verifier logger while forwarded
+        logging.getLogger().handle(record)
+
+    @Slot(str)
+    def _report_problem(self, message):
+        logger.warning("Background library check: %s", message)
+
+    @Slot(dict)
+    def _report_pass(self, report):
+        logger.info("Background library check finished: %i files verified, %i problems",
+                    report["files_verified"], len(report["errors"]))
@@ -7,14 +7,22 @@ from functools import partial
 from urllib.parse import urlunsplit
 
 from PySide2.QtCore import Slot, Signal, QObject, QItemSelection, Qt, QMimeData, \
-        QByteArray, QModelIndex
+        QByteArray, QModelIndex, QTimer
 from PySide2.QtWidgets import QAbstractItemView, QShortcut
 from PySide2.QtGui import QStandardItemModel, QIcon, QStandardItem, QKeySequence
 
 from .lib_items import MIMETYPES, ItemMimeData
+from .file_analyzer import PRIORITY_BULK
+from ..file_analyzer import STAT_PROVIDER
+from ..metadata import Metadata
+from ..workplace import WorkplaceConflictError
 
 logger = logging.getLogger("gui.workplace")
 
+# analyzed files are imported and added to the view in batches,
+# at most that many milliseconds after the first one in the batch arrived
+IMPORT_BATCH_DELAY = 200
+
 
 class WorkplaceItemMimeData(QMimeData):
     def __init__(self, app, items):
@@ -154,6 +162,13 @@ class WorkplaceItems(QObject):
         self.view = window.workplace_items
         self.items = []
         self.folders = {}
+        self.item_icon = QIcon.fromTheme("audio-x-generic")
+        self.folder_icon = QIcon.fromTheme("folder")
+        self._import_queue = []
+        self._import_timer = QTimer(self)
+        self._import_timer.setSingleShot(True)
+        self._import_timer.setInterval(IMPORT_BATCH_DELAY)
+        self._import_timer.timeout.connect(self._flush_imports)
         self.model = ItemModel(self)
         self.model.setColumnCount(1)
         self.view.setHeaderHidden(False)
@@ -178,46 +193,74 @@ class WorkplaceItems(QObject):
                     if s_item.data().expanded}
         self.model.clear()
         self.item_selected.emit(None)
-        icon = QIcon.fromTheme("audio-x-generic")
-        folder_icon = QIcon.fromTheme("folder")
-        folders = {}
-        self.folders = folders
+        self.folders = {}
         for item in sorted(self.items, key=lambda x: x.path):
-            parent_paths = []
-            path = item.path
-            while "/" in path:
-                parent_folder = path.rsplit("/", 1)[0]
-                logger.debug("%r is in a folder: %r", path, parent_folder)
-                parent = folders.get(parent_folder)
-                if parent:
-                    logger.debug("%r already here: %r", parent_folder, parent)
-                    break
-                else:
-                    parent_paths.append(parent_folder)
-                path = parent_folder
-            else:
-                logger.debug("starting at root")
-                parent = self.model.invisibleRootItem()
-            for folder in reversed(parent_paths):
-                logger.debug("creating %r", folder)
-                name = folder.rsplit("/", 1)[-1]
-                s_item = QStandardItem(folder_icon, name)
-                folder_o = WorkplaceFolder(folder)
-                s_item.setData(folder_o)
-                parent.appendRow([s_item])
-                parent = s_item
-                folders[folder] = s_item
-            s_item = QStandardItem(icon, item.name)
-            s_item.setDragEnabled(True)
-            s_item.setDropEnabled(False)
-            s_item.setData(item)
-            parent.appendRow([s_item])
+            self._add_node(item)
         for path in expanded:
-            s_item = folders.get(path)
+            s_item = self.folders.get(path)
             if not s_item:
                 continue
             self.view.expand(s_item.index())
 
+    @staticmethod
+    def _sort_key(s_item):
+        return s_item.data().path.rsplit("/", 1)[-1]
+
+    def _insert_sorted(self, parent, s_item):
+        """Insert model item among its siblings, keeping them sorted by file name."""
+        key = self._sort_key(s_item)
+        count = parent.rowCount()
+        if not count or self._sort_key(parent.child(count - 1)) <= key:
+            parent.appendRow([s_item])
+            return
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._sort_key(parent.child(middle)) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        parent.insertRow(low, [s_item])
+
+    def _add_node(self, item):
+        """Add model item for a workplace item, creating missing folders."""
+        parent = self.model.invisibleRootItem()
+        folder = None
+        for name in item.path.split("/")[:-1]:
+            folder = name if folder is None else folder + "/" + name
+            s_item = self.folders.get(folder)
+            if s_item is None:
+                logger.debug("creating %r", folder)
+                s_item = QStandardItem(self.folder_icon, name)
+                s_item.setData(WorkplaceFolder(folder))
+                self._insert_sorted(parent, s_item)
+                self.folders[folder] = s_item
+            parent = s_item
+        s_item = QStandardItem(self.item_icon, item.name)
+        s_item.setDragEnabled(True)
+        s_item.setDropEnabled(False)
+        s_item.setData(item)
+        self._insert_sorted(parent, s_item)
+
+    def add_items(self, items):
+        """Add new workplace items to the view, without reloading it."""
+        items = sorted(items, key=lambda x: x.path)
+        self.items += items
+        for item in items:
+            self._add_node(item)
+
+    def _remove_nodes(self, s_items):
+        """Remove model items and the folders left empty."""
+        root = self.model.invisibleRootItem()
+        for s_item in s_items:
+            # parent() is None for top-level items
+            parent = s_item.parent()
+            (parent or root).removeRow(s_item.row())
+            while parent is not None and not parent.rowCount():
+                del self.folders[parent.data().path]
+                s_item, parent = parent, parent.parent()
+                (parent or root).removeRow(s_item.row())
+
     @Slot()
     def folder_expanded(self, index):
         s_item = self.model.itemFromIndex(index)
@@ -265,10 +308,18 @@ class WorkplaceItems(QObject):
         if not indexes:
             logger.warning("Nothing to delete")
             return
+        to_remove = []
         for index in indexes:
-            item = self.model.itemFromIndex(index)
-            self.workplace.delete_item(item.data())
-        self.get_items()
+            s_item = self.model.itemFromIndex(index)
+            item = s_item.data()
+            if not isinstance(item, Metadata):
+                logger.debug("not deleting a folder")
+                continue
+            to_remove.append((s_item, item))
+        self.workplace.delete_items([item for s_item, item in to_remove])
+        removed = set(id(item) for s_item, item in to_remove)
+        self.items = [item for item in self.items if id(item) not in removed]
+        self._remove_nodes([s_item for s_item, item in to_remove])
 
     def import_urls(self, urls, folder=""):
         for url in urls:
@@ -280,23 +331,50 @@ class WorkplaceItems(QObject):
                 continue
             path = url.path()
             if os.path.isdir(path):
-                self._import_dir(path, folder=folder)
+                self._import_dir(path, parent_folder=folder)
                 continue
             elif not os.path.isfile(path):
                 logger.warning("Ignoring %r not a regular file", url.toString())
                 continue
             callback = partial(self._import_file, folder=folder)
-            self.file_analyzer.request_file_metadata(path, callback)
+            self.file_analyzer.request_file_metadata(path, callback, PRIORITY_BULK)
 
     def _import_file(self, file_key, metadata, folder=""):
         logger.debug("Got metadata for import: %r", metadata)
-        self.workplace.import_file(metadata, folder=folder)
-        self.get_items()
+        if metadata is None:
+            logger.warning("Cannot import %r", str(file_key))
+            return
+        self._import_queue.append((metadata, folder))
+        if not self._import_timer.isActive():
+            self._import_timer.start()
+
+    @Slot()
+    def _flush_imports(self):
+        queue, self._import_queue = self._import_queue, []
+        by_folder = {}
+        for metadata, folder in queue:
+            by_folder.setdefault(folder, []).append(metadata)
+        for folder, items in by_folder.items():
+            self.add_items(self._check_imported(self.workplace.import_files(items,
+                                                                            folder=folder)))
+
+    @staticmethod
+    def _check_imported(results):
+        """Log import errors, return the items imported."""
+        imported = []
+        for result in results:
+            if isinstance(result, WorkplaceConflictError):
+                logger.warning("%r already in the workplace", result.path)
+            elif isinstance(result, OSError):
+                logger.error("Cannot copy file to the workplace: %s", result)
+            else:
+                imported.append(result)
+        return imported
 
     def _import_dir(self, path, parent_folder=""):
         logger.debug("Importing dir: %r", path)
         parent_path = os.path.dirname(path)
-        for dirpath, dirnames, filenames in os.walk(path):
+        for dirpath, filenames in STAT_PROVIDER.walk(path):
             folder = os.path.relpath(dirpath, parent_path)
             if os.sep != "/":
                 folder.replace(os.sep, "/")
@@ -306,9 +384,8 @@ class WorkplaceItems(QObject):
             for filename in filenames:
                 full_path = os.path.join(dirpath, filename)
                 importer = partial(self._import_file, folder=folder)
-                self.file_analyzer.request_file_metadata(full_path, importer)
+                self.file_analyzer.request_file_metadata(full_path, importer, PRIORITY_BULK)
 
     def import_lib_items(self, items, folder=""):
-        for metadata in items:
-            self.workplace.import_item(metadata, folder=folder)
-        self.get_items()
+        self.add_items(self._check_imported(self.workplace.import_items(items,
+                                                                        folder=folder)))
@@ -0,0 +1,143 @@
+
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger("import_journal")
+
+IMPORT_JOURNAL_FILENAME = "import_journal.jsonl"
+WATCH_JOURNAL_FILENAME = "watch_journal.jsonl"
+JOURNAL_RE = re.compile(r"\w+_journal\.jsonl(\.tmp)?$")
+
+# states of a source file
+ANALYZED = "analyzed"
+COPIED = "copied"
+COMMITTED = "committed"
+
+
+class JournalEntry:
+    """What is known about a source file from an earlier import run."""
+
+    def __init__(self, path, size, mtime_ns, state, metadata=None):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.state = state
+        self.metadata = metadata
+
+    @property
+    def signature(self):
+        return (self.size, self.mtime_ns)
+
+
+def file_signature(path):
+    """Return the stat signature of a file, to detect changes."""
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class ImportJournal:
+    """Record of the import progress, so an interrupted import can resume.
+
+    Each source file goes through the ANALYZED (analysis results known),
+    COPIED (file in the library storage) and COMMITTED (item in the
+    database, or was already there) states. Every state change is
+    appended as a JSON line together with the file stat signature; the
+    analysis results are stored with the ANALYZED state only.
+
+    Lines are flushed, but not synced, as soon as they are written. A lost
+    or truncated line only means some work is done again: importing a file
+    which is already in the library is detected as a conflict."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._stream = None
+
+    def load(self):
+        """Read the journal left by an interrupted import, if any."""
+        self.entries = {}
+        try:
+            stream = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with stream:
+            for line_no, line in enumerate(stream, 1):
+                try:
+                    record = json.loads(line)
+                    path = record["path"]
+                    entry = JournalEntry(path, record["size"], record["mtime_ns"],
+                                         record["state"], record.get("metadata"))
+                except (ValueError, KeyError, TypeError) as err:
+                    # probably the last line, cut short
+                    logger.debug("%s:%i: invalid journal record: %s", self.path, line_no, err)
+                    continue
+                old_entry = self.entries.get(path)
+                if (entry.metadata is None and old_entry is not None
+                        and old_entry.signature == entry.signature):
+                    entry.metadata = old_entry.metadata
+                self.entries[path] = entry
+        logger.debug("%i entries loaded from the import journal", len(self.entries))
+
+    def get(self, path, signature):
+        """Return journal entry for an unchanged file, or None."""
+        entry = self.entries.get(path)
+        if entry is None or entry.signature != tuple(signature):
+            return None
+        return entry
+
+    def record(self, path, signature, state, metadata=None):
+        """Record new state of a source file.
+
+        `metadata` (a dict) is required for the ANALYZED state."""
+        if self._stream is None:
+            self._open()
+        size, mtime_ns = signature
+        old_entry = self.entries.get(path)
+        record = {"path": path, "size": size, "mtime_ns": mtime_ns, "state": state}
+        if metadata is not None:
+            record["metadata"] = metadata
+        elif old_entry is not None and old_entry.signature == tuple(signature):
+            metadata = old_entry.metadata
+        self._stream.write(json.dumps(record) + "\n")
+        self._stream.flush()
+        self.entries[path] = JournalEntry(path, size, mtime_ns, state, metadata)
+
+    def _open(self):
+        self._stream = open(self.path, "a", encoding="utf-8")
+        with open(self.path, "rb") as stream:
+            if stream.seek(0, os.SEEK_END):
+                stream.seek(-1, os.SEEK_END)
+                if stream.read(1) != b"\n":
+                    # do not append to a line cut short
+                    self._stream.write("\n")
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def compact(self):
+        """Rewrite the journal with only the current state of each file."""
+        self.close()
+        if not os.path.exists(self.path):
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as stream:
+            for entry in self.entries.values():
+                record = {"path": entry.path, "size": entry.size,
+                          "mtime_ns": entry.mtime_ns, "state": entry.state}
+                if entry.metadata is not None:
+                    record["metadata"] = entry.metadata
+                stream.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Remove the journal after the import has completed."""
+        self.close()
+        self.entries = {}
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,16 +1,21 @@
 
 from . import __path__ as PKG_PATH
+import itertools
 import os
 import logging
 import shutil
 import sqlite3
-import threading
 
+from concurrent.futures import ThreadPoolExecutor
+
+from .cleanup_scheduler import CleanupScheduler
+from .file_copy import copy_file, DEFAULT_COPY_METHODS
 from .metadata import FIXED_METADATA, FIXED_METADATA_D, FIXED_METADATA_KEYS, Metadata
 
 logger = logging.getLogger("library")
 
 SCHEMA_FILENAME = os.path.join(PKG_PATH[0], "schema.sql")
+UPGRADE_FILENAME = os.path.join(PKG_PATH[0], "schema_upgrade_{}.sql")
 
 
 class LibraryError(Exception):
@@ -28,13 +33,51 @@ class LibraryConflictError(LibraryError):
         return self.args[2]
 
 
-DATABASE_VERSION = "0"
+DATABASE_VERSION = "1"
+
+# files copied in parallel by import_files()
+IMPORT_COPY_THREADS = 4
+
+# files passed to a single import_files() call by bulk imports
+IMPORT_BATCH_SIZE = 100
+
+# maximum number of parameters in a single SQL statement
+SQL_PARAMS_LIMIT = 500
+
+# database versions that can be upgraded with schema_upgrade_<version>.sql
+# to the next one
+UPGRADABLE_VERSIONS = ["0"]
+
+
+def format_import_stats(stats):
+    """Describe import statistics collected in a Counter.
+
+    Counted keys: 'imported', 'skipped', 'failed' and 'copy:<method>'
+    for each copy method used."""
+    methods = ["{}: {}".format(key[5:], count)
+               for key, count in sorted(stats.items())
+               if key.startswith("copy:")]
+    if methods:
+        methods = " ({})".format(", ".join(methods))
+    else:
+        methods = ""
+    return ("{} files imported{}, {} already in the library, {} failed"
+            .format(stats["imported"], methods, stats["skipped"], stats["failed"]))
+
+
+# makes temporary file names unique
+_import_counter = itertools.count()
 
 
 class Library:
-    def __init__(self, appdirs, base_path=None):
+    def __init__(self, appdirs, base_path=None, copy_methods=None):
         self.db = None
         self.tmp_dir = None
+        self._tmp_subdirs = set()
+        self.cleanup_scheduler = None
+        if copy_methods is None:
+            copy_methods = DEFAULT_COPY_METHODS
+        self.copy_methods = list(copy_methods)
         if base_path is None:
             base_path = os.path.join(appdirs.user_data_dir, "library")
         self.base_path = base_path
@@ -61,8 +104,13 @@ class Library:
                                     "tmp.{}".format(os.getpid()))
         logger.debug("Creating temporary dir %r", self.tmp_dir)
         os.makedirs(self.tmp_dir, exist_ok=True)
+        self._tmp_subdirs = {self.tmp_dir}
+        self.cleanup_scheduler = CleanupScheduler()
 
     def remove_tmp_dir(self):
+        if self.cleanup_scheduler:
+            self.cleanup_scheduler.stop()
+            self.cleanup_scheduler = None
         if self.tmp_dir and os.path.exists(self.tmp_dir):
             logger.debug("Removing temporary dir %r", self.tmp_dir)
             try:
@@ -111,15 +159,50 @@ class Library:
             raise LibraryError("Cannot open database {!r}: {}".format(db_path, err))
         if not row:
             raise LibraryError("Invalid database: not db_meta data")
-        version = row[0]
-        if str(version) != str(DATABASE_VERSION):
+        version = str(row[0])
+        if version in UPGRADABLE_VERSIONS:
+            self.upgrade_database(db, db_path, version)
+        elif version != str(DATABASE_VERSION):
             raise LibraryError("Unsupported database version: {!r} ({!r} expected)"
                                .format(version, DATABASE_VERSION))
         self.db = db
 
+    def open_connection(self, timeout=5.0):
+        """Open another connection to the library database.
+
+        sqlite3 connections cannot be shared between threads, so code
+        running in a different thread needs its own one. `timeout` is how
+        many seconds to wait for a lock held by another connection."""
+        db_path = os.path.join(self.base_path, "database.db")
+        try:
+            db = sqlite3.connect(db_path, timeout=timeout)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA foreign_keys = 1")
+        except sqlite3.Error as err:
+            raise LibraryError("Cannot open database {!r}: {}".format(db_path, err))
+        return db
+
+    def upgrade_database(self, db, db_path, version):
+        index = UPGRADABLE_VERSIONS.index(version)
+        for old_version in UPGRADABLE_VERSIONS[index:]:
+            logging.info("Upgrading database %r from version %r", db_path, old_version)
+            script = open(UPGRADE_FILENAME.format(old_version)).read()
+            try:
+                # executescript() commits first, so use explicit transaction
+                db.executescript("BEGIN;\n" + script + "\nCOMMIT;")
+            except sqlite3.Error as err:
+                db.rollback()
+                raise LibraryError("Cannot upgrade database {!r}: {}".format(db_path, err))
+
     def get_item_path(self, metadata):
         if metadata.path:
             return metadata.path
+        return self.get_storage_path(metadata)
+
+    def get_storage_path(self, metadata):
+        """Return path of the item file in the library storage.
+
+        Ignores the item path, so can be used for workplace items too."""
         md5 = metadata.md5
         ext = metadata.format
         if ext:
@@ -129,47 +212,75 @@ class Library:
         return os.path.join(self.base_path, md5[0], md5[1:3], md5 + ext)
 
     def get_pretty_path(self, metadata, timeout=10.0):
-        if metadata.path:
-            return metadata.path
-        md5 = metadata.md5
-        ext = metadata.format
-        if ext:
-            ext = "." + ext.lower()
-        else:
-            ext = ".bin"
-        orig_path = os.path.join(self.base_path, md5[0], md5[1:3], md5 + ext)
-        filename = metadata.name.replace("/", "_") + ext
-        new_path = os.path.join(self.tmp_dir, filename)
+        return self.get_pretty_paths([metadata], timeout)[0]
 
-        # metadata.name does not have to be unique
-        i = 0
-        while os.path.exists(new_path):
-            i += 1
-            new_path = os.path.join(self.tmp_dir, str(i), filename)
+    def get_pretty_paths(self, items, timeout=10.0):
+        """Make files named after the items available for a while.
 
-        os.makedirs(os.path.dirname(new_path), exist_ok=True)
-        try:
-            logger.debug("hard-linking %r to %r", orig_path, new_path)
-            os.link(orig_path, new_path)
-        except OSError as err:
-            logger.debug("hard-link failed (%s), trying to copy instead", err)
-            shutil.copy(orig_path, new_path)
+        Library files are hard-linked (or copied, if that fails) to the
+        temporary directory under the item names and removed after
+        `timeout` seconds by the cleanup scheduler.
+
+        Returns list of paths, one for each item."""
+        result = []
+        to_cleanup = []
+        for metadata in items:
+            if metadata.path:
+                result.append(metadata.path)
+                continue
+            ext = metadata.format
+            if ext:
+                ext = "." + ext.lower()
+            else:
+                ext = ".bin"
+            orig_path = self.get_item_path(metadata)
+            filename = metadata.name.replace("/", "_") + ext
+            new_path = self._make_pretty_link(orig_path, filename)
+            result.append(new_path)
+            to_cleanup.append(new_path)
+        if to_cleanup:
+            self.cleanup_scheduler.schedule_many(to_cleanup, timeout)
+        return result
 
-        def cleanup():
-            if not os.path.exists(new_path):
-                return
-            logger.debug("unlinking %r", new_path)
+    def _make_pretty_link(self, orig_path, filename):
+        # metadata.name does not have to be unique
+        i = 0
+        while True:
+            if i:
+                directory = os.path.join(self.tmp_dir, str(i))
+            else:
+                directory = self.tmp_dir
+            if directory not in self._tmp_subdirs:
+                os.makedirs(directory, exist_ok=True)
+                self._tmp_subdirs.add(directory)
+            new_path = os.path.join(directory, filename)
             try:
-                os.unlink(new_path)
+                logger.debug("hard-linking %r to %r", orig_path, new_path)
+                os.link(orig_path, new_path)
+                return new_path
+            except FileExistsError:
+                i += 1
+                continue
             except OSError as err:
-                logger.debug("%r: %s", err)
+                if os.path.exists(new_path):
+                    i += 1
+                    continue
+                logger.debug("hard-link failed (%s), trying to copy instead", err)
+                copy_file(orig_path, new_path, ["reflink", "copy"])
+                return new_path
+
+    def copy_file(self, source, target):
+        """Copy a file using the configured copy methods.
 
-        t = threading.Timer(timeout, cleanup)
-        t.daemon = True
-        t.start()
-        return new_path
+        Returns name of the method used."""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return copy_file(source, target, self.copy_methods)
 
     def import_file(self, metadata, copy=True):
+        """Add a file to the library.
+
+        Returns name of the method used to copy the file, or None if
+        the file has not been copied."""
         md5 = metadata.md5
         path = metadata.path
         if not md5 or not path:
@@ -180,30 +291,197 @@ class Library:
             row = cur.fetchone()
             if row is not None:
                 raise LibraryConflictError("Already there", md5, row[1])
-            metadata = metadata.copy()
+            metadata = self._prepare_import(metadata, copy)
+            item_id = self._insert_item(cur, metadata)
+            if not copy:
+                self._record_external_file(cur, item_id, path)
             if copy:
-                metadata.path = None
-            metadata.source = "file:{}".format(path)
-            query = "INSERT INTO items({}) VALUES ({})".format(
-                    ", ".join(mdtype.name for mdtype in FIXED_METADATA),
-                    ", ".join(["?"] * len(FIXED_METADATA)))
-            values = [getattr(metadata, mdtype.name) for mdtype in FIXED_METADATA]
-            logging.debug("running: %r with %r", query, values)
-            cur.execute(query, values)
-            item_id = cur.lastrowid
-            logging.debug("item inserted with id: %r", item_id)
-            tags = metadata.get_tags()
-
-            # add missing parent tags
-            # as  /a/b/c implies /a/b and /a
-            for tag in list(tags):
-                if tag.startswith("/"):
-                    parent = tag.rsplit("/", 1)[0]
-                    while parent:
-                        tags.add(parent)
-                        parent = parent.rsplit("/", 1)[0]
-
-            for tag in tags:
+                target_path = self.get_item_path(metadata)
+                return self.copy_file(path, target_path)
+        return None
+
+    def import_files(self, items, copy=True, db=None, jobs=IMPORT_COPY_THREADS,
+                     copied=(), on_copied=None):
+        """Add many files to the library in a single transaction.
+
+        Files are copied first, by `jobs` threads, and only the items
+        copied successfully are added to the database. `db` is the
+        database connection to use, if not the default one.
+
+        Files are copied to temporary names and moved into the storage only
+        after the items are committed, so files of items added by someone
+        else in the meantime are not overwritten.
+
+        `copied` are indices of items already copied to the library storage
+        (e.g. by an interrupted import), `on_copied` is called with an item
+        index and the copy method used after each file is copied.
+
+        Returns a list with a result for each item: name of the copy method
+        used (None if not copied) or the exception which prevented the
+        import (LibraryConflictError or OSError)."""
+        if db is None:
+            db = self.db
+        results = [None] * len(items)
+        for metadata in items:
+            if not metadata.md5 or not metadata.path:
+                raise ValueError("md5 and path are required for file import")
+        existing = self.find_md5s([metadata.md5 for metadata in items], db)
+        to_import = []
+        for i, metadata in enumerate(items):
+            md5 = metadata.md5
+            if md5 in existing:
+                results[i] = LibraryConflictError("Already there", md5, existing[md5])
+            else:
+                # the same file twice in the batch
+                existing[md5] = metadata.name
+                to_import.append((i, self._prepare_import(metadata, copy)))
+        # item index -> temporary path of the copied file
+        tmp_paths = {}
+        if copy:
+            copied_items = []
+
+            copied = set(copied)
+
+            def copy_item(i, metadata):
+                if i in copied and os.path.exists(self.get_item_path(metadata)):
+                    return None
+                tmp_paths[i] = self._import_tmp_path(metadata)
+                return self.copy_file(items[i].path, tmp_paths[i])
+
+            with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+                futures = [executor.submit(copy_item, i, metadata)
+                           for i, metadata in to_import]
+                for (i, metadata), future in zip(to_import, futures):
+                    try:
+                        results[i] = future.result()
+                    except OSError as err:
+                        results[i] = err
+                        if i in tmp_paths:
+                            self._remove_stray_file(tmp_paths.pop(i))
+                    else:
+                        copied_items.append((i, metadata))
+                        if on_copied is not None:
+                            on_copied(i, results[i])
+            to_import = copied_items
+        try:
+            with db:
+                cur = db.cursor()
+                # another import could have added some in the meantime
+                existing = self.find_md5s([metadata.md5 for i, metadata in to_import], db)
+                tag_ids = {}
+                key_ids = {}
+                for i, metadata in to_import:
+                    if metadata.md5 in existing:
+                        results[i] = LibraryConflictError("Already there", metadata.md5,
+                                                          existing[metadata.md5])
+                        continue
+                    item_id = self._insert_item(cur, metadata, tag_ids, key_ids)
+                    if not copy:
+                        self._record_external_file(cur, item_id, metadata.path)
+        except BaseException:
+            for tmp_path in tmp_paths.values():
+                self._remove_stray_file(tmp_path)
+            raise
+        for i, metadata in to_import:
+            tmp_path = tmp_paths.get(i)
+            if tmp_path is None:
+                continue
+            if isinstance(results[i], LibraryConflictError):
+                self._remove_stray_file(tmp_path)
+                continue
+            target = self.get_item_path(metadata)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(tmp_path, target)
+            except OSError as err:
+                logger.error("Cannot move %r to %r: %s", tmp_path, target, err)
+                self._remove_stray_file(tmp_path)
+                results[i] = err
+        return results
+
+    def _import_tmp_path(self, metadata):
+        """Return a unique temporary path for an item file being imported."""
+        filename = "import-{}-{}".format(next(_import_counter), metadata.md5)
+        return os.path.join(self.tmp_dir, filename)
+
+    def find_md5s(self, md5s, db=None):
+        """Return md5 → name mapping of library items with given md5 sums."""
+        if db is None:
+            db = self.db
+        result = {}
+        md5s = list(set(md5s))
+        cur = db.cursor()
+        for start in range(0, len(md5s), SQL_PARAMS_LIMIT):
+            chunk = md5s[start:start + SQL_PARAMS_LIMIT]
+            cur.execute("SELECT md5, name FROM items WHERE md5 IN ({})"
+                        .format(", ".join(["?"] * len(chunk))),
+                        chunk)
+            result.update(cur.fetchall())
+        return result
+
+    @staticmethod
+    def _remove_stray_file(path):
+        try:
+            os.unlink(path)
+        except OSError as err:
+            logger.debug("Cannot remove %r: %s", path, err)
+
+    @staticmethod
+    def _prepare_import(metadata, copy):
+        """Return copy of the metadata as it should be stored in the library."""
+        path = metadata.path
+        metadata = metadata.copy()
+        if copy:
+            metadata.path = None
+        metadata.source = "file:{}".format(path)
+        return metadata
+
+    @staticmethod
+    def _record_external_file(cur, item_id, path):
+        """Remember size and mtime of a file left outside the library storage.
+
+        So the external files rescan can tell which files changed since."""
+        try:
+            stat = os.stat(path)
+        except OSError as err:
+            logger.warning("Cannot stat %r: %s", path, err)
+            return
+        cur.execute("INSERT OR REPLACE INTO item_files(item_id, size, mtime_ns)"
+                    " VALUES (?, ?, ?)",
+                    (item_id, stat.st_size, stat.st_mtime_ns))
+
+    def _insert_item(self, cur, metadata, tag_ids=None, key_ids=None, workplace_id=None):
+        """Insert item into the database, return its id.
+
+        `tag_ids` and `key_ids` may be dictionaries caching tag and custom
+        key ids for the current transaction. Items of a workplace (with
+        `workplace_id`) are not added to the full text search index."""
+        if tag_ids is None:
+            tag_ids = {}
+        if key_ids is None:
+            key_ids = {}
+        query = "INSERT INTO items(workplace_id, {}) VALUES ({})".format(
+                ", ".join(mdtype.name for mdtype in FIXED_METADATA),
+                ", ".join(["?"] * (len(FIXED_METADATA) + 1)))
+        values = [workplace_id] + [getattr(metadata, mdtype.name) for mdtype in FIXED_METADATA]
+        logging.debug("running: %r with %r", query, values)
+        cur.execute(query, values)
+        item_id = cur.lastrowid
+        logging.debug("item inserted with id: %r", item_id)
+        tags = metadata.get_tags()
+
+        # add missing parent tags
+        # as  /a/b/c implies /a/b and /a
+        for tag in list(tags):
+            if tag.startswith("/"):
+                parent = tag.rsplit("/", 1)[0]
+                while parent:
+                    tags.add(parent)
+                    parent = parent.rsplit("/", 1)[0]
+
+        for tag in tags:
+            tag_id = tag_ids.get(tag)
+            if tag_id is None:
                 cur.execute("SELECT id FROM tags WHERE name=?", (tag,))
                 row = cur.fetchone()
                 if row:
@@ -211,13 +489,16 @@ class Library:
                 else:
                     cur.execute("INSERT INTO tags(name) VALUES(?)", (tag,))
                     tag_id = cur.lastrowid
-                cur.execute("INSERT INTO item_tags(item_id, tag_id) VALUES(?, ?)",
-                            (item_id, tag_id))
+                tag_ids[tag] = tag_id
+            cur.execute("INSERT INTO item_tags(item_id, tag_id) VALUES(?, ?)",
+                        (item_id, tag_id))
 
-            for key in metadata:
-                if key.startswith("_"):
-                    continue
-                value = metadata[key]
+        for key in metadata:
+            if key.startswith("_"):
+                continue
+            value = metadata[key]
+            key_id = key_ids.get(key)
+            if key_id is None:
                 cur.execute("SELECT id FROM custom_keys WHERE name=?", (key,))
                 row = cur.fetchone()
                 if row:
@@ -225,31 +506,37 @@ class Library:
                 else:
                     cur.execute("INSERT INTO custom_keys(name) VALUES(?)", (key,))
                     key_id = cur.lastrowid
-                cur.execute("INSERT INTO item_custom_values(item_id, key_id, value)"
-                            " VALUES(?, ?, ?)",
-                            (item_id, key_id, value))
-
-            fts_content = []
-            for key in metadata:
-                mdtype = FIXED_METADATA_KEYS.get(key)
-                if mdtype and not mdtype.indexable:
-                    continue
-                value = metadata.get(key)
-                if not value:
-                    continue
-                if isinstance(value, float):
-                    fts_content.append("{:.2f} ~~~".format(value))
-                else:
-                    fts_content.append("{} ~~~".format(value))
-            fts_content = " ".join(fts_content)
-            query = "INSERT INTO fts (rowid, content) VALUES (?,?)"
-            values = (item_id, fts_content)
-            logging.debug("running: %r with %r", query, values)
-            cur.execute(query, values)
-            if copy:
-                target_path = self.get_item_path(metadata)
-                os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                shutil.copy(path, target_path)
+                key_ids[key] = key_id
+            cur.execute("INSERT INTO item_custom_values(item_id, key_id, value)"
+                        " VALUES(?, ?, ?)",
+                        (item_id, key_id, value))
+
+        if workplace_id is not None:
+            return item_id
+
+        fts_content = self.get_fts_content(metadata)
+        query = "INSERT INTO fts (rowid, content) VALUES (?,?)"
+        values = (item_id, fts_content)
+        logging.debug("running: %r with %r", query, values)
+        cur.execute(query, values)
+        return item_id
+
+    @staticmethod
+    def get_fts_content(metadata):
+        """Build the full text search index content for an item."""
+        fts_content = []
+        for key in metadata:
+            mdtype = FIXED_METADATA_KEYS.get(key)
+            if mdtype and not mdtype.indexable:
+                continue
+            value = metadata.get(key)
+            if not value:
+                continue
+            if isinstance(value, float):
+                fts_content.append("{:.2f} ~~~".format(value))
+            else:
+                fts_content.append("{} ~~~".format(value))
+        return " ".join(fts_content)
 
     def get_tags(self):
         with self.db:
@@ -259,20 +546,25 @@ class Library:
                 yield tuple(row)
 
     def get_items(self, query, **kwargs):
+        return list(self.iter_items(query, **kwargs))
+
+    def iter_items(self, query, **kwargs):
+        """Yield items matching the query one by one.
+
+        Rows are fetched from the cursor as they are consumed, so this can be
+        used to go through arbitrarily large result sets."""
         if isinstance(query, tuple):
             query, params = query
-        if isinstance(query, str):
+        elif isinstance(query, str):
             params = ()
         else:
             query, params = query.as_sql(**kwargs)
-        result = []
         with self.db:
             cur = self.db.cursor()
             logging.debug("running: %r with %r", query, params)
             cur.execute(query, params)
-            for row in cur.fetchall():
-                result.append(self._metadata_from_row(row))
-        return result
+            for row in cur:
+                yield self._metadata_from_row(row)
 
     def get_completions(self, query, **kwargs):
         columns = ["offsets(compl_fts.fts)", "compl_fts.content"]
@@ -337,4 +629,4 @@ class Library:
         for key, value in cur.fetchall():
             data[key] = value
 
-        return Metadata(data, tags)
+        return Metadata.trusted(data, tags)
@@ -0,0 +1,292 @@
+
+import gzip
+import json
+import logging
+import sys
+
+from .library import LibraryError, DATABASE_VERSION
+from .metadata import FIXED_METADATA, Metadata
+
+DUMP_FORMAT = "sampledrawer-dump"
+DUMP_VERSION = 1
+
+DEFAULT_BATCH_SIZE = 1000
+
+logger = logging.getLogger("library_dump")
+
+
+class LibraryDumpError(LibraryError):
+    pass
+
+
+def open_dump_file(path, mode):
+    """Open dump file for reading ('r') or writing ('w').
+
+    '-' means standard input or output, '.gz' files are compressed."""
+    if path == "-":
+        if mode == "r":
+            return sys.stdin
+        else:
+            return sys.stdout
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class LibraryDumper:
+    """Logical export and import of the library database as JSON Lines.
+
+    The dump starts with a header record, followed by 'tag', 'workplace'
+    and 'item' records. Item records carry the fixed metadata fields,
+    all assigned tag names and custom metadata values, so the dump does not
+    depend on the database schema or row ids.
+
+    Sample files are not included – the library storage can be copied
+    separately (file names depend on the content only)."""
+
+    def __init__(self, library):
+        self.library = library
+
+    def dump(self, stream):
+        """Write the whole library database to a text stream.
+
+        Items, their tags and their custom values are read by three parallel
+        cursors ordered by item id and merged, so memory use does not depend
+        on the library size."""
+        db = self.library.db
+        count = 0
+        db.execute("BEGIN")
+        try:
+            self._write(stream, {"type": "header",
+                                 "format": DUMP_FORMAT,
+                                 "version": DUMP_VERSION,
+                                 "db_version": DATABASE_VERSION})
+            for (name,) in db.execute("SELECT name FROM tags WHERE id != 0 ORDER BY id"):
+                self._write(stream, {"type": "tag", "name": name})
+            for (name,) in db.execute("SELECT name FROM workplaces ORDER BY id"):
+                self._write(stream, {"type": "workplace", "name": name})
+
+            columns = ", ".join("item." + mdtype.name for mdtype in FIXED_METADATA)
+            items_cur = db.execute("SELECT item.id, wp.name, {}"
+                                   " FROM items item"
+                                   " LEFT JOIN workplaces wp ON (wp.id = item.workplace_id)"
+                                   " ORDER BY item.id".format(columns))
+            tags_cur = db.execute("SELECT it.item_id, tags.name"
+                                  " FROM item_tags it JOIN tags ON (tags.id = it.tag_id)"
+                                  " ORDER BY it.item_id")
+            values_cur = db.execute("SELECT icv.item_id, ck.name, icv.value"
+                                    " FROM item_custom_values icv"
+                                    " JOIN custom_keys ck ON (ck.id = icv.key_id)"
+                                    " ORDER BY icv.item_id")
+            tag_rows = _PeekableCursor(tags_cur)
+            value_rows = _PeekableCursor(values_cur)
+            for row in items_cur:
+                item_id, workplace = row[0], row[1]
+                record = {"type": "item", "workplace": workplace}
+                for mdtype, value in zip(FIXED_METADATA, row[2:]):
+                    if value is not None:
+                        record[mdtype.name] = value
+                record["tags"] = sorted(name for _, name in tag_rows.take(item_id))
+                record["custom"] = {key: value for _, key, value
+                                    in value_rows.take(item_id)}
+                self._write(stream, record)
+                count += 1
+        finally:
+            db.commit()
+        stream.flush()
+        logger.info("%i items dumped", count)
+        return count
+
+    @staticmethod
+    def _write(stream, record):
+        stream.write(json.dumps(record, ensure_ascii=False))
+        stream.write("\n")
+
+    def restore(self, stream, batch_size=DEFAULT_BATCH_SIZE):
+        """Load a dump into the library.
+
+        Items are inserted in batches, one transaction per batch. Items
+        already present in the library (same md5, or same path in the same
+        workplace) are skipped.
+
+        Returns a dictionary with the numbers of restored and skipped items."""
+        stats = {"restored": 0, "skipped": 0}
+        restorer = _Restorer(self.library)
+        lines = iter(enumerate(stream, 1))
+        try:
+            line_no, line = next(lines)
+        except StopIteration:
+            raise LibraryDumpError("Empty dump")
+        header = self._parse(line_no, line)
+        if header.get("type") != "header" or header.get("format") != DUMP_FORMAT:
+            raise LibraryDumpError("Not a Sample Drawer library dump")
+        if header.get("version") != DUMP_VERSION:
+            raise LibraryDumpError("Unsupported dump version: {!r} ({!r} expected)"
+                                   .format(header.get("version"), DUMP_VERSION))
+        batch = []
+        for line_no, line in lines:
+            if not line.strip():
+                continue
+            record = self._parse(line_no, line)
+            record_type = record.get("type")
+            if record_type == "item":
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    restorer.restore_items(batch, stats)
+                    batch = []
+            elif record_type == "tag":
+                restorer.tags.get_id(record["name"])
+            elif record_type == "workplace":
+                restorer.get_workplace_id(record["name"])
+            else:
+                logger.warning("line %i: unknown record type %r, ignoring",
+                               line_no, record_type)
+        if batch:
+            restorer.restore_items(batch, stats)
+        restorer.finish()
+        logger.info("%i items restored, %i skipped", stats["restored"], stats["skipped"])
+        return stats
+
+    @staticmethod
+    def _parse(line_no, line):
+        try:
+            record = json.loads(line)
+        except ValueError as err:
+            raise LibraryDumpError("line {}: invalid JSON: {}".format(line_no, err))
+        if not isinstance(record, dict):
+            raise LibraryDumpError("line {}: not a JSON object".format(line_no))
+        return record
+
+
+class _PeekableCursor:
+    """Iterates over (item_id, ...) rows ordered by item_id."""
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._next = cursor.fetchone()
+
+    def take(self, item_id):
+        """Yield rows for given item_id, skipping rows of earlier items."""
+        while self._next is not None and self._next[0] < item_id:
+            self._next = self._cursor.fetchone()
+        while self._next is not None and self._next[0] == item_id:
+            yield self._next
+            self._next = self._cursor.fetchone()
+
+
+class _NameIdCache:
+    """Name to id mapping for the 'tags' and 'custom_keys' tables."""
+    def __init__(self, db, table):
+        self._db = db
+        self._table = table
+        self._ids = {}
+
+    def get_id(self, name):
+        key = name.lower()
+        try:
+            return self._ids[key]
+        except KeyError:
+            pass
+        cur = self._db.execute("SELECT id FROM {} WHERE name=?".format(self._table),
+                               (name,))
+        row = cur.fetchone()
+        if row:
+            row_id = row[0]
+        else:
+            cur.execute("INSERT INTO {}(name) VALUES(?)".format(self._table), (name,))
+            row_id = cur.lastrowid
+        self._ids[key] = row_id
+        return row_id
+
+
+class _Restorer:
+    def __init__(self, library):
+        self.library = library
+        self.db = library.db
+        self.tags = _NameIdCache(self.db, "tags")
+        self.keys = _NameIdCache(self.db, "custom_keys")
+        self.workplaces = {}
+        # only needed when restoring into a non-empty library
+        self.existing_md5s = None
+        self.existing_paths = None
+        cur = self.db.execute("SELECT 1 FROM items LIMIT 1")
+        if cur.fetchone():
+            logger.info("Library not empty, existing items will be skipped")
+            cur.execute("SELECT md5 FROM items WHERE workplace_id IS NULL")
+            self.existing_md5s = {row[0] for row in cur}
+            cur.execute("SELECT workplace_id, path FROM items WHERE workplace_id IS NOT NULL")
+            self.existing_paths = {tuple(row) for row in cur}
+
+    def get_workplace_id(self, name):
+        try:
+            return self.workplaces[name]
+        except KeyError:
+            pass
+        cur = self.db.execute("SELECT id FROM workplaces WHERE name=?", (name,))
+        row = cur.fetchone()
+        if row:
+            workplace_id = row[0]
+        else:
+            cur.execute("INSERT INTO workplaces(name) VALUES (?)", (name,))
+            workplace_id = cur.lastrowid
+        self.workplaces[name] = workplace_id
+        return workplace_id
+
+    def _is_duplicate(self, workplace_id, record):
+        if self.existing_md5s is None:
+            return False
+        if workplace_id is None:
+            md5 = record.get("md5")
+            if md5 in self.existing_md5s:
+                return True
+            self.existing_md5s.add(md5)
+        else:
+            key = (workplace_id, record.get("path"))
+            if key in self.existing_paths:
+                return True
+            self.existing_paths.add(key)
+        return False
+
+    def restore_items(self, records, stats):
+        insert_item = "INSERT INTO items(workplace_id, {}) VALUES ({})".format(
+                ", ".join(mdtype.name for mdtype in FIXED_METADATA),
+                ", ".join(["?"] * (len(FIXED_METADATA) + 1)))
+        item_tags = []
+        custom_values = []
+        fts_rows = []
+        with self.db:
+            cur = self.db.cursor()
+            for record in records:
+                workplace = record.get("workplace")
+                if workplace is None:
+                    workplace_id = None
+                else:
+                    workplace_id = self.get_workplace_id(workplace)
+                if self._is_duplicate(workplace_id, record):
+                    stats["skipped"] += 1
+                    continue
+                values = [workplace_id] + [record.get(mdtype.name)
+                                           for mdtype in FIXED_METADATA]
+                cur.execute(insert_item, values)
+                item_id = cur.lastrowid
+                for tag in record.get("tags", ()):
+                    item_tags.append((item_id, self.tags.get_id(tag)))
+                custom = record.get("custom", {})
+                for key, value in custom.items():
+                    custom_values.append((item_id, self.keys.get_id(key), value))
+                if workplace_id is None:
+                    data = {"_" + mdtype.name: record.get(mdtype.name)
+                            for mdtype in FIXED_METADATA}
+                    data.update(custom)
+                    metadata = Metadata(data)
+                    fts_rows.append((item_id, self.library.get_fts_content(metadata)))
+                stats["restored"] += 1
+            cur.executemany("INSERT INTO item_tags(item_id, tag_id) VALUES(?, ?)",
+                            item_tags)
+            cur.executemany("INSERT INTO item_custom_values(item_id, key_id, value)"
+                            " VALUES(?, ?, ?)", custom_values)
+            cur.executemany("INSERT INTO fts (rowid, content) VALUES (?,?)", fts_rows)
+        logger.debug("%i items restored so far", stats["restored"])
+
+    def finish(self):
+        # tags and workplaces created outside of item batches
+        self.db.commit()
@@ -1,18 +1,129 @@
 
+import json
 import logging
 import os
+import random
 import re
 import shutil
+import time
 
+from collections import namedtuple
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, wait,
+                                FIRST_COMPLETED)
+
+from .file_analyzer import compute_md5
+from .import_journal import JOURNAL_RE
 from .metadata import Metadata
 
 TMPDIR_RE = re.compile(r"tmp.(\d+)$")
 FILENAME_RE = re.compile(r"([0-9a-f]{32})\.(\w+)$")
 HEX_DIGITS = "0123456789abcdef"
 
+# unchanged files are verified again after that many seconds
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+# hashing jobs queued per worker process
+JOBS_QUEUED_PER_WORKER = 4
+
+# verification results stored in the database in batches of that size
+VERIFIED_BATCH_SIZE = 1000
+
+# fixes applied in one write transaction
+FIXES_BATCH_SIZE = 100
+
+# checkpoint of an interrupted verification run, in the library directory
+CHECKPOINT_FILENAME = "verify_checkpoint.json"
+CHECKPOINT_RE = re.compile(r"\w+_checkpoint\.json(\.tmp)?$")
+CHECKPOINT_VERSION = 1
+
+# how often (in seconds) the checkpoint is saved during long stages
+CHECKPOINT_INTERVAL = 30.0
+
+# number of threads listing the fan-out directories
+SCAN_THREADS = 16
+
+FileToVerify = namedtuple("FileToVerify", "path item_id md5 size mtime_ns")
+StoredItem = namedtuple("StoredItem", "item_id name md5 ext size mtime_ns verified_at")
+FoundFile = namedtuple("FoundFile", "path md5 ext size mtime_ns")
+
 logger = logging.getLogger("library_verifier")
 
 
+def scan_fanout_dir(dir_path):
+    """List library files in a single fan-out directory.
+
+    Returns list of FoundFile tuples and list of warning messages."""
+    prefix = dir_path[-4] + dir_path[-2:]
+    files = []
+    warnings = []
+    try:
+        entries = list(os.scandir(dir_path))
+    except OSError as err:
+        return files, ["Cannot list {!r}: {}".format(dir_path, err)]
+    for entry in entries:
+        path = entry.path
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                warnings.append("Unexpected directory: {!r}".format(path))
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                warnings.append("Unexpected special file: {!r}".format(path))
+                continue
+            match = FILENAME_RE.match(entry.name)
+            if not match:
+                warnings.append("Unexpected file (bad filename): {!r}".format(path))
+                continue
+            md5 = match.group(1)
+            if md5[:3] != prefix:
+                warnings.append("Unexpected (misplaced) file: {!r}".format(path))
+                continue
+            stat = entry.stat(follow_symlinks=False)
+        except OSError as err:
+            warnings.append("Cannot stat {!r}: {}".format(path, err))
+            continue
+        files.append(FoundFile(path, md5, match.group(2), stat.st_size, stat.st_mtime_ns))
+    return files, warnings
+
+
+def hash_files(files, jobs=1, throttle=None):
+    """Compute MD5 of the files, yielding (file, md5, error) tuples.
+
+    `files` are FileToVerify tuples, hashed by `jobs` worker processes
+    (in the current one, if 1); `throttle`, if given, is called with
+    the size of each file before it is read. Results come in the order of
+    completion."""
+    if jobs == 1:
+        for file_to_verify in files:
+            if throttle is not None:
+                throttle(file_to_verify.size)
+            try:
+                yield file_to_verify, compute_md5(file_to_verify.path), None
+            except OSError as err:
+                yield file_to_verify, None, err
+        return
+    max_pending = jobs * JOBS_QUEUED_PER_WORKER
+    files = iter(files)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+        while True:
+            for file_to_verify in files:
+                if throttle is not None:
+                    throttle(file_to_verify.size)
+                future = executor.submit(compute_md5, file_to_verify.path)
+                pending[future] = file_to_verify
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_to_verify = pending.pop(future)
+                try:
+                    yield file_to_verify, future.result(), None
+                except OSError as err:
+                    yield file_to_verify, None, err
+
+
 class Progress:
     def __init__(self, stages):
         self.stages = stages
@@ -126,75 +237,291 @@ class FixBrokenTagAssignments(Question):
 
 
 class LibraryVerifier:
-    def __init__(self, app):
+    """Checks library database and storage consistency.
+
+    The database is read once, in a single short read transaction, so the
+    checks see a consistent snapshot without locking the library for the
+    whole run. Problems found are collected as fixes (JSON-serializable
+    lists: kind and arguments) and applied in short write transactions at
+    the end, each fix checked again against the current state first.
+
+    Database and storage are reconciled with set operations: all library
+    items are loaded with one query, the fan-out directories are listed in
+    parallel threads and missing, unknown and misplaced files are found
+    by comparing the results.
+
+    File contents are verified by comparing MD5 checksums, computed in
+    `jobs` worker processes. Size and modification time of verified files
+    are stored in the database, so only files that changed, were not verified
+    for `max_age` seconds, or are randomly selected with `sample_ratio`
+    probability are read again. `verify_all` forces checking all files.
+
+    Progress is saved to a checkpoint file regularly and when the run is
+    interrupted: the last stage completed, fan-out directories with all
+    contents verified, errors reported and fixes not applied yet. With
+    `resume` an interrupted run continues from the checkpoint – errors
+    already reported are not reported (or asked about) again and verified
+    directories are not read again. The `report` attribute is set to
+    a JSON-serializable summary when the run completes.
+
+    `db` is the database connection to use, when not the one of the library
+    (e.g. in another thread). `throttle`, if given, is called with the size
+    of each file read, before it is read; it may sleep to limit the
+    I/O rate. `checkpoint_name` allows separate checkpoints for separate
+    kinds of verification runs."""
+
+    def __init__(self, app, jobs=None, max_age=DEFAULT_MAX_AGE, sample_ratio=0.0,
+                 verify_all=False, resume=False, db=None, throttle=None,
+                 checkpoint_name=CHECKPOINT_FILENAME):
         self.app = app
         self.lib = app.library
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        self.jobs = max(jobs, 1)
+        self.max_age = max_age
+        self.sample_ratio = sample_ratio
+        self.verify_all = verify_all
+        self.resume = resume
+        self.db = db if db is not None else self.lib.db
+        self.throttle = throttle
+        self.checkpoint_path = os.path.join(self.lib.base_path, checkpoint_name)
+        self.report = None
+        self.fixes = []
+        self.errors = []
+        self._fixes_applied = []
+        self._fixes_skipped = []
+        self._previous_errors = set()
+        self._done_dirs = set()
+        self._started_at = None
+        self._resumed = False
+        self._last_stage = None
+        self._last_checkpoint = 0
+        self._items_checked = 0
+        self._files_found = 0
+        self._files_verified = 0
+        self._snapshot = None
+        self._stored_items = {}
+        self._found_files = []
+        self._to_verify = []
 
     def verify(self):
-        progress = Progress(3)
-        with self.lib.db as db:
-            db.execute("BEGIN EXCLUSIVE TRANSACTION")
-            yield from self._check_items(db, progress)
-            yield from self._check_files(db, progress)
-            yield from self._check_item_tags(db, progress)
-
-    def _check_items(self, db, progress):
-        yield from progress._next_stage("Checking items")
-        cur = db.execute("SELECT item_count FROM tags WHERE name = '/'")
-        row = cur.fetchone()
-        if cur:
-            item_count = row[0]
+        progress = Progress(7)
+        self._start()
+        self._stored_items = {}
+        self._found_files = []
+        self._to_verify = []
+        db = self.db
+        stages = [self._check_items,
+                  self._scan_storage,
+                  self._check_missing_files,
+                  self._check_files,
+                  lambda progress: self._verify_contents(db, progress),
+                  self._check_item_tags,
+                  lambda progress: self._apply_fixes(db, progress)]
+        try:
+            self._snapshot = self._read_snapshot(db)
+            for stage in stages:
+                yield from stage(progress)
+                self._last_stage = progress.stage_name
+                self._save_checkpoint()
+        except BaseException:
+            if self._started_at is not None:
+                logger.info("Verification interrupted, saving checkpoint")
+                self._save_checkpoint()
+            raise
+        finally:
+            self._snapshot = None
+        self._remove_checkpoint()
+        self.report = self._make_report()
+
+    def _start(self):
+        self.report = None
+        self.fixes = []
+        self.errors = []
+        self._fixes_applied = []
+        self._fixes_skipped = []
+        self._previous_errors = set()
+        self._done_dirs = set()
+        self._last_stage = None
+        self._items_checked = 0
+        self._files_found = 0
+        self._files_verified = 0
+        checkpoint = None
+        if self.resume:
+            checkpoint = self._load_checkpoint()
+        elif os.path.exists(self.checkpoint_path):
+            logger.info("Previous verification run was interrupted,"
+                        " starting from the beginning")
+        if checkpoint:
+            self._started_at = checkpoint["started_at"]
+            self._last_stage = checkpoint["stage"]
+            self.fixes = checkpoint["fixes"]
+            self.errors = checkpoint["errors"]
+            self._previous_errors = set(self.errors)
+            self._done_dirs = set(checkpoint["done_dirs"])
+            self._resumed = True
+            logger.info("Resuming verification started at %s, last stage completed: %r",
+                        time.ctime(self._started_at), self._last_stage)
         else:
-            yield from progress._send_error("Missing '/' tag for total item count")
-            cur = db.execute("SELECT COUNT(id) FROM items")
-            item_count = cur.fetchone()[0]
+            self._started_at = time.time()
+            self._resumed = False
+        self._last_checkpoint = time.monotonic()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as checkpoint_f:
+                checkpoint = json.load(checkpoint_f)
+        except FileNotFoundError:
+            logger.warning("No interrupted verification run to resume")
+            return None
+        except (OSError, ValueError) as err:
+            logger.warning("Cannot read %r: %s", self.checkpoint_path, err)
+            return None
+        if not isinstance(checkpoint, dict) or checkpoint.get("version") != CHECKPOINT_VERSION:
+            logger.warning("Unsupported checkpoint %r, ignoring", self.checkpoint_path)
+            return None
+        try:
+            return {"started_at": float(checkpoint["started_at"]),
+                    "stage": checkpoint["stage"],
+                    "fixes": list(checkpoint["fixes"]),
+                    "errors": list(checkpoint["errors"]),
+                    "done_dirs": list(checkpoint["done_dirs"])}
+        except (KeyError, TypeError, ValueError) as err:
+            logger.warning("Invalid checkpoint %r (%s), ignoring", self.checkpoint_path, err)
+            return None
+
+    def _save_checkpoint(self):
+        checkpoint = {"version": CHECKPOINT_VERSION,
+                      "started_at": self._started_at,
+                      "saved_at": time.time(),
+                      "stage": self._last_stage,
+                      "done_dirs": sorted(self._done_dirs),
+                      "fixes": self.fixes,
+                      "errors": self.errors}
+        tmp_path = self.checkpoint_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as checkpoint_f:
+                json.dump(checkpoint, checkpoint_f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError as err:
+            logger.warning("Cannot save verification checkpoint: %s", err)
+        self._last_checkpoint = time.monotonic()
+
+    def _checkpoint_due(self):
+        return time.monotonic() - self._last_checkpoint >= CHECKPOINT_INTERVAL
+
+    def _remove_checkpoint(self):
+        try:
+            os.unlink(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logger.warning("Cannot remove %r: %s", self.checkpoint_path, err)
+
+    def _make_report(self):
+        return {"started_at": self._started_at,
+                "finished_at": time.time(),
+                "resumed": self._resumed,
+                "items_checked": self._items_checked,
+                "files_found": self._files_found,
+                "files_verified": self._files_verified,
+                "errors": list(self.errors),
+                "fixes_applied": self._fixes_applied,
+                "fixes_skipped": self._fixes_skipped}
+
+    def _send_error(self, progress, message, question=None):
+        """Report an error, unless already reported before the run was resumed."""
+        if message in self._previous_errors:
+            logger.debug("already reported: %s", message)
+            return
+        yield from progress._send_error(message, question)
+        # recorded when handled, so unanswered questions are asked again
+        self.errors.append(message)
+
+    def _read_snapshot(self, db):
+        """Read everything needed from the database in one read transaction."""
+        snapshot = {}
+        if db.in_transaction:
+            # committing it here could commit somebody else's changes
+            raise RuntimeError("Database connection in the middle of a transaction")
+        db.execute("BEGIN DEFERRED TRANSACTION")
+        try:
+            cur = db.execute("SELECT item_count FROM tags WHERE name = '/'")
+            row = cur.fetchone()
+            snapshot["item_count"] = row[0] if row else None
+            cur = db.execute("SELECT COUNT(id) FROM items WHERE workplace_id IS NULL")
+            snapshot["real_item_count"] = cur.fetchone()[0]
+            cur = db.execute("SELECT item.id, item.name, item.md5, item.path, item.format,"
+                             " f.size, f.mtime_ns, f.verified_at"
+                             " FROM items item"
+                             " LEFT JOIN item_files f ON (f.item_id = item.id)"
+                             " WHERE item.workplace_id IS NULL")
+            snapshot["items"] = cur.fetchall()
+            cur = db.execute("SELECT id, tag_id, item_id FROM item_tags"
+                             " WHERE tag_id NOT IN (SELECT id FROM tags)")
+            snapshot["missing_tags"] = cur.fetchall()
+            cur = db.execute("SELECT id, item_id FROM item_tags"
+                             " WHERE item_id NOT IN (SELECT id FROM items)")
+            snapshot["missing_items"] = cur.fetchall()
+        finally:
+            db.commit()
+        return snapshot
+
+    def _add_fix(self, kind, *args):
+        logger.debug("fix scheduled: %s%r", kind, args)
+        self.fixes.append([kind] + list(args))
+
+    def _check_items(self, progress):
+        yield from progress._next_stage("Checking items")
+        item_count = self._snapshot["item_count"]
+        if item_count is None:
+            yield from self._send_error(progress, "Missing '/' tag for total item count")
+            item_count = self._snapshot["real_item_count"]
 
-        cur = db.execute("SELECT id, name, md5, path, format"
-                         " FROM items"
-                         " WHERE workplace_id IS NULL")
+        rows, self._snapshot["items"] = self._snapshot["items"], None
         i = 0
-        to_delete = []
-        while True:
-            row = cur.fetchone()
-            if row is None:
-                break
-            item_id, name, item_md5, path, file_format = row
+        stored_items = {}
+        for row in rows:
+            item_id, name, md5, path, file_format = row[:5]
             i += 1
-            if not (i % 100):
-                yield from progress._set_percent(100 * i / item_count)
-            metadata = Metadata({"_md5": item_md5,
-                                 "_path": path,
-                                 "_format": file_format})
-            path = self.lib.get_item_path(metadata)
-            if not os.path.exists(path):
-                question = RemoveItemWhenFileMissing(name, path)
-                yield from progress._send_error("Item #{} {!r} – file {!r} missing"
+            if path:
+                # external file
+                if not (i % 100):
+                    yield from progress._set_percent(100 * i / max(item_count, 1))
+                if not os.path.exists(path):
+                    question = RemoveItemWhenFileMissing(name, path)
+                    yield from self._send_error(progress, "Item #{} {!r} – file {!r} missing"
                                                 .format(item_id, name, path),
                                                 question)
-                if question.the_answer == "Yes":
-                    to_delete.append(item_id)
+                    if question.the_answer == "Yes":
+                        self._add_fix("delete_missing_item", item_id, path)
+            elif md5:
+                ext = file_format.lower() if file_format else "bin"
+                stored_items[md5] = StoredItem(item_id, name, md5, ext, *row[5:])
+            else:
+                yield from self._send_error(progress, "Item #{} {!r} has no checksum"
+                                            .format(item_id, name))
         if item_count != i:
-            yield from progress._send_error("Item counter is wrong says: {} instead on {}"
-                                            .format(item_count, i))
-        for i in range(0, len(to_delete), 10):
-            ids = to_delete[i:i+10]
-            logger.debug("Removing items %r", ids)
-            placeholders = ", ".join(["?"] * len(ids))
-            db.execute("DELETE FROM items WHERE id IN ({})".format(placeholders),
-                       ids)
+            yield from self._send_error(progress, "Item counter is wrong says: {} instead on {}"
+                                        .format(item_count, i))
+        self._items_checked = i
+        self._stored_items = stored_items
         yield from progress._set_percent(100)
 
-    def _check_files(self, db, progress):
-        yield from progress._next_stage("Checking files")
+    def _scan_storage(self, progress):
+        yield from progress._next_stage("Scanning storage")
         base_path = self.lib.base_path
+        fanout_dirs = []
         for filename in sorted(os.listdir(base_path)):
             path = os.path.join(base_path, filename)
             if os.path.isfile(path):
-                if filename not in ("database.db", "database.db-journal"):
+                if (filename not in ("database.db", "database.db-journal")
+                        and not CHECKPOINT_RE.match(filename)
+                        and not JOURNAL_RE.match(filename)):
                     logger.warning("Unexpected file: %r", path)
             elif os.path.isdir(path):
                 if len(filename) == 1 and filename in HEX_DIGITS:
-                    yield from self._check_files2(db, progress, filename)
+                    fanout_dirs += self._list_fanout_dirs(filename)
                 else:
                     match = TMPDIR_RE.match(filename)
                     if match:
@@ -203,132 +530,278 @@ class LibraryVerifier:
                             question = RemoveStaleTmpDir()
                             msg = "Unexpected (stale?) temporary directory: "
                             msg += repr(path)
-                            yield from progress._send_error(msg, question)
+                            yield from self._send_error(progress, msg, question)
                             if question.the_answer == "Yes":
-                                try:
-                                    shutil.rmtree(path)
-                                except OSError as err:
-                                    logger.error("Could not remove %r: %s",
-                                                 path, err)
+                                self._add_fix("remove_tmp_dir", path)
                     else:
                         logger.warning("Unexpected directory: %r", path)
             else:
                 logger.warning("Unexpected special file: %r", path)
+
+        found_files = []
+        total = len(fanout_dirs)
+        with ThreadPoolExecutor(max_workers=SCAN_THREADS) as executor:
+            results = executor.map(scan_fanout_dir, fanout_dirs)
+            for i, (files, warnings) in enumerate(results, 1):
+                found_files += files
+                for warning in warnings:
+                    logger.warning("%s", warning)
+                yield from progress._set_percent(100 * i / total)
+        logger.debug("%i files found in %i directories", len(found_files), total)
+        self._files_found = len(found_files)
+        self._found_files = found_files
         yield from progress._set_percent(100)
 
-    def _check_files2(self, db, progress, subdir):
+    def _list_fanout_dirs(self, subdir):
         base_path = self.lib.base_path
         dir_path = os.path.join(base_path, subdir)
+        result = []
         for filename in sorted(os.listdir(dir_path)):
             path = os.path.join(dir_path, filename)
             if os.path.isdir(path):
-                if len(filename) == 2:
-                    try:
-                        number = int(subdir + filename, 16)
-                    except ValueError:
-                        logger.warning("Unexpected directory: %r", path)
-                    else:
-                        yield from progress._set_percent(100 * number / 0x1000)
-                        yield from self._check_files3(db, progress, subdir, filename)
+                if len(filename) == 2 and all(c in HEX_DIGITS for c in filename):
+                    result.append(path)
                 else:
                     logger.warning("Unexpected directory: %r", path)
             else:
                 logger.warning("Unexpected file: %r", path)
+        return result
+
+    def _check_missing_files(self, progress):
+        yield from progress._next_stage("Checking missing files")
+        stored_items = self._stored_items
+        # files with a wrong extension are reported by _check_files()
+        present = {found.md5 for found in self._found_files if found.md5 in stored_items}
+        missing = sorted(stored_items.keys() - present)
+        for i, md5 in enumerate(missing, 1):
+            item = stored_items.pop(md5)
+            path = self.lib.get_item_path(Metadata({"_md5": md5, "_format": item.ext}))
+            question = RemoveItemWhenFileMissing(item.name, path)
+            yield from self._send_error(progress, "Item #{} {!r} – file {!r} missing"
+                                        .format(item.item_id, item.name, path),
+                                        question)
+            if question.the_answer == "Yes":
+                self._add_fix("delete_missing_item", item.item_id, path)
+            yield from progress._set_percent(100 * i / len(missing))
+        yield from progress._set_percent(100)
 
-    def _check_files3(self, db, progress, subdir, subdir2):
-        analyzer = self.app.analyzer
-        base_path = self.lib.base_path
-        dir_path = os.path.join(base_path, subdir, subdir2)
-        for filename in os.listdir(dir_path):
-            path = os.path.join(dir_path, filename)
-            if os.path.isdir(path):
-                logger.warning("Unexpected directory: %r", path)
-                continue
-            if not os.path.isfile(path):
-                logger.warning("Unexpected special file: %r", path)
-                continue
-            match = FILENAME_RE.match(filename)
-            if not match:
-                logger.warning("Unexpected file (bad filename): %r", path)
-                continue
-            md5 = match.group(1)
-            ext = match.group(2)
-            if md5[0] != subdir or md5[1:3] != subdir2:
-                logger.warning("Unexpected (misplaced) file: %r", path)
-                continue
-            cur = db.execute("SELECT id, format, path FROM items"
-                             " WHERE md5 = ?", (md5,))
-            row = cur.fetchone()
-            if not row:
+    def _check_files(self, progress):
+        yield from progress._next_stage("Checking files")
+        stored_items = self._stored_items
+        found_files, self._found_files = self._found_files, []
+        total = len(found_files)
+        for i, found in enumerate(found_files, 1):
+            if not (i % 100):
+                yield from progress._set_percent(100 * i / total)
+            path = found.path
+            item = stored_items.get(found.md5)
+            if item is None:
                 question = RemoveUnknownFile()
                 msg = "File {!r} not in the database".format(path)
-                yield from progress._send_error(msg, question)
+                yield from self._send_error(progress, msg, question)
                 if question.the_answer == "Yes":
-                    try:
-                        os.unlink(path)
-                    except OSError as err:
-                        logger.error("Cannot remove %r: %s", path, err)
+                    self._add_fix("remove_file", path, found.md5, found.ext)
                 continue
-            try:
-                file_info = analyzer.get_file_info(path)
-            except (OSError, RuntimeError) as err:
-                logger.error("Cannot read file %r: %s", path, err)
-                file_info = None
-            item_id, item_format, item_path = row
-            if file_info is None or file_info["md5"] != md5:
-                question = RemoveInvalidItem()
-                if file_info:
-                    msg = "File {!r} checksum mismatch".format(path)
-                else:
-                    msg = "File {!r} unreadable".format(path)
-                yield from progress._send_error(msg, question)
-                if question.the_answer == "Yes":
-                    try:
-                        os.unlink(path)
-                    except OSError as err:
-                        logger.error("Cannot remove %r: %s", path, err)
-                    else:
-                        db.execute("DELETE FROM items WHERE id = ?", (item_id,))
-            if ext != item_format.lower():
+            if found.ext != item.ext:
                 question = RemoveUnknownFile()
                 msg = ("File {!r} extension does not match file format from the library {!r}"
-                       .format(path, item_format))
-                yield from progress._send_error(msg, question)
+                       .format(path, item.ext))
+                yield from self._send_error(progress, msg, question)
                 if question.the_answer == "Yes":
-                    try:
-                        os.unlink(path)
-                    except OSError as err:
-                        logger.error("Cannot remove %r: %s", path, err)
+                    self._add_fix("remove_file", path, found.md5, found.ext)
                 continue
+            if self._needs_verification(found, item):
+                self._to_verify.append(FileToVerify(path, item.item_id, item.md5,
+                                                    found.size, found.mtime_ns))
 
             # TODO: check format/duration/etc
             # it is hard to imagine a mismatch here would happen, though
+        self._stored_items = {}
+        yield from progress._set_percent(100)
 
-    def _check_item_tags(self, db, progress):
+    def _needs_verification(self, found, item):
+        if item.verified_at is None:
+            return True
+        if found.size != item.size or found.mtime_ns != item.mtime_ns:
+            logger.debug("file changed since last verification")
+            return True
+        if item.verified_at >= self._started_at:
+            # verified by the interrupted run being resumed
+            return False
+        if os.path.dirname(found.path) in self._done_dirs:
+            return False
+        if self.verify_all:
+            return True
+        if self.max_age is not None and time.time() - item.verified_at > self.max_age:
+            return True
+        return self.sample_ratio > 0 and random.random() < self.sample_ratio
+
+    def _hash_files(self, files):
+        """Compute MD5 of the files, yielding (file, md5, error) tuples.
+
+        Results come in the order of completion."""
+        return hash_files(files, self.jobs, self.throttle)
+
+    def _verify_contents(self, db, progress):
+        yield from progress._next_stage("Verifying file contents")
+        to_verify, self._to_verify = self._to_verify, []
+        total = len(to_verify)
+        logger.debug("%i files to verify", total)
+        # files left to verify in each fan-out directory
+        remaining = {}
+        for file_to_verify in to_verify:
+            dir_path = os.path.dirname(file_to_verify.path)
+            remaining[dir_path] = remaining.get(dir_path, 0) + 1
+        verified = []
+        # directories done, but with results not stored yet
+        finished_dirs = []
+        try:
+            results = enumerate(self._hash_files(to_verify), 1)
+            for i, (file_to_verify, md5, error) in results:
+                path = file_to_verify.path
+                if md5 == file_to_verify.md5:
+                    verified.append((file_to_verify.item_id, file_to_verify.size,
+                                     file_to_verify.mtime_ns, time.time()))
+                    self._files_verified += 1
+                else:
+                    question = RemoveInvalidItem()
+                    if error is None:
+                        msg = "File {!r} checksum mismatch".format(path)
+                    else:
+                        msg = "File {!r} unreadable: {}".format(path, error)
+                    yield from self._send_error(progress, msg, question)
+                    if question.the_answer == "Yes":
+                        self._add_fix("remove_invalid_item", file_to_verify.item_id,
+                                      path, file_to_verify.md5)
+                dir_path = os.path.dirname(path)
+                remaining[dir_path] -= 1
+                if not remaining[dir_path]:
+                    finished_dirs.append(dir_path)
+                if len(verified) >= VERIFIED_BATCH_SIZE or self._checkpoint_due():
+                    self._store_verified(db, verified)
+                    verified = []
+                    self._done_dirs.update(finished_dirs)
+                    finished_dirs = []
+                    if self._checkpoint_due():
+                        self._save_checkpoint()
+                yield from progress._set_percent(100 * i / total)
+        finally:
+            # also when interrupted, so the work done is not lost
+            self._store_verified(db, verified)
+            self._done_dirs.update(finished_dirs)
+        yield from progress._set_percent(100)
+
+    @staticmethod
+    def _store_verified(db, verified):
+        if not verified:
+            return
+        # items might have been removed since the snapshot was taken
+        with db:
+            db.executemany("INSERT OR REPLACE INTO item_files"
+                           "(item_id, size, mtime_ns, verified_at)"
+                           " SELECT id, ?, ?, ? FROM items WHERE id = ?",
+                           [(size, mtime_ns, verified_at, item_id)
+                            for item_id, size, mtime_ns, verified_at in verified])
+
+    def _check_item_tags(self, progress):
         yield from progress._next_stage("Checking item tags")
-        cur = db.execute("SELECT id, tag_id, item_id FROM item_tags"
-                         " WHERE tag_id NOT IN (SELECT id FROM tags)")
-        rows = cur.fetchall()
+        rows = self._snapshot["missing_tags"]
         missing_tags = set([row[1] for row in rows])
         yield from progress._set_percent(50)
         if missing_tags:
             question = FixBrokenTagAssignments(rows)
-            yield from progress._send_error("Missing item tags: {!r}"
-                                            .format(missing_tags),
-                                            question)
+            yield from self._send_error(progress, "Missing item tags: {!r}"
+                                        .format(missing_tags),
+                                        question)
             if question.the_answer == "Yes":
-                db.execute("DELETE FROM item_tags"
-                           " WHERE tag_id NOT IN (SELECT id FROM tags)")
-        cur = db.execute("SELECT id, item_id FROM item_tags"
-                         " WHERE item_id NOT IN (SELECT id FROM items)")
-        rows = cur.fetchall()
+                self._add_fix("delete_broken_tag_assignments")
+        rows = self._snapshot["missing_items"]
         missing_items = set([row[1] for row in rows])
         yield from progress._set_percent(100)
         if missing_items:
             question = FixBrokenTagAssignments(rows)
-            yield from progress._send_error("Missing tag items: {!r}"
-                                            .format(missing_items),
-                                            question)
+            yield from self._send_error(progress, "Missing tag items: {!r}"
+                                        .format(missing_items),
+                                        question)
             if question.the_answer == "Yes":
-                db.execute("DELETE FROM item_tags"
-                           " WHERE item_id NOT IN (SELECT id FROM items)")
+                self._add_fix("delete_broken_tag_assignments")
+
+    def _apply_fixes(self, db, progress):
+        yield from progress._next_stage("Applying fixes")
+        total = len(self.fixes)
+        done = 0
+        while self.fixes:
+            batch = self.fixes[:FIXES_BATCH_SIZE]
+            applied = []
+            skipped = []
+            with db:
+                for fix in batch:
+                    kind, args = fix[0], fix[1:]
+                    try:
+                        if getattr(self, "_fix_" + kind)(db, *args):
+                            applied.append(fix)
+                        else:
+                            skipped.append(fix)
+                    except OSError as err:
+                        logger.error("Cannot apply fix %s%r: %s", kind, tuple(args), err)
+                        skipped.append(fix)
+            # fixes are checked again before applying, so repeating them
+            # after an interruption here is harmless
+            del self.fixes[:len(batch)]
+            self._fixes_applied += applied
+            self._fixes_skipped += skipped
+            done += len(batch)
+            if self._checkpoint_due():
+                self._save_checkpoint()
+            yield from progress._set_percent(100 * done / total)
+        yield from progress._set_percent(100)
+
+    def _fix_delete_missing_item(self, db, item_id, path):
+        if os.path.exists(path):
+            logger.info("%r re-appeared, not removing item #%i", path, item_id)
+            return False
+        logger.debug("Removing item %r", item_id)
+        db.execute("DELETE FROM items WHERE id = ?", (item_id,))
+        return True
+
+    def _fix_remove_file(self, db, path, md5, ext):
+        cur = db.execute("SELECT format FROM items"
+                         " WHERE md5 = ? AND workplace_id IS NULL AND path IS NULL",
+                         (md5,))
+        for (file_format, ) in cur:
+            if (file_format.lower() if file_format else "bin") == ext:
+                logger.info("%r added to the library meanwhile, not removing", path)
+                return False
+        logger.debug("Removing %r", path)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _fix_remove_invalid_item(self, db, item_id, path, md5):
+        cur = db.execute("SELECT id FROM items WHERE id = ? AND md5 = ?", (item_id, md5))
+        if not cur.fetchone():
+            logger.info("Item #%i changed meanwhile, not removing", item_id)
+            return False
+        logger.debug("Removing %r and item %r", path, item_id)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        db.execute("DELETE FROM items WHERE id = ?", (item_id,))
+        return True
+
+    def _fix_remove_tmp_dir(self, db, path):
+        if not os.path.exists(path):
+            return False
+        logger.debug("Removing %r", path)
+        shutil.rmtree(path)
+        return True
+
+    def _fix_delete_broken_tag_assignments(self, db):
+        db.execute("DELETE FROM item_tags"
+                   " WHERE tag_id NOT IN (SELECT id FROM tags)")
+        db.execute("DELETE FROM item_tags"
+                   " WHERE item_id NOT IN (SELECT id FROM items)")
+        return True
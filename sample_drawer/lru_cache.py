@@ -1,21 +1,40 @@
 
+import os
 import threading
+import time
 
 SENTINEL = object()
-PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+PREV, NEXT, KEY, VALUE, WEIGHT, EXPIRES = 0, 1, 2, 3, 4, 5
 
 
 class LRUCache:
-    """LRU cache based on Python's functools lru_cache wrapper."""
+    """LRU cache based on Python's functools lru_cache wrapper.
 
-    def __init__(self, maxsize=100):
+    Number of entries is limited by `maxsize` (None for no limit). When
+    `weight` function is given, it is called for every value stored and
+    the least recently used entries are evicted when the total weight
+    (e.g. size in bytes) exceeds `maxweight`. Values heavier than
+    `maxweight` are not stored at all.
+
+    Entries expire `ttl` seconds after they were stored (never when None).
+    The default may be overridden per entry in `put()`."""
+
+    def __init__(self, maxsize=100, maxweight=None, weight=None, ttl=None):
         self._cache = {}
         self._lock = threading.RLock()
         self.maxsize = maxsize
+        self.maxweight = maxweight
+        self._weight = weight
+        self.ttl = ttl
         self.hits = self.misses = 0
-        self.full = False
+        self.evictions = self.expirations = 0
+        self.total_weight = 0
         self._root = []
-        self._root[:] = [self._root, self._root, None, None]
+        self._root[:] = [self._root, self._root, None, None, 0, None]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
 
     def get(self, key, default=None):
         with self._lock:
@@ -23,13 +42,19 @@ class LRUCache:
             if link is None:
                 self.misses += 1
                 return default
+            expires = link[EXPIRES]
+            if expires is not None and expires <= time.monotonic():
+                self._remove(link)
+                self.expirations += 1
+                self.misses += 1
+                return default
             self._to_the_front(link)
             value = link[VALUE]
             self.hits += 1
             return value
 
     def _to_the_front(self, link):
-        link_prev, link_next, _key, value = link
+        link_prev, link_next = link[PREV], link[NEXT]
         link_prev[NEXT] = link_next
         link_next[PREV] = link_prev
         last = self._root[PREV]
@@ -37,42 +62,159 @@ class LRUCache:
         link[PREV] = last
         link[NEXT] = self._root
 
+    def _remove(self, link):
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        del self._cache[link[KEY]]
+        self.total_weight -= link[WEIGHT]
+
     def __getitem__(self, key):
         result = self.get(key, default=SENTINEL)
         if result is SENTINEL:
             raise KeyError(key)
         return result
 
-    def put(self, key, value):
+    def __contains__(self, key):
+        with self._lock:
+            link = self._cache.get(key)
+            if link is None:
+                return False
+            expires = link[EXPIRES]
+            return expires is None or expires > time.monotonic()
+
+    def put(self, key, value, ttl=SENTINEL):
+        if ttl is SENTINEL:
+            ttl = self.ttl
+        if ttl is not None:
+            expires = time.monotonic() + ttl
+        else:
+            expires = None
+        if self._weight is not None:
+            weight = self._weight(value)
+        else:
+            weight = 0
         with self._lock:
             current = self._cache.get(key)
             if current is not None:
-                current[3] = value
-                self._to_the_front(current)
-            elif self.full:
-                # Use the old root to store the new key and result.
-                oldroot = self._root
-                oldroot[KEY] = key
-                oldroot[VALUE] = value
-                # Empty the oldest link and make it the new root.
-                # Keep a reference to the old key and old result to
-                # prevent their ref counts from going to zero during the
-                # update. That will prevent potentially arbitrary object
-                # clean-up code (i.e. __del__) from running while we're
-                # still adjusting the links.
-                self._root = oldroot[NEXT]
-                oldkey = self._root[KEY]
-                oldresult = self._root[VALUE]  # noqa: F841 keep reference
-                self._root[KEY] = self._root[VALUE] = None
-                # Now update the cache dictionary.
-                del self._cache[oldkey]
-                # Put the new link
-                self._cache[key] = oldroot
-            else:
-                # Put result in a new link at the front of the queue.
-                last = self._root[PREV]
-                link = [last, self._root, key, value]
-                last[NEXT] = self._root[PREV] = self._cache[key] = link
-                # Use the cache_len bound method instead of the len() function
-                # which could potentially be wrapped in an lru_cache itself.
-                self.full = (len(self._cache) >= self.maxsize)
+                self._remove(current)
+            if self.maxweight is not None and weight > self.maxweight:
+                # would evict everything else and still not fit
+                self.evictions += 1
+                return
+            # Put result in a new link at the front of the queue.
+            last = self._root[PREV]
+            link = [last, self._root, key, value, weight, expires]
+            last[NEXT] = self._root[PREV] = self._cache[key] = link
+            self.total_weight += weight
+            self._evict()
+
+    def _evict(self):
+        while self._cache and (
+                (self.maxsize is not None and len(self._cache) > self.maxsize)
+                or (self.maxweight is not None and self.total_weight > self.maxweight)):
+            oldest = self._root[NEXT]
+            # keep a reference to the old value until the links are updated,
+            # so no arbitrary clean-up code runs in the middle of that
+            oldvalue = oldest[VALUE]  # noqa: F841 keep reference
+            self._remove(oldest)
+            self.evictions += 1
+
+    def discard(self, key):
+        """Remove entry from the cache, if present."""
+        with self._lock:
+            link = self._cache.get(key)
+            if link is not None:
+                self._remove(link)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._root[:] = [self._root, self._root, None, None, 0, None]
+            self.total_weight = 0
+
+    def stats(self):
+        """Return cache statistics as a dictionary."""
+        with self._lock:
+            return {"entries": len(self._cache),
+                    "weight": self.total_weight,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+
+def default_shard_count():
+    """Power of two above the number of CPUs, so few threads share a shard."""
+    count = 4
+    while count < 4 * (os.cpu_count() or 1):
+        count *= 2
+    return count
+
+
+class ShardedLRUCache:
+    """LRU cache split into independently locked shards.
+
+    Keys are distributed between the shards by their hash and each shard is
+    a separate LRUCache with its share of the `maxsize` and `maxweight`
+    limits, so threads using different keys rarely wait for each other.
+    Eviction is only approximately global: the least recently used entry of
+    the shard being updated goes, not the least recently used one overall,
+    and a single value may use only the weight budget of its shard.
+
+    The interface is the same as of LRUCache."""
+
+    def __init__(self, maxsize=100, maxweight=None, weight=None, ttl=None, shards=None):
+        if shards is None:
+            shards = default_shard_count()
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError("Number of shards must be a power of two")
+        self._mask = shards - 1
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.ttl = ttl
+        shard_size = None if maxsize is None else max(1, -(-maxsize // shards))
+        shard_weight = None if maxweight is None else maxweight / shards
+        self._shards = [LRUCache(maxsize=shard_size,
+                                 maxweight=shard_weight,
+                                 weight=weight,
+                                 ttl=ttl)
+                        for i in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) & self._mask]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def get(self, key, default=None):
+        return self._shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def put(self, key, value, ttl=SENTINEL):
+        self._shard(key).put(key, value, ttl)
+
+    def discard(self, key):
+        self._shard(key).discard(key)
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
+    @property
+    def total_weight(self):
+        return sum(shard.total_weight for shard in self._shards)
+
+    def stats(self):
+        """Return statistics summed over all the shards."""
+        result = {}
+        for shard in self._shards:
+            for key, value in shard.stats().items():
+                result[key] = result.get(key, 0) + value
+        result["shards"] = len(self._shards)
+        return result
@@ -1,19 +1,30 @@
 
 import argparse
+import json
 import logging
 import os
 import shlex
 import sys
 
+from collections import Counter
+
 import appdirs
 
-from .gui.app import GUIApplication
-from .library import Library, LibraryError, LibraryConflictError
-from .library_verifier import LibraryVerifier
-from .workplace import Workplace
+from .library import (Library, LibraryError, LibraryConflictError, IMPORT_BATCH_SIZE,
+                      format_import_stats)
+from .import_journal import (ImportJournal, IMPORT_JOURNAL_FILENAME, WATCH_JOURNAL_FILENAME,
+                             ANALYZED, COPIED, COMMITTED, file_signature)
+from .external_rescan import ExternalRescanner
+from .folder_watcher import FolderWatcher
+from .library_dump import LibraryDumper, open_dump_file
+from .library_verifier import LibraryVerifier, DEFAULT_MAX_AGE
+from .workplace import Workplace, MATERIALIZE_THREADS
 from .file_analyzer import FileAnalyzer
-from .metadata import FIXED_METADATA_D, FIXED_METADATA_KEYS
+from .metadata import FIXED_METADATA_D, FIXED_METADATA_KEYS, Metadata, RewriteRules
 from .config import Config
+from .file_copy import check_methods
+from .export import DEFAULT_FIELDS, PATH_FIELD, ItemWriter, parse_fields
+from .search import SearchQuery, TagRequireQuery
 
 APP_NAME = "sampledrawer"
 APP_AUTHOR = "Jajcus"
@@ -59,6 +70,20 @@ def metadata_key_value(arg):
     return (key.lower(), value)
 
 
+def copy_method_list(arg):
+    try:
+        return check_methods(method.strip() for method in arg.split(","))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def field_list(arg):
+    try:
+        return parse_fields(arg)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
 class Application:
     def __init__(self):
         self.args = None
@@ -73,7 +98,11 @@ class Application:
 
         self.config = Config()
         self.analyzer = FileAnalyzer()
-        self.library = Library(self.appdirs)
+        self.import_stats = Counter()
+        self.import_journal = None
+        self.import_batch = []
+        self.import_batch_size = IMPORT_BATCH_SIZE
+        self.library = Library(self.appdirs, copy_methods=self.get_copy_methods())
         self.workplace = Workplace(self, self.library, self.args.workplace)
 
     def parse_args(self):
@@ -92,9 +121,17 @@ class Application:
         parser.add_argument('--qt-options', type=shlex.split, action='extend',
                             dest='qt_argv', default=[sys.argv[0]],
                             help='Command line options to pass to the Qt library')
+        parser.add_argument('--prefetch', type=int, metavar="N",
+                            help='For GUI: analyze N files before and after the selected one'
+                            ' in advance')
+        parser.add_argument('--no-scrubber', action="store_false", dest="scrubber",
+                            help='For GUI: do not verify the library in the background')
         parser.add_argument('--import', nargs="+", metavar="PATH",
                             dest="import_files",
                             help='Import files to the library')
+        parser.add_argument('--watch', nargs="*", metavar="PATH",
+                            help='Watch folders (default: from the configuration)'
+                            ' and import new files until interrupted')
         parser.add_argument('--tag', action="append", dest='tags',
                             help='Tag to select or add')
         parser.add_argument('--set', action="append", dest='metadata',
@@ -102,26 +139,96 @@ class Application:
                             help='Set custom metadata')
         parser.add_argument('--workplace', default="main",
                             help='Select workplace to use')
+        parser.add_argument('--materialize', metavar="DIR",
+                            help='Create a folder tree with the workplace files in DIR')
         parser.add_argument('--check-db', action="store_true",
                             help='Verify library database consistency')
+        parser.add_argument('--jobs', type=int, metavar="N",
+                            help='Number of worker processes for --check-db'
+                            ' and --rescan-external (default: number of CPUs)'
+                            ' or threads for --materialize'
+                            ' (default: {})'.format(MATERIALIZE_THREADS))
+        parser.add_argument('--verify-all', action="store_true",
+                            help='For --check-db: verify contents of all files,'
+                            ' not only the changed or not recently verified ones')
+        parser.add_argument('--verify-max-age', type=float, metavar="DAYS",
+                            default=DEFAULT_MAX_AGE / 86400,
+                            help='For --check-db: verify contents of unchanged files'
+                            ' not verified for that many days (default: %(default)g)')
+        parser.add_argument('--verify-sample', type=float, metavar="RATIO", default=0.0,
+                            help='For --check-db: also verify this fraction (0-1)'
+                            ' of randomly selected, recently verified files')
+        parser.add_argument('--resume', action="store_true",
+                            help='For --check-db: continue an interrupted verification run')
+        parser.add_argument('--report', metavar="FILE",
+                            help='For --check-db: write a JSON report of the verification'
+                            ' to FILE')
+        parser.add_argument('--rescan-external', nargs="*", metavar="SEARCH_PATH",
+                            help='Check files imported with --no-copy: verify the ones'
+                            ' changed and look for the missing ones under SEARCH_PATHs')
+        parser.add_argument('--search', metavar="QUERY",
+                            help='Search the library and write matching items'
+                            ' to the standard output')
+        parser.add_argument('--output-format', default="jsonl",
+                            choices=sorted(ItemWriter.formats),
+                            help='Search output format')
+        parser.add_argument('--fields', type=field_list, default=DEFAULT_FIELDS,
+                            metavar="FIELD,...",
+                            help='Comma-separated list of fields to output'
+                            ' (default: {})'.format(",".join(DEFAULT_FIELDS)))
+        parser.add_argument('--with-path', action="store_true",
+                            help='Add path of the sample file to the search output')
+        parser.add_argument('--limit', type=int,
+                            help='Maximum number of search results')
+        parser.add_argument('--dump', metavar="FILE",
+                            help='Dump library database to a JSON Lines file'
+                            " ('-' for standard output)")
+        parser.add_argument('--restore', metavar="FILE",
+                            help='Load library database dump'
+                            " ('-' for standard input)")
         parser.add_argument('--audio-driver',
                             help='Select audio device to use.')
         parser.add_argument('--audio-device',
                             help='Select audio device to use.')
         parser.add_argument('--no-copy', action="store_false", dest="copy",
                             help='Do not copy files to library on import.')
+        parser.add_argument('--copy-methods', type=copy_method_list,
+                            metavar="METHOD,...",
+                            help='Methods used to copy files, in the order of preference'
+                            ' (reflink, hardlink, copy_file_range, sendfile, copy)')
+        parser.add_argument('--allow-hardlinks', action="store_true",
+                            help='Allow hard-linking imported files into the library.'
+                            ' Later changes to the source files will affect'
+                            ' the library too.')
         parser.add_argument('--data-dir',
                             help='Override default data directory (for testing).')
         self.args = parser.parse_args()
         if self.args.data_dir:
             self.appdirs.override("user_data_dir", self.args.data_dir)
 
+    def get_copy_methods(self):
+        copy_methods = list(self.args.copy_methods
+                            or self.config["library"]["copy_methods"])
+        if self.args.allow_hardlinks and "hardlink" not in copy_methods:
+            # right after reflink, which is safer when available
+            if "reflink" in copy_methods:
+                index = copy_methods.index("reflink") + 1
+            else:
+                index = 0
+            copy_methods.insert(index, "hardlink")
+        return copy_methods
+
     def setup_logging(self):
         logging.basicConfig(level=self.args.debug_level,
                             format=LOG_FORMAT)
 
     def check_db(self):
-        verifier = LibraryVerifier(self)
+        verifier = LibraryVerifier(self,
+                                   jobs=self.args.jobs,
+                                   max_age=self.args.verify_max_age * 86400,
+                                   sample_ratio=self.args.verify_sample,
+                                   verify_all=self.args.verify_all,
+                                   resume=self.args.resume)
         last_stage = 0
         last_percent = -10
         errors = 0
@@ -168,31 +275,166 @@ class Application:
                         except KeyError:
                             continue
                 question.answer(answer)
-        if errors:
+        if self.args.report:
+            with open(self.args.report, "w", encoding="utf-8") as report_f:
+                json.dump(verifier.report, report_f, indent=2, ensure_ascii=False)
+                report_f.write("\n")
+        if errors or verifier.errors:
+            return 1
+
+        return 0
+
+    def materialize(self):
+        stats = self.workplace.materialize(self.args.materialize,
+                                           jobs=self.args.jobs or MATERIALIZE_THREADS)
+        methods = ", ".join("{}: {}".format(key[5:], count)
+                            for key, count in sorted(stats.items())
+                            if key.startswith("copy:"))
+        copied = sum(count for key, count in stats.items() if key.startswith("copy:"))
+        logger.info("%i files written to %r%s, %i missing, %i failed",
+                    copied, self.args.materialize,
+                    " ({})".format(methods) if methods else "",
+                    stats["missing"], stats["failed"])
+        if stats["missing"] or stats["failed"]:
+            return 1
+        return 0
+
+    def rescan_external(self):
+        rescanner = ExternalRescanner(self, self.args.rescan_external, jobs=self.args.jobs)
+        stats = rescanner.rescan()
+        logger.info("%i files unchanged, %i verified, %i modified, %i relocated,"
+                    " %i missing, %i failed",
+                    stats["unchanged"], stats["verified"], stats["modified"],
+                    stats["relocated"], stats["missing"], stats["failed"])
+        if stats["missing"] or stats["failed"]:
             return 1
+        return 0
+
+    def search(self):
+        query = SearchQuery.from_string(self.args.search)
+        if self.args.tags:
+            query.add_conditions(TagRequireQuery(tag) for tag in self.args.tags)
+        fields = list(self.args.fields)
+        if self.args.with_path and PATH_FIELD not in fields:
+            fields.append(PATH_FIELD)
+        with_path = PATH_FIELD in fields
+        writer = ItemWriter.for_format(self.args.output_format, sys.stdout, fields)
+        count = 0
+        try:
+            writer.write_header()
+            for metadata in self.library.iter_items(query, limit=self.args.limit):
+                if with_path:
+                    path = self.library.get_item_path(metadata)
+                else:
+                    path = None
+                writer.write_item(metadata, path)
+                count += 1
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # output consumer went away (e.g. '| head'), not an error
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return 0
+        logger.debug("%i items written", count)
+        return 0
+
+    def dump(self):
+        dumper = LibraryDumper(self.library)
+        stream = open_dump_file(self.args.dump, "w")
+        try:
+            dumper.dump(stream)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        return 0
 
+    def restore(self):
+        dumper = LibraryDumper(self.library)
+        stream = open_dump_file(self.args.restore, "r")
+        try:
+            dumper.restore(stream)
+        except LibraryError as err:
+            logger.error("Cannot restore %r: %s", self.args.restore, err)
+            return 1
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
         return 0
 
     def import_file(self, metadata_rules, path, root):
+        """Analyze a file and queue it for import.
+
+        Analysis results of unchanged files are taken from the import
+        journal and files already imported are skipped."""
         try:
-            metadata = self.analyzer.get_file_metadata(path)
-        except (OSError, RuntimeError) as err:
+            signature = file_signature(path)
+        except OSError as err:
             logger.warning("Cannot import %r: %s", path, err)
+            self.import_stats["failed"] += 1
             return False
+        entry = self.import_journal.get(path, signature)
+        if entry is not None and entry.state == COMMITTED and entry.metadata:
+            md5 = entry.metadata.get("_md5")
+            if md5 and self.library.find_md5s([md5]):
+                logger.debug("%r already imported", path)
+                self.import_stats["skipped"] += 1
+                return True
+        if entry is not None and entry.metadata:
+            logger.debug("Using analysis results for %r from the import journal", path)
+            metadata = Metadata(entry.metadata)
+            copied = entry.state == COPIED
+        else:
+            try:
+                metadata = self.analyzer.get_file_metadata(path)
+            except (OSError, RuntimeError) as err:
+                logger.warning("Cannot import %r: %s", path, err)
+                self.import_stats["failed"] += 1
+                return False
+            self.import_journal.record(path, signature, ANALYZED,
+                                       {key: metadata[key] for key in metadata})
+            copied = False
         logger.debug(metadata)
-        metadata = metadata.rewrite(metadata_rules, root=root)
+        metadata = metadata_rules.apply(metadata, root=root)
         if self.args.tags:
             metadata.add_tags(self.args.tags)
         for key, value in self.args.metadata:
             metadata[key] = value
-        try:
-            self.library.import_file(metadata, copy=self.args.copy)
-        except LibraryConflictError as err:
-            logger.info("File %r (%r) already in the library, known as %r."
-                        " Ignoring it.", path, err.md5, err.existing_name)
-            return False
+        self.import_batch.append((path, signature, metadata, copied))
+        if len(self.import_batch) >= self.import_batch_size:
+            self.flush_import_batch()
         return True
 
+    def flush_import_batch(self):
+        """Import the queued files in one transaction."""
+        batch = self.import_batch
+        self.import_batch = []
+        if not batch:
+            return
+        journal = self.import_journal
+
+        def on_copied(i, method):
+            path, signature = batch[i][:2]
+            journal.record(path, signature, COPIED)
+
+        results = self.library.import_files([item[2] for item in batch],
+                                            copy=self.args.copy,
+                                            copied=[i for i, item in enumerate(batch) if item[3]],
+                                            on_copied=on_copied)
+        for (path, signature, metadata, copied), result in zip(batch, results):
+            if isinstance(result, LibraryConflictError):
+                logger.info("File %r (%r) already in the library, known as %r."
+                            " Ignoring it.", path, result.md5, result.existing_name)
+                self.import_stats["skipped"] += 1
+            elif isinstance(result, OSError):
+                logger.error("Cannot copy %r to the library: %s", path, result)
+                self.import_stats["failed"] += 1
+                continue
+            else:
+                self.import_stats["imported"] += 1
+                if result:
+                    self.import_stats["copy:" + result] += 1
+            journal.record(path, signature, COMMITTED)
+
     def import_dir(self, metadata_rules, path):
         if self.args.root:
             root = self.args.root
@@ -205,19 +447,106 @@ class Application:
                 self.import_file(metadata_rules, file_path, root)
 
     def import_files(self, metadata_rules=None):
+        """Import files and directories given on the command line.
+
+        Progress is recorded in the import journal, so an interrupted
+        import continues where it stopped when run again. The journal is
+        removed when an import completes."""
         if metadata_rules is None:
             metadata_rules = self.config["rewrite_rules"]["default"]["rules"]
-        for path in self.args.import_files:
-            if os.path.isdir(path):
-                self.import_dir(metadata_rules, path)
+        metadata_rules = RewriteRules(metadata_rules)
+        self.import_stats.clear()
+        self.import_journal = ImportJournal(os.path.join(self.library.base_path,
+                                                         IMPORT_JOURNAL_FILENAME))
+        self.import_journal.load()
+        if self.import_journal.entries:
+            logger.info("Resuming interrupted import, %i files in the journal",
+                        len(self.import_journal.entries))
+        self.import_batch = []
+        try:
+            for path in self.args.import_files:
+                if os.path.isdir(path):
+                    self.import_dir(metadata_rules, path)
+                else:
+                    self.import_file(metadata_rules, path, root=self.args.root)
+            self.flush_import_batch()
+        except BaseException:
+            self.import_journal.close()
+            raise
+        finally:
+            self.log_import_stats()
+        self.import_journal.remove()
+
+    def watch(self):
+        """Import new and changed files from the watched folders until interrupted.
+
+        Files already imported are remembered in the watch journal, so
+        they are not analyzed again after a restart."""
+        config = self.config["watch"]
+        folders = [os.path.abspath(path) for path in self.args.watch or config["folders"]]
+        if not folders:
+            logger.error("No folders to watch")
+            return 1
+        metadata_rules = RewriteRules(self.config["rewrite_rules"][config["rules"]]["rules"])
+        self.import_journal = ImportJournal(os.path.join(self.library.base_path,
+                                                         WATCH_JOURNAL_FILENAME))
+        self.import_journal.load()
+        self.import_journal.compact()
+        self.import_batch_size = config["batch_size"]
+        watcher = FolderWatcher(folders,
+                                debounce=config["debounce"],
+                                scan_interval=config["scan_interval"])
+        try:
+            paths = watcher.start()
+            logger.info("Watching %s", ", ".join(repr(path) for path in folders))
+            while True:
+                self._import_watched(metadata_rules, folders, paths)
+                paths = watcher.wait()
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finally:
+            watcher.close()
+            self.import_journal.close()
+        return 0
+
+    def _import_watched(self, metadata_rules, folders, paths):
+        self.import_stats.clear()
+        for path in paths:
+            if self.args.root:
+                root = self.args.root
             else:
-                self.import_file(metadata_rules, path, root=self.args.root)
+                # the innermost watched folder
+                root = max((folder for folder in folders
+                            if path.startswith(folder.rstrip(os.sep) + os.sep)),
+                           key=len, default=os.path.dirname(path))
+            self.import_file(metadata_rules, path, root)
+        self.flush_import_batch()
+        if self.import_stats["imported"] or self.import_stats["failed"]:
+            self.log_import_stats()
+
+    def log_import_stats(self):
+        logger.info("%s", format_import_stats(self.import_stats))
 
     def start(self):
         if self.args.import_files:
             return self.import_files()
+        if self.args.watch is not None:
+            return self.watch()
         if self.args.check_db:
             return self.check_db()
+        if self.args.rescan_external is not None:
+            return self.rescan_external()
+        if self.args.materialize:
+            return self.materialize()
+        if self.args.search is not None:
+            return self.search()
+        if self.args.dump:
+            return self.dump()
+        if self.args.restore:
+            return self.restore()
+
+        # imported here, so the command line modes work without Qt
+        from .gui.app import GUIApplication
 
         self.gui = GUIApplication(self)
         try:
@@ -1,9 +1,12 @@
 
+import functools
 import logging
 import os
 import re
+import string
+import sys
 
-from collections import namedtuple, defaultdict
+from collections import namedtuple
 
 MDType = namedtuple("MDType",
                     "name type editable unit indexable",
@@ -24,42 +27,92 @@ FIXED_METADATA = [
 ]
 FIXED_METADATA_D = {mdtype.name: mdtype for mdtype in FIXED_METADATA}
 FIXED_METADATA_KEYS = {"_" + mdtype.name: mdtype for mdtype in FIXED_METADATA}
+FIXED_INDEX = {"_" + mdtype.name: i for i, mdtype in enumerate(FIXED_METADATA)}
 
 VALID_KEY_RE = re.compile(r"^[^\W_][\w -]+$")
 VALID_TAG_RE = re.compile(r"^((/[\w-]+)*/)?[\w-]+$")
 
 INVALID_TAG_CHAR = re.compile(r"[^\w/-]")
 
+SIMPLE_FIELD_RE = re.compile(r"^(\d+|[^\W\d]\w*)$")
+
+SENTINEL = object()
+
 logger = logging.getLogger("metadata")
 
 
 class Metadata:
+    """Item meta-data: fixed fields, custom key-value pairs and tags.
+
+    Fixed field values are kept in a list in the FIXED_METADATA order (None
+    when not set), custom values in a dict (None when there are none) and
+    tags as a tuple of interned strings, so objects for large result sets
+    take little memory."""
+    __slots__ = ("_fixed", "_custom", "_tags")
+
     def __init__(self, data=None, tags=None):
-        object.__setattr__(self, "_data", {})
-        object.__setattr__(self, "_tags", set())
+        fixed = [None] * len(FIXED_METADATA)
+        custom = None
         if data is not None:
             for key, value in data.items():
-                mdtype = FIXED_METADATA_KEYS.get(key)
-                if mdtype:
+                index = FIXED_INDEX.get(key)
+                if index is not None:
                     if value is not None:
                         try:
-                            value = mdtype.type(value)
-                            self._data[key] = value
+                            fixed[index] = FIXED_METADATA[index].type(value)
                         except (ValueError, TypeError):
                             logging.warning("Invalid %r: %r", key, data[key])
                 elif not VALID_KEY_RE.match(key):
                     logger.warning("Invalid meta-data key: %r", key)
                 else:
-                    self._data[key] = value
-        if tags is not None:
-            for tag in tags:
-                if not VALID_TAG_RE.match(tag):
-                    logger.warning("Invalid tag: %r", key)
-                else:
-                    self._tags.add(tag)
+                    if custom is None:
+                        custom = {}
+                    custom[key] = value
+        self._fixed = fixed
+        self._custom = custom
+        if tags:
+            self._tags = tuple(set(self._valid_tags(tags)))
+        else:
+            self._tags = ()
+
+    @classmethod
+    def trusted(cls, data=None, tags=None):
+        """Create object from data known to be valid, e.g. read from the
+        library database.
+
+        Keys, values and tags are not checked, tags must not repeat."""
+        if not data:
+            return cls._from_parts([None] * len(FIXED_METADATA), None, tags)
+        fixed = list(map(data.get, FIXED_INDEX))
+        if data.keys() <= FIXED_INDEX.keys():
+            custom = None
+        else:
+            custom = {key: value for key, value in data.items() if key not in FIXED_INDEX}
+        return cls._from_parts(fixed, custom, tags)
+
+    @classmethod
+    def _from_parts(cls, fixed, custom, tags):
+        """Create object from the internal representation, taking ownership
+        of the `fixed` list and the `custom` dict. Tags must not repeat."""
+        self = object.__new__(cls)
+        self._fixed = fixed
+        self._custom = custom or None
+        if tags:
+            self._tags = tuple(map(sys.intern, tags))
+        else:
+            self._tags = ()
+        return self
+
+    def _as_dict(self):
+        result = {key: value
+                  for key, value in zip(FIXED_INDEX, self._fixed)
+                  if value is not None}
+        if self._custom:
+            result.update(self._custom)
+        return result
 
     def __repr__(self):
-        return "Metadata({!r}, {!r})".format(self._data, self._tags)
+        return "Metadata({!r}, {!r})".format(self._as_dict(), set(self._tags))
 
     @classmethod
     def from_file_info(cls, file_info):
@@ -68,66 +121,63 @@ class Metadata:
         return cls(data)
 
     def copy(self):
-        return self.__class__(self._data, self._tags)
+        custom = dict(self._custom) if self._custom else None
+        return self._from_parts(list(self._fixed), custom, self._tags)
 
     def get_tags(self):
         return set(self._tags)
 
-    def set_tags(self, tags):
-        new_tags = set()
+    @staticmethod
+    def _valid_tags(tags):
+        result = []
         for tag in tags:
             if not VALID_TAG_RE.match(tag):
                 logger.warning("Invalid tag: %r", tag)
             else:
-                new_tags.add(tag)
-        object.__setattr__(self, "_tags", new_tags)
+                result.append(sys.intern(tag))
+        return result
+
+    def set_tags(self, tags):
+        self._tags = tuple(set(self._valid_tags(tags)))
 
     def add_tags(self, tags):
-        for tag in tags:
-            if not VALID_TAG_RE.match(tag):
-                logger.warning("Invalid tag: %r", tag)
-            else:
-                self._tags.add(tag)
+        new_tags = set(self._valid_tags(tags)).difference(self._tags)
+        if new_tags:
+            self._tags += tuple(new_tags)
 
     def remove_tags(self, tags):
-        for tag in tags:
-            if not VALID_TAG_RE.match(tag):
-                logger.warning("Invalid tag: %r", tag)
-            else:
-                self._tags.discard(tag)
+        removed = set(self._valid_tags(tags))
+        self._tags = tuple(tag for tag in self._tags if tag not in removed)
 
     def __getattr__(self, key):
-        if key in FIXED_METADATA_D:
-            return self._data.get("_" + key)
-
+        # fixed fields are properties, see below
         raise KeyError(key)
 
-    def __setattr__(self, key, value):
-        mdtype = FIXED_METADATA_D.get(key)
-        if mdtype:
-            key = "_" + key
-            if value is None:
-                try:
-                    del self._data[key]
-                except KeyError:
-                    pass
-            else:
-                self._data[key] = mdtype.type(value)
-        else:
-            raise AttributeError("Cannot set {!r}".format(key))
-
     def __iter__(self):
-        return iter(self._data)
+        for key, value in zip(FIXED_INDEX, self._fixed):
+            if value is not None:
+                yield key
+        if self._custom:
+            yield from self._custom
 
     def __len__(self):
-        return len(self._data)
+        count = len(self._fixed) - self._fixed.count(None)
+        if self._custom:
+            count += len(self._custom)
+        return count
 
     def get(self, key, default=None):
-        return self._data.get(key, default)
+        index = FIXED_INDEX.get(key)
+        if index is not None:
+            value = self._fixed[index]
+            return default if value is None else value
+        elif self._custom:
+            return self._custom.get(key, default)
+        return default
 
     def get_formatted(self, key, default=None):
         mdtype = FIXED_METADATA_KEYS.get(key)
-        value = self._data.get(key, default)
+        value = self.get(key, default)
         if value is None:
             value = ""
         else:
@@ -143,20 +193,28 @@ class Metadata:
         return key, value
 
     def __getitem__(self, key):
-        return self._data[key]
+        value = self.get(key, SENTINEL)
+        if value is SENTINEL:
+            raise KeyError(key)
+        return value
 
     def __setitem__(self, key, value):
-        mdtype = FIXED_METADATA_KEYS.get(key)
-        if mdtype:
+        index = FIXED_INDEX.get(key)
+        if index is not None:
             if value is not None:
-                value = mdtype.type(value)
+                value = FIXED_METADATA[index].type(value)
+            logger.debug("setting %r to %r", key, value)
+            self._fixed[index] = value
+            return
         elif not VALID_KEY_RE.match(key):
             raise ValueError("Invalid meta-data key: {!r}".format(key))
         logger.debug("setting %r to %r", key, value)
-        self._data[key] = value
+        if self._custom is None:
+            self._custom = {}
+        self._custom[key] = value
 
     def __contains__(self, key):
-        return key in self._data
+        return self.get(key, SENTINEL) is not SENTINEL
 
     def rewrite(self, rules, root=None):
         """Return copy rewriten using given rules.
@@ -165,64 +223,206 @@ class Metadata:
         Regexp is applied to the value of a given field and if it matches, then
         metadata fields will be changed according to substitutions, which
         are mapping from field name to .format() string, that uses regexp groups
-        and current metadata values."""
-        data = dict(self._data)
-        data["_tags"] = " ".join(self._tags)
-        if root:
-            logger.debug("Root %r given, auto-generating category", root)
-            root = os.path.normpath(root)
-            directory = os.path.dirname(self.path)
-            if os.path.commonpath([directory, root]) == root:
-                relpath = os.path.relpath(directory, root)
-                if relpath == ".":
-                    logger.debug("no category in path")
-                else:
-                    if os.path.sep != "/":
-                        relpath = relpath.replace(os.path.sep, "/")
-                    category = INVALID_TAG_CHAR.sub("_", relpath)
-                    data["_auto_category"] = "/" + category
+        and current metadata values.
+
+        `rules` may also be a RewriteRules object, which is faster when the
+        same rules are applied many times."""
+        if not isinstance(rules, RewriteRules):
+            rules = RewriteRules(rules)
+        return rules.apply(self, root=root)
+
+
+def _fixed_field(index):
+    mdtype = FIXED_METADATA[index]
+
+    def getter(self):
+        return self._fixed[index]
+
+    def setter(self, value):
+        if value is not None:
+            value = mdtype.type(value)
+        self._fixed[index] = value
+
+    return property(getter, setter, doc=mdtype.name)
+
+
+for _index, _mdtype in enumerate(FIXED_METADATA):
+    setattr(Metadata, _mdtype.name, _fixed_field(_index))
+
+
+class _Template:
+    """Compiled substitution pattern.
+
+    Patterns using only plain positional or named fields (like "{2}" or
+    "{_tags} {0}") are split once into literals and field references.
+    Anything else is formatted with str.format() as is."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.parts = []
+        self.fields = set()
+        try:
+            parsed = list(string.Formatter().parse(pattern))
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            self.parts = None
+            return
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                self.parts.append((None, literal))
+            if field is None:
+                continue
+            if spec or conversion or not SIMPLE_FIELD_RE.match(field):
+                # attribute access, format specification, auto-numbering…
+                self.parts = None
+                return
+            if field.isdigit():
+                self.parts.append((int(field), None))
             else:
-                logger.debug("%r not under %r", self.path, root)
+                self.parts.append((field, None))
+                self.fields.add(field)
+
+    def format(self, groups, groupdict, data):
+        if self.parts is None:
+            format_dict = dict(data)
+            format_dict.update(groupdict)
+            return self.pattern.format(*groups, **format_dict)
+        result = []
+        for field, literal in self.parts:
+            if field is None:
+                result.append(literal)
+            elif field.__class__ is int:
+                result.append(str(groups[field]))
+            else:
+                value = groupdict.get(field, SENTINEL)
+                if value is SENTINEL:
+                    value = data[field]
+                result.append(value if value.__class__ is str else str(value))
+        return "".join(result)
+
+
+class RewriteRules:
+    """Rewrite rules compiled for repeated use.
+
+    Regular expressions and substitution patterns are compiled and target
+    fields checked once, when the object is created, so applying the rules
+    to many files (see `apply_all()`) costs little more than the regexp
+    matching itself. See Metadata.rewrite() for the rule format."""
+
+    def __init__(self, rules):
+        self.rules = []
+        self._invalid_keys = set()
+        used_fields = set()
+        opaque = False
         for key, regexp, substs in rules:
-            value = data.get(key)
-            if value is None:
-                logging.debug("Ignoring rewrite rule for %r – no value", key)
-                continue
-            logging.debug("Applying %r to %r=%r", regexp, key, value)
             if isinstance(regexp, str):
                 regexp = re.compile(regexp)
-            if not isinstance(value, str):
-                value = str(value)
-            match = regexp.match(value)
-            if not match:
-                logging.debug("no match")
-                continue
-            format_list = [match.group(0)] + list(match.groups())
-            format_dict = defaultdict(lambda: "", data)
-            format_dict.update(match.groupdict())
+            used_fields.add(key)
+            targets = []
             for target, pattern in substs.items():
                 mdtype = FIXED_METADATA_KEYS.get(target)
                 if mdtype:
                     if not mdtype.editable:
-                        logging.warning("%r is not editable, not substituting", target)
+                        logger.warning("%r is not editable, not substituting", target)
                         continue
-                logging.debug("setting %r with pattern %r (%r, %r)",
-                              target, pattern, format_list, format_dict)
+                elif target == "_tags":
+                    used_fields.add(target)
+                elif (target != "_auto_category"
+                        and not VALID_KEY_RE.match(target)):
+                    # may be used by the following rules, but not stored
+                    logger.warning("Invalid meta-data key: %r", target)
+                    self._invalid_keys.add(target)
+                template = _Template(pattern)
+                if template.parts is None:
+                    opaque = True
+                used_fields |= template.fields
+                targets.append((target, template, mdtype))
+            self.rules.append((key, regexp, targets))
+        # skip preparing values no rule would look at
+        self._need_tags = opaque or "_tags" in used_fields
+        self._need_category = opaque or "_auto_category" in used_fields
+
+    def __len__(self):
+        return len(self.rules)
+
+    def apply(self, metadata, root=None):
+        """Return a rewritten copy of a Metadata object."""
+        if root:
+            root = os.path.normpath(root)
+        return self._apply(metadata, root)
+
+    def apply_all(self, metadata_iter, root=None):
+        """Rewrite many Metadata objects, yield the results."""
+        if root:
+            root = os.path.normpath(root)
+        for metadata in metadata_iter:
+            yield self._apply(metadata, root)
+
+    def _apply(self, metadata, root):
+        data = metadata._as_dict()
+        if self._need_tags:
+            data["_tags"] = " ".join(metadata._tags)
+        if root and self._need_category:
+            category = self._auto_category(metadata.path, root)
+            if category:
+                data["_auto_category"] = category
+        for key, regexp, targets in self.rules:
+            value = data.get(key)
+            if value is None:
+                continue
+            if value.__class__ is not str:
+                value = str(value)
+            match = regexp.match(value)
+            if not match:
+                continue
+            groups = (match.group(0),) + match.groups()
+            groupdict = match.groupdict()
+            for target, template, mdtype in targets:
                 try:
-                    new_value = pattern.format(*format_list, **format_dict)
+                    new_value = template.format(groups, groupdict, data)
                 except KeyError as err:
-                    logging.warning("%r substitution failed: key not found: %r",
-                                    pattern, str(err))
+                    logger.warning("%r substitution failed: key not found: %r",
+                                   template.pattern, str(err))
                     continue
                 except (IndexError, ValueError, TypeError) as err:
-                    logging.warning("%r substitution failed: %s", pattern, err)
+                    logger.warning("%r substitution failed: %s", template.pattern, err)
                     continue
-                logging.debug("new value: %r", new_value)
                 data[target] = new_value
-        try:
-            del data["_auto_category"]
-        except KeyError:
-            pass
-        tags = data["_tags"].split()
-        del data["_tags"]
-        return self.__class__(data, tags)
+        data.pop("_auto_category", None)
+        for key in self._invalid_keys:
+            data.pop(key, None)
+        if self._need_tags:
+            tags = set()
+            for tag in data.pop("_tags").split():
+                if tag in metadata._tags or VALID_TAG_RE.match(tag):
+                    tags.add(tag)
+                else:
+                    logger.warning("Invalid tag: %r", tag)
+        else:
+            tags = metadata._tags
+        name = data.get("_name")
+        if name is not None and name.__class__ is not str:
+            data["_name"] = str(name)
+        return metadata.trusted(data, tags)
+
+    @staticmethod
+    def _auto_category(path, root):
+        if path is None:
+            return None
+        return _dir_category(os.path.dirname(path), root)
+
+
+@functools.lru_cache(maxsize=1024)
+def _dir_category(directory, root):
+    """Category tag for files in `directory` imported from `root`."""
+    directory = os.path.normpath(directory)
+    if directory == root:
+        return None
+    prefix = root if root.endswith(os.path.sep) else root + os.path.sep
+    if not directory.startswith(prefix):
+        return None
+    relpath = directory[len(prefix):]
+    if os.path.sep != "/":
+        relpath = relpath.replace(os.path.sep, "/")
+    return "/" + INVALID_TAG_CHAR.sub("_", relpath)
@@ -24,6 +24,14 @@ CREATE TABLE items (
         peak_level FLOAT
 );
 
+-- state of library files, as seen by the last verification
+CREATE TABLE item_files (
+	item_id INTEGER PRIMARY KEY REFERENCES items(id) ON DELETE CASCADE,
+	size INTEGER,
+	mtime_ns INTEGER,
+	verified_at FLOAT -- time of the last successful content verification
+);
+
 CREATE TABLE tags (
 	id INTEGER PRIMARY KEY,
 	name TEXT COLLATE NOCASE NOT NULL UNIQUE,
@@ -0,0 +1,10 @@
+-- version 0 -> 1
+
+CREATE TABLE item_files (
+	item_id INTEGER PRIMARY KEY REFERENCES items(id) ON DELETE CASCADE,
+	size INTEGER,
+	mtime_ns INTEGER,
+	verified_at FLOAT -- time of the last successful content verification
+);
+
+UPDATE db_meta SET version = '1' WHERE id = 1;
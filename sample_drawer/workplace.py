@@ -1,14 +1,23 @@
 
+import itertools
 import os
 import logging
-import shutil
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-from .metadata import FIXED_METADATA
+from .file_copy import copy_file
+from .library import IMPORT_COPY_THREADS, SQL_PARAMS_LIMIT
 from .search import SearchQuery
 
 logger = logging.getLogger("workplace")
 
+# threads resolving and copying files in materialize()
+MATERIALIZE_THREADS = 8
+
+# makes temporary file names unique
+_import_counter = itertools.count()
+
 
 class WorkplaceError(Exception):
     def __str__(self):
@@ -50,19 +59,27 @@ class Workplace:
 
     def get_item_path(self, metadata):
         logger.debug("get_item_path(%r)", metadata)
+        return self._resolve_path(metadata, os.path.exists)
+
+    def _resolve_path(self, metadata, local_exists):
+        """Find the file of a workplace item.
+
+        That is the workplace file, the library file or the source file,
+        whichever is found first. `local_exists` checks if a path in the
+        workplace directory exists."""
         if metadata.path:
             if os.path.isabs(metadata.path):
                 local_path = metadata.path
+                if os.path.exists(local_path):
+                    return local_path
             else:
                 local_path = os.path.join(self.base_path, metadata.path)
-            if os.path.exists(local_path):
-                return local_path
+                if local_exists(local_path):
+                    return local_path
         else:
             local_path = None
 
-        tmp_metadata = metadata.copy()
-        tmp_metadata.path = None
-        path = self.library.get_item_path(tmp_metadata)
+        path = self.library.get_storage_path(metadata)
         if os.path.exists(path):
             return path
 
@@ -72,25 +89,111 @@ class Workplace:
 
         return local_path
 
+    def resolve_paths(self, items, jobs=MATERIALIZE_THREADS):
+        """Find files of many workplace items, return list of their paths.
+
+        The workplace directory is listed once, instead of checking each
+        file, and the library files are looked up in `jobs` threads."""
+        local_files = set()
+        for dirpath, dirnames, filenames in os.walk(self.base_path):
+            local_files.update(os.path.join(dirpath, filename) for filename in filenames)
+
+        def resolve(metadata):
+            return self._resolve_path(metadata, local_files.__contains__)
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            return list(executor.map(resolve, items))
+
+    def materialize(self, target_dir, items=None, methods=None, jobs=MATERIALIZE_THREADS):
+        """Create a real folder tree of the workplace items in `target_dir`.
+
+        All the item files are resolved first, then the directories
+        created and the files copied by `jobs` threads, with the library
+        copy methods (or `methods`), so hard links or reflinks are used
+        where allowed and possible. Existing files are replaced.
+
+        Returns a Counter with the number of files copied with each method
+        ('copy:<method>'), 'missing' and 'failed'."""
+        if items is None:
+            items = list(self.iter_items())
+        if methods is None:
+            methods = self.library.copy_methods
+        target_dir = os.path.abspath(target_dir)
+        stats = Counter()
+        to_copy = []
+        for metadata, source in zip(items, self.resolve_paths(items, jobs)):
+            normpath = os.path.normpath(metadata.path)
+            if os.path.isabs(normpath) or normpath.startswith(".."):
+                logger.warning("%r not in the workplace, skipping", metadata.path)
+                stats["failed"] += 1
+                continue
+            if source is None:
+                logger.warning("No file for %r", metadata.path)
+                stats["missing"] += 1
+                continue
+            to_copy.append((source, os.path.join(target_dir, normpath)))
+        for directory in sorted(set(os.path.dirname(target) for source, target in to_copy)):
+            os.makedirs(directory, exist_ok=True)
+
+        def copy(source, target):
+            # could be a hard link to a library file, must not be overwritten
+            try:
+                os.unlink(target)
+            except FileNotFoundError:
+                pass
+            return copy_file(source, target, methods)
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [executor.submit(copy, source, target) for source, target in to_copy]
+            for (source, target), future in zip(to_copy, futures):
+                try:
+                    stats["copy:" + future.result()] += 1
+                except FileNotFoundError:
+                    logger.warning("%r missing", source)
+                    stats["missing"] += 1
+                except OSError as err:
+                    logger.error("Cannot copy %r to %r: %s", source, target, err)
+                    stats["failed"] += 1
+        return stats
+
     def delete_item(self, metadata):
-        path = metadata.path
-        if os.path.isabs(path):
+        if os.path.isabs(metadata.path):
             return False
+        self.delete_items([metadata])
+        return None
+
+    def delete_items(self, items):
+        """Remove items from the workplace, in a single transaction.
+
+        Items with absolute paths (not in the workplace directory) are
+        ignored. Returns number of items removed from the database."""
+        paths = []
+        for metadata in items:
+            path = metadata.path
+            if os.path.isabs(path):
+                logger.debug("not removing %r – not a workplace item", path)
+                continue
+            paths.append(path)
+        removed = 0
         with self.library.db:
             cur = self.library.db.cursor()
-            cur.execute("DELETE FROM items"
-                        " WHERE path=? AND workplace_id=?",
-                        (path, self.id))
-            if not cur.rowcount:
-                logger.warning("Could not remove %r from workplace database",
-                               path)
-            else:
-                logger.debug("Removed %r from database: %i rows",
-                             path, cur.rowcount)
+            for start in range(0, len(paths), SQL_PARAMS_LIMIT):
+                chunk = paths[start:start + SQL_PARAMS_LIMIT]
+                cur.execute("DELETE FROM items WHERE workplace_id=? AND path IN ({})"
+                            .format(", ".join(["?"] * len(chunk))),
+                            [self.id] + chunk)
+                removed += cur.rowcount
+        if removed != len(paths):
+            logger.warning("Only %i of %i items removed from the workplace database",
+                           removed, len(paths))
+        else:
+            logger.debug("Removed %i items from database", removed)
+        for path in paths:
             normpath = os.path.normpath(path)
             if normpath.startswith("/") or normpath.startswith("../"):
                 logger.warning("refusing to remove %r – not in the workplace",
                                path)
+                continue
             full_path = os.path.join(self.base_path, path)
             try:
                 os.unlink(full_path)
@@ -99,107 +202,175 @@ class Workplace:
                 logger.debug("Not removed %r: %s", full_path, err)
             except OSError as err:
                 logger.warning("Could not remove %r: %s", full_path, err)
+        return removed
 
     def import_file(self, metadata, copy=False, folder="", name=None):
-        orig_path = metadata.path
-        if not metadata.md5 or not orig_path:
-            raise ValueError("md5 and path are required for file import")
-        if name is None:
-            name = metadata.name
-            if not metadata.name:
-                name = os.path.basename(orig_path).rsplit(".", 1)[0]
-        source = "file:{}".format(orig_path)
-        with self.library.db:
-            path = self._import_item(source, metadata, folder, name)
-            if copy:
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                shutil.copy(orig_path, path)
+        """Add a file to the workplace, return the new workplace item."""
+        result = self.import_files([metadata], copy, folder, [name])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def import_files(self, items, copy=False, folder="", names=None):
+        """Add files to the workplace folder, in a single transaction.
+
+        `names` are the item names to use (None for default) for each item.
+        Returns a list with the new workplace item or the exception which
+        prevented the import (WorkplaceConflictError or OSError) for each
+        of `items`."""
+        if names is None:
+            names = [None] * len(items)
+        to_import = []
+        for metadata, name in zip(items, names):
+            orig_path = metadata.path
+            if not metadata.md5 or not orig_path:
+                raise ValueError("md5 and path are required for file import")
+            if name is None:
+                name = metadata.name
+                if not metadata.name:
+                    name = os.path.basename(orig_path).rsplit(".", 1)[0]
+            source = "file:{}".format(orig_path)
+            to_import.append((source, metadata, name, orig_path if copy else None))
+        return self._import_items(to_import, folder)
 
     def import_item(self, metadata, copy=False, folder="", name=None):
-        if not metadata.md5:
-            raise ValueError("md5 is required for lib item import")
-        if name is None:
-            name = metadata.name
-        source = "lib:{}".format(metadata.md5)
-        with self.library.db:
-            path = self._import_item(source, metadata, folder, name)
+        """Add a library item to the workplace, return the new workplace item."""
+        result = self.import_items([metadata], copy, folder, [name])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def import_items(self, items, copy=False, folder="", names=None):
+        """Add library items to the workplace folder, in a single transaction.
+
+        Returns a list with the new workplace item or the exception which
+        prevented the import (WorkplaceConflictError or OSError) for each
+        of `items`."""
+        if names is None:
+            names = [None] * len(items)
+        to_import = []
+        for metadata, name in zip(items, names):
+            if not metadata.md5:
+                raise ValueError("md5 is required for lib item import")
+            if name is None:
+                name = metadata.name
+            source = "lib:{}".format(metadata.md5)
             if copy:
-                os.makedirs(os.path.dirname(path), exist_ok=True)
-                shutil.copy(self.library.get_item_path(metadata),
-                            path)
+                copy_from = self.library.get_item_path(metadata)
+            else:
+                copy_from = None
+            to_import.append((source, metadata, name, copy_from))
+        return self._import_items(to_import, folder)
 
-    def _import_item(self, source, metadata, folder="", name=None):
-        if metadata.format:
-            filename = "{}.{}".format(name, metadata.format.lower())
-        else:
-            filename = "{}.bin".format(name)
-        path = os.path.join(folder, filename)
-        cur = self.library.db.cursor()
-        cur.execute("SELECT id, name, md5"
-                    " FROM items"
-                    " WHERE path=? AND workplace_id=?"
-                    " LIMIT 1", (path, self.id))
-        row = cur.fetchone()
-        if row is not None:
-            raise WorkplaceConflictError("Already there", path, row[1])
-        metadata = metadata.copy()
-        metadata.path = path
-        metadata.name = name
-        metadata.source = source
-        query = "INSERT INTO items(workplace_id,{}) VALUES ({})".format(
-                ", ".join(mdtype.name for mdtype in FIXED_METADATA),
-                ", ".join(["?"] * (len(FIXED_METADATA) + 1)))
-        values = [self.id] + [getattr(metadata, mdtype.name)
-                              for mdtype in FIXED_METADATA]
-        logging.debug("running: %r with %r", query, values)
-        cur.execute(query, values)
-        item_id = cur.lastrowid
-        logging.debug("item inserted with id: %r", item_id)
-        tags = metadata.get_tags()
-
-        # add missing parent tags
-        # as  /a/b/c implies /a/b and /a
-        for tag in list(tags):
-            if tag.startswith("/"):
-                parent = tag.rsplit("/", 1)[0]
-                while parent:
-                    tags.add(parent)
-                    parent = parent.rsplit("/", 1)[0]
-
-        for tag in tags:
-            cur.execute("SELECT id FROM tags WHERE name=?", (tag,))
-            row = cur.fetchone()
-            if row:
-                tag_id = row[0]
+    def _import_items(self, to_import, folder):
+        """Insert (source, metadata, name, copy_from) items into the database.
+
+        Files are copied from `copy_from` paths, when given, before the
+        database transaction, like in Library.import_files(): to temporary
+        names, renamed after the commit only for the items inserted."""
+        results = [None] * len(to_import)
+        items = []
+        for source, metadata, name, copy_from in to_import:
+            if metadata.format:
+                filename = "{}.{}".format(name, metadata.format.lower())
             else:
-                cur.execute("INSERT INTO tags(name) VALUES(?)", (tag,))
-                tag_id = cur.lastrowid
-            cur.execute("INSERT INTO item_tags(item_id, tag_id) VALUES(?, ?)",
-                        (item_id, tag_id))
+                filename = "{}.bin".format(name)
+            metadata = metadata.copy()
+            metadata.path = os.path.join(folder, filename)
+            metadata.name = name
+            metadata.source = source
+            items.append(metadata)
+        existing = self._find_paths([metadata.path for metadata in items],
+                                    self.library.db.cursor())
+        to_insert = []
+        for i, metadata in enumerate(items):
+            path = metadata.path
+            if path in existing:
+                results[i] = WorkplaceConflictError("Already there", path, existing[path])
+            else:
+                # the same path twice in the batch
+                existing[path] = metadata.name
+                to_insert.append(i)
+
+        # item index -> temporary path of the copied file
+        tmp_paths = {}
+
+        def copy_item(i):
+            tmp_paths[i] = self._import_tmp_path(items[i].path)
+            return self.library.copy_file(to_import[i][3], tmp_paths[i])
 
-        for key in metadata:
-            if key.startswith("_"):
+        to_copy = [i for i in to_insert if to_import[i][3]]
+        if to_copy:
+            with ThreadPoolExecutor(max_workers=IMPORT_COPY_THREADS) as executor:
+                futures = [executor.submit(copy_item, i) for i in to_copy]
+                for i, future in zip(to_copy, futures):
+                    try:
+                        future.result()
+                    except OSError as err:
+                        results[i] = err
+                        if i in tmp_paths:
+                            self.library._remove_stray_file(tmp_paths.pop(i))
+            to_insert = [i for i in to_insert if results[i] is None]
+        try:
+            with self.library.db:
+                cur = self.library.db.cursor()
+                # added by someone else in the meantime
+                existing = self._find_paths([items[i].path for i in to_insert], cur)
+                tag_ids = {}
+                key_ids = {}
+                for i in to_insert:
+                    metadata = items[i]
+                    path = metadata.path
+                    if path in existing:
+                        results[i] = WorkplaceConflictError("Already there", path,
+                                                            existing[path])
+                        continue
+                    item_id = self.library._insert_item(cur, metadata, tag_ids, key_ids,
+                                                        workplace_id=self.id)
+                    logging.debug("item inserted with id: %r", item_id)
+                    results[i] = metadata
+        except BaseException:
+            for tmp_path in tmp_paths.values():
+                self.library._remove_stray_file(tmp_path)
+            raise
+        for i, tmp_path in tmp_paths.items():
+            if isinstance(results[i], WorkplaceConflictError):
+                self.library._remove_stray_file(tmp_path)
                 continue
-            value = metadata[key]
-            cur.execute("SELECT id FROM custom_keys WHERE name=?", (key,))
-            row = cur.fetchone()
-            if row:
-                key_id = row[0]
-            else:
-                cur.execute("INSERT INTO custom_keys(name) VALUES(?)", (key,))
-                key_id = cur.lastrowid
-            cur.execute("INSERT INTO item_custom_values(item_id, key_id, value)"
-                        " VALUES(?, ?, ?)",
-                        (item_id, key_id, value))
+            target = os.path.join(self.base_path, items[i].path)
+            try:
+                os.replace(tmp_path, target)
+            except OSError as err:
+                logger.error("Cannot move %r to %r: %s", tmp_path, target, err)
+                self.library._remove_stray_file(tmp_path)
+                results[i] = err
+        return results
+
+    def _import_tmp_path(self, path):
+        """Return a unique temporary path for a file to be stored at `path`.
+
+        In the same directory, so it can be renamed into place."""
+        dir_path, filename = os.path.split(os.path.join(self.base_path, path))
+        return os.path.join(dir_path, ".{}.{}-{}.tmp".format(filename, os.getpid(),
+                                                             next(_import_counter)))
+
+    def _find_paths(self, paths, cur):
+        """Return path → name mapping of workplace items with given paths."""
+        result = {}
+        paths = list(set(paths))
+        for start in range(0, len(paths), SQL_PARAMS_LIMIT):
+            chunk = paths[start:start + SQL_PARAMS_LIMIT]
+            cur.execute("SELECT path, name FROM items WHERE workplace_id=? AND path IN ({})"
+                        .format(", ".join(["?"] * len(chunk))),
+                        [self.id] + chunk)
+            result.update(cur.fetchall())
+        return result
 
     def get_items(self):
+        return list(self.iter_items())
+
+    def iter_items(self):
+        """Yield all the workplace items, ordered by path."""
         query = SearchQuery([])
-        query, params = query.as_sql(workplace_id=self.id)
-        result = []
-        with self.library.db:
-            cur = self.library.db.cursor()
-            logging.debug("running: %r with %r", query, params)
-            cur.execute(query, params)
-            for row in cur.fetchall():
-                result.append(self.library._metadata_from_row(row))
-        return result
+        return self.library.iter_items(query, workplace_id=self.id,
+                                       order_by="item.path", limit=None)
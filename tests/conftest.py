@@ -0,0 +1,99 @@
+
+import hashlib
+import shutil
+import weakref
+
+from unittest.mock import Mock
+
+import pytest
+
+from jajcus.sample_drawer.library import Library
+from jajcus.sample_drawer.metadata import Metadata
+
+# benchmark results, shown in the terminal summary
+BENCHMARK_RESULTS = pytest.StashKey()
+
+
+def pytest_configure(config):
+    config.stash[BENCHMARK_RESULTS] = []
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    results = config.stash[BENCHMARK_RESULTS]
+    if results:
+        terminalreporter.section("benchmark results")
+        for line in results:
+            terminalreporter.write_line(line)
+
+
+@pytest.fixture
+def benchmark_report(request):
+    """Function adding a line to the benchmark results."""
+    return request.config.stash[BENCHMARK_RESULTS].append
+
+
+@pytest.fixture
+def library_factory(request, tmp_path_factory):
+    """Factory of libraries, closed and removed after the test.
+
+    Libraries are opened in `library_factory.base_path`: a new directory,
+    or the 'library' directory of a template from the test data when the
+    test is marked with `library_template(name)`. Another directory may be
+    passed as `base_path`."""
+    marker = request.node.get_closest_marker("library_template")
+    if marker is None:
+        default_path = tmp_path_factory.mktemp("lib", True)
+    else:
+        default_path = request.getfixturevalue("shared_datadir") / marker.args[0] / "library"
+    paths = [default_path]
+    # weak, so tests can check what happens when a library is deleted
+    libraries = weakref.WeakSet()
+
+    def _library_factory(base_path=None):
+        if base_path is None:
+            base_path = default_path
+        elif base_path not in paths:
+            paths.append(base_path)
+        library = Library(Mock(name="appdirs Mock"), base_path=base_path)
+        libraries.add(library)
+        return library
+
+    _library_factory.base_path = default_path
+    yield _library_factory
+
+    for library in list(libraries):
+        library.close()
+    for base_path in paths:
+        if base_path.exists():
+            shutil.rmtree(base_path)
+
+
+@pytest.fixture
+def library(library_factory):
+    return library_factory()
+
+
+@pytest.fixture
+def make_sources(tmp_path):
+    """Factory of small source files with their metadata (MD5 included).
+
+    Files are named 'source<N>.wav', items 'item<N>' (unless `named` is
+    False)."""
+    def _make_sources(count, directory=None, tags=(), named=True):
+        if directory is None:
+            directory = tmp_path
+        items = []
+        for i in range(count):
+            data = b"sample data %i" % i
+            source = directory / "source{}.wav".format(i)
+            source.write_bytes(data)
+            metadata = Metadata({"_md5": hashlib.md5(data).hexdigest(),
+                                 "_path": str(source),
+                                 "_format": "WAV"},
+                                list(tags))
+            if named:
+                metadata.name = "item{}".format(i)
+            items.append(metadata)
+        return items
+
+    return _make_sources
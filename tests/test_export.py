@@ -0,0 +1,52 @@
+
+import io
+import json
+
+import pytest
+
+from jajcus.sample_drawer.export import ItemWriter, parse_fields
+from jajcus.sample_drawer.metadata import Metadata
+
+
+@pytest.fixture
+def metadata():
+    return Metadata({"_name": "kick\tone", "_format": "WAV", "_duration": 0.5,
+                     "genre": "techno"},
+                    ["/drums", "tag1"])
+
+
+def test_parse_fields():
+    assert parse_fields("name,_format, tags,path,Genre") == [
+            "_name", "_format", "tags", "path", "genre"]
+    with pytest.raises(ValueError):
+        parse_fields("_bad_key")
+    with pytest.raises(ValueError):
+        parse_fields(",")
+
+
+def test_jsonl(metadata):
+    stream = io.StringIO()
+    writer = ItemWriter.for_format("jsonl", stream, ["_name", "_duration", "genre", "tags",
+                                                     "_md5", "path"])
+    writer.write_header()
+    writer.write_item(metadata, "/some/path.wav")
+    writer.write_item(metadata)
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0]) == {"_name": "kick\tone", "_duration": 0.5,
+                                    "genre": "techno", "tags": ["/drums", "tag1"],
+                                    "_md5": None, "path": "/some/path.wav"}
+    assert json.loads(lines[1])["path"] is None
+
+
+def test_tsv(metadata):
+    stream = io.StringIO()
+    writer = ItemWriter.for_format("tsv", stream, ["_name", "_duration", "tags", "_md5"])
+    writer.write_header()
+    writer.write_item(metadata)
+    assert stream.getvalue() == "_name\t_duration\ttags\t_md5\nkick\\tone\t0.5\t/drums tag1\t\n"
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        ItemWriter.for_format("xml", io.StringIO(), ["_name"])
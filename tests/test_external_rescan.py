@@ -0,0 +1,60 @@
+
+import hashlib
+import os
+
+from unittest.mock import Mock, patch
+
+from jajcus.sample_drawer import external_rescan
+from jajcus.sample_drawer.external_rescan import ExternalRescanner
+
+
+def _item_paths(library):
+    cur = library.db.execute("SELECT name, path, md5 FROM items")
+    return {name: (path, md5) for name, path, md5 in cur}
+
+
+def test_rescan_external(library, make_sources, tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    items = make_sources(5, source_dir)
+    library.import_files(items, copy=False)
+    app = Mock(library=library)
+
+    stats = ExternalRescanner(app, jobs=1).rescan()
+    assert stats["unchanged"] == 5
+    assert stats["verified"] == stats["modified"] == stats["missing"] == 0
+
+    # touched, but not changed
+    os.utime(source_dir / "source0.wav", ns=(0, 0))
+    # modified
+    (source_dir / "source1.wav").write_bytes(b"new data")
+    # moved
+    moved_dir = tmp_path / "moved" / "sub"
+    moved_dir.mkdir(parents=True)
+    os.rename(source_dir / "source2.wav", moved_dir / "renamed.wav")
+    (moved_dir / "other.wav").write_bytes(b"other data")
+    # removed
+    os.unlink(source_dir / "source3.wav")
+
+    with patch.object(external_rescan, "hash_files", wraps=external_rescan.hash_files) as hf:
+        stats = ExternalRescanner(app, [str(tmp_path / "moved")], jobs=1).rescan()
+        hashed = [f.path for call in hf.call_args_list for f in call[0][0]]
+    assert sorted(hashed) == sorted([str(source_dir / "source0.wav"),
+                                     str(source_dir / "source1.wav"),
+                                     str(moved_dir / "renamed.wav")])
+    assert stats["unchanged"] == 1
+    assert stats["verified"] == 1
+    assert stats["modified"] == 1
+    assert stats["relocated"] == 1
+    assert stats["missing"] == 1
+
+    paths = _item_paths(library)
+    assert paths["item1"] == (str(source_dir / "source1.wav"),
+                              hashlib.md5(b"new data").hexdigest())
+    assert paths["item2"][0] == str(moved_dir / "renamed.wav")
+    assert paths["item3"][0] == str(source_dir / "source3.wav")
+
+    stats = ExternalRescanner(app, jobs=1).rescan()
+    assert stats["unchanged"] == 4
+    assert stats["missing"] == 1
+    assert stats["verified"] == stats["modified"] == stats["relocated"] == 0
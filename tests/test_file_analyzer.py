@@ -1,7 +1,11 @@
 
+import os
+
+import numpy
 import pytest
 
-from jajcus.sample_drawer.file_analyzer import FileKey, FileAnalyzer
+from jajcus.sample_drawer.file_analyzer import (FileKey, FileAnalyzer, CachedFileAnalyzer,
+                                                StatProvider, file_info_weight)
 
 
 class TestFileKey:
@@ -149,3 +153,77 @@ class TestFileAnalyzer:
         assert file_info['peak_level'] < -70.0
         assert file_info['waveform'] == "WAVEFORM"
         assert file_info['md5'] == "a39504034bb59d9b4016ad35faccc586"
+
+
+def test_file_info_weight():
+    data = numpy.zeros(1024 * 1024, numpy.uint8)
+    owned = file_info_weight({"waveform": data})
+    view = file_info_weight({"waveform": data[:]})
+    assert 1024 * 1024 < owned < 2 * 1024 * 1024
+    assert 1024 * 1024 < view < 2 * 1024 * 1024
+
+
+class TestCachedFileAnalyzer:
+    def test_large_file_info_cached(self, tmp_path, mocker):
+        path = tmp_path / "long.wav"
+        path.write_bytes(b"data")
+        file_info = {"path": str(path), "waveform": numpy.zeros(4 * 1024 * 1024, numpy.uint8)}
+        get_file_info = mocker.patch.object(FileAnalyzer, "get_file_info",
+                                            return_value=file_info)
+        analyzer = CachedFileAnalyzer()
+        assert analyzer.get_file_info(str(path)) is file_info
+        assert analyzer.get_file_info(str(path)) is file_info
+        assert get_file_info.call_count == 1
+
+
+class TestStatProvider:
+    def test_prefetch(self, tmp_path, mocker):
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "dir" / "a.wav").write_text("a")
+        (tmp_path / "dir" / "b.wav").write_text("bb")
+        (tmp_path / "dir" / "sub").mkdir()
+        (tmp_path / "dir" / "sub" / "c.wav").write_text("ccc")
+        (tmp_path / "link").symlink_to(tmp_path / "dir")
+        provider = StatProvider()
+        paths = provider.prefetch_dir(tmp_path / "link")
+        assert sorted(paths) == [str(tmp_path / "link" / "a.wav"),
+                                 str(tmp_path / "link" / "b.wav")]
+        realpath = mocker.patch("os.path.realpath")
+        assert provider.stat(str(tmp_path / "link" / "a.wav")).st_size == 1
+        key = FileKey(str(tmp_path / "link" / "b.wav"), stat_provider=provider)
+        assert key.path == str(tmp_path / "dir" / "b.wav")
+        assert key.stat.st_size == 2
+        assert key == FileKey(str(tmp_path / "dir" / "b.wav"), stat_provider=provider)
+        realpath.assert_not_called()
+
+    def test_key_rewritten(self, tmp_path):
+        path = tmp_path / "a.wav"
+        path.write_text("a")
+        os.utime(path, ns=(0, 0))
+        provider = StatProvider()
+        provider.prefetch_dir(tmp_path)
+        key = FileKey(str(path), stat_provider=provider)
+        assert key.stat.st_size == 1
+        # rewritten in place, within the cache TTL
+        path.write_text("b")
+        new_key = FileKey(str(path), stat_provider=provider)
+        assert new_key != key
+        assert provider.stat(str(path)).st_mtime_ns != 0
+
+    def test_walk(self, tmp_path):
+        (tmp_path / "a.wav").write_text("a")
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "b.wav").write_text("bb")
+        provider = StatProvider()
+        result = sorted(provider.walk(tmp_path))
+        assert result == [(str(tmp_path), ["a.wav"]),
+                          (str(tmp_path / "sub"), ["b.wav"])]
+        assert provider.stat(str(tmp_path / "sub" / "b.wav")).st_size == 2
+
+    def test_expired(self, tmp_path):
+        path = tmp_path / "a.wav"
+        path.write_text("a")
+        provider = StatProvider(ttl=0)
+        provider.prefetch_dir(tmp_path)
+        path.write_text("changed")
+        assert provider.stat(str(path)).st_size == 7
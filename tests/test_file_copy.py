@@ -0,0 +1,51 @@
+
+import os
+
+import pytest
+
+from jajcus.sample_drawer.file_copy import copy_file, check_methods, COPY_METHODS
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "source.wav"
+    path.write_bytes(os.urandom(100000))
+    path.chmod(0o640)
+    return path
+
+
+@pytest.mark.parametrize("method", ["copy_file_range", "sendfile", "copy"])
+def test_copy_methods(method, source, tmp_path):
+    target = tmp_path / "target.wav"
+    used = copy_file(str(source), str(target), [method, "copy"])
+    assert used in (method, "copy")
+    assert target.read_bytes() == source.read_bytes()
+    assert target.stat().st_mode == source.stat().st_mode
+    assert target.stat().st_ino != source.stat().st_ino
+
+
+def test_reflink_fallback(source, tmp_path):
+    target = tmp_path / "target.wav"
+    used = copy_file(str(source), str(target), ["reflink", "copy"])
+    assert used in ("reflink", "copy")
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test_hardlink(source, tmp_path):
+    target = tmp_path / "target.wav"
+    target.write_text("old content")
+    assert copy_file(str(source), str(target), ["hardlink", "copy"]) == "hardlink"
+    assert target.stat().st_ino == source.stat().st_ino
+
+
+def test_missing_source(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        copy_file(str(tmp_path / "missing"), str(tmp_path / "target"), COPY_METHODS)
+
+
+def test_check_methods():
+    assert check_methods(["reflink", "copy"]) == ["reflink", "copy"]
+    with pytest.raises(ValueError):
+        check_methods(["rsync"])
+    with pytest.raises(ValueError):
+        check_methods([])
@@ -0,0 +1,46 @@
+
+import os
+import time
+
+import pytest
+
+from jajcus.sample_drawer.folder_watcher import FolderWatcher
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_watch(tmp_path, use_inotify):
+    (tmp_path / "old.wav").write_bytes(b"old")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "old2.wav").write_bytes(b"old")
+    watcher = FolderWatcher([str(tmp_path)], debounce=0.2, scan_interval=0.1,
+                            use_inotify=use_inotify)
+    try:
+        existing = watcher.start()
+        assert sorted(existing) == [str(tmp_path / "old.wav"),
+                                    str(tmp_path / "sub" / "old2.wav")]
+        assert watcher.wait(0.3) == []
+
+        start = time.monotonic()
+        (tmp_path / "new.wav").write_bytes(b"new")
+        (tmp_path / "pack" / "drums").mkdir(parents=True)
+        (tmp_path / "pack" / "drums" / "kick.wav").write_bytes(b"kick")
+        ready = watcher.wait(2)
+        ready += watcher.wait(0.5)
+        assert time.monotonic() - start >= 0.2
+        assert sorted(ready) == [str(tmp_path / "new.wav"),
+                                 str(tmp_path / "pack" / "drums" / "kick.wav")]
+
+        # not reported while still changing
+        path = tmp_path / "growing.wav"
+        with open(path, "wb") as stream:
+            for i in range(4):
+                stream.write(b"data")
+                stream.flush()
+                os.utime(path, ns=(i * 10**9, i * 10**9))
+                assert watcher.wait(0.12) == []
+        assert watcher.wait(2) == [str(path)]
+
+        (tmp_path / "old.wav").unlink()
+        assert watcher.wait(0.5) == []
+    finally:
+        watcher.close()
@@ -0,0 +1,40 @@
+
+from jajcus.sample_drawer.import_journal import (ImportJournal, ANALYZED, COPIED, COMMITTED,
+                                                 file_signature)
+
+
+def test_journal(tmp_path):
+    source = tmp_path / "source.wav"
+    source.write_bytes(b"data")
+    other = tmp_path / "other.wav"
+    other.write_bytes(b"other")
+    journal_path = tmp_path / "journal.jsonl"
+    journal = ImportJournal(str(journal_path))
+    journal.load()
+    assert journal.entries == {}
+    signature = file_signature(str(source))
+    journal.record(str(source), signature, ANALYZED, {"_md5": "0" * 32})
+    journal.record(str(source), signature, COPIED)
+    journal.record(str(other), file_signature(str(other)), ANALYZED, {"_md5": "1" * 32})
+    journal.close()
+    # interrupted while writing
+    with open(journal_path, "a") as stream:
+        stream.write('{"path": "/trunc')
+
+    journal = ImportJournal(str(journal_path))
+    journal.load()
+    assert len(journal.entries) == 2
+    entry = journal.get(str(source), signature)
+    assert entry.state == COPIED
+    assert entry.metadata == {"_md5": "0" * 32}
+    journal.record(str(source), signature, COMMITTED)
+    assert journal.get(str(source), signature).metadata == {"_md5": "0" * 32}
+    journal.close()
+
+    other.write_bytes(b"changed")
+    journal = ImportJournal(str(journal_path))
+    journal.load()
+    assert journal.get(str(source), signature).state == COMMITTED
+    assert journal.get(str(other), file_signature(str(other))) is None
+    journal.remove()
+    assert not journal_path.exists()
@@ -1,34 +1,17 @@
 
 import os
-import shutil
 import sqlite3
-
-from unittest.mock import Mock
+import threading
+import time
 
 import pytest
 
-from jajcus.sample_drawer.library import Library, LibraryError
+from jajcus.sample_drawer.cleanup_scheduler import CleanupScheduler
+from jajcus.sample_drawer.library import LibraryError, LibraryConflictError, DATABASE_VERSION
+from jajcus.sample_drawer.metadata import Metadata
 from jajcus.sample_drawer.search import SearchQuery
 
 
-@pytest.fixture
-def library_factory(request, tmp_path_factory, shared_datadir):
-    marker = request.node.get_closest_marker("library_template")
-    if marker is None:
-        base_path = tmp_path_factory.mktemp("lib", True)
-    else:
-        base_path = shared_datadir / marker.args[0] / "library"
-
-    def _library_factory():
-        return Library(Mock(name="appdirs Mock"), base_path=base_path)
-
-    _library_factory.base_path = base_path
-    yield _library_factory
-
-    if base_path.exists():
-        shutil.rmtree(base_path)
-
-
 def test_create_new(library_factory):
     library = library_factory()
     base_path = library_factory.base_path
@@ -106,6 +89,21 @@ def test_open_existing_bad_version(library_factory):
         library = library_factory()
 
 
+def test_upgrade_from_ver_0(library_factory):
+    library = library_factory()
+    base_path = library_factory.base_path
+    library.close()
+    db = sqlite3.connect(base_path / "database.db")
+    db.execute("DROP TABLE item_files")
+    db.execute("UPDATE db_meta SET version='0'")
+    db.commit()
+    db.close()
+    library = library_factory()
+    row = library.db.execute("SELECT version FROM db_meta").fetchone()
+    assert row[0] == DATABASE_VERSION
+    library.db.execute("SELECT item_id, size, mtime_ns, verified_at FROM item_files")
+
+
 @pytest.mark.library_template("testdb_ver_0")
 def test_open_existing_testdb_ver_0(library_factory):
     library = library_factory()
@@ -142,3 +140,173 @@ def test_open_existing_testdb_ver_0(library_factory):
     path = library.get_item_path(item)
     assert path == item.path  # external item
     assert not path.startswith(str(library_factory.base_path))
+
+
+def _add_items(library, count, tags=("tag1",)):
+    for i in range(count):
+        metadata = Metadata({"_md5": "{:032x}".format(i),
+                             "_path": "/nonexistent/item{}.wav".format(i),
+                             "_name": "item{:04d}".format(i),
+                             "_format": "WAV"},
+                            tags)
+        library.import_file(metadata, copy=False)
+
+
+def test_iter_items_unlimited(library_factory):
+    library = library_factory()
+    _add_items(library, 150)
+    items = library.iter_items(SearchQuery([]), limit=None)
+    assert not isinstance(items, list)
+    names = [item.name for item in items]
+    assert len(names) == 150
+    assert names == sorted(names)
+    assert len(library.get_items(SearchQuery([]))) == 100
+    query = SearchQuery.from_string("+tag1 _name=item0042")
+    items = list(library.iter_items(query, limit=None))
+    assert [item.name for item in items] == ["item0042"]
+    assert items[0].get_tags() == {"tag1"}
+
+
+def _wait_for(condition, timeout=10.0):
+    """Poll until the condition is true, return False on timeout."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_get_pretty_paths(library_factory, tmp_path):
+    library = library_factory()
+    items = []
+    for i in range(3):
+        source = tmp_path / "source{}.wav".format(i)
+        source.write_bytes(b"data%i" % i)
+        metadata = Metadata({"_md5": "{:032x}".format(i),
+                             "_path": str(source),
+                             "_name": "same name",
+                             "_format": "WAV"})
+        library.import_file(metadata)
+        items.append(metadata.copy())
+        items[-1].path = None
+    external = Metadata({"_md5": "f" * 32, "_path": "/external.wav", "_name": "ext"})
+    now = [0.0]
+    library.cleanup_scheduler.clock = lambda: now[0]
+    library.cleanup_scheduler.batch_window = 0
+    paths = library.get_pretty_paths(items + [external], timeout=0.5)
+    assert len(paths) == 4
+    assert paths[3] == "/external.wav"
+    assert len(set(paths)) == 4
+    for i, path in enumerate(paths[:3]):
+        assert os.path.basename(path) == "same name.wav"
+        assert path.startswith(library.tmp_dir)
+        assert open(path, "rb").read() == b"data%i" % i
+    assert len(library.cleanup_scheduler) == 3
+    now[0] = 1.0
+    assert _wait_for(lambda: not any(os.path.exists(path) for path in paths[:3]))
+    assert len(library.cleanup_scheduler) == 0
+    # original files are still there
+    for item in items:
+        assert os.path.exists(library.get_item_path(item))
+
+
+def test_import_files(library_factory, tmp_path):
+    library = library_factory()
+    items = []
+    for i in range(5):
+        source = tmp_path / "source{}.wav".format(i)
+        source.write_bytes(b"data%i" % (i % 4))
+        items.append(Metadata({"_md5": "{:032x}".format(i % 4),
+                               "_path": str(source),
+                               "_name": "item{}".format(i),
+                               "_format": "WAV"},
+                              ["/a/b", "tag{}".format(i % 2)]))
+    library.import_file(items[0])
+    items[3].path = str(tmp_path / "nonexistent.wav")
+    results = library.import_files(items)
+    assert isinstance(results[0], LibraryConflictError)
+    assert results[0].existing_name == "item0"
+    assert results[1] in library.copy_methods
+    assert results[2] in library.copy_methods
+    assert isinstance(results[3], OSError)
+    # same file as item0
+    assert isinstance(results[4], LibraryConflictError)
+
+    items = library.get_items(SearchQuery.from_string("+/a/b"))
+    assert sorted(item.name for item in items) == ["item0", "item1", "item2"]
+    for item in items:
+        assert item.source.startswith("file:" + str(tmp_path))
+        path = library.get_item_path(item)
+        assert path.startswith(str(library_factory.base_path))
+        assert os.path.isfile(path)
+    assert dict(library.get_tags())["tag1"] == 1
+    assert dict(library.get_tags())["/a"] == 3
+
+    results = library.import_files([Metadata({"_md5": "{:032x}".format(1),
+                                              "_path": "/external.wav"})],
+                                   copy=False)
+    assert isinstance(results[0], LibraryConflictError)
+    with pytest.raises(ValueError):
+        library.import_files([Metadata({"_md5": "f" * 32})])
+
+
+def test_import_files_conflict(library_factory, tmp_path, mocker):
+    library = library_factory()
+    items = []
+    for i in range(2):
+        source = tmp_path / "source{}.wav".format(i)
+        source.write_bytes(b"data%i" % i)
+        items.append(Metadata({"_md5": "{:032x}".format(i),
+                               "_path": str(source),
+                               "_name": "item{}".format(i),
+                               "_format": "WAV"}))
+    stored_path = library.get_storage_path(items[0])
+    find_md5s = library.find_md5s
+    calls = []
+
+    def racing_find_md5s(md5s, db=None):
+        result = find_md5s(md5s, db)
+        if not calls:
+            calls.append(md5s)
+            # imported by someone else after the first check
+            other = items[0].copy()
+            other.name = "other"
+            library.import_file(other)
+            with open(stored_path, "wb") as stored_f:
+                stored_f.write(b"stored")
+        return result
+
+    mocker.patch.object(library, "find_md5s", side_effect=racing_find_md5s)
+    results = library.import_files(items)
+    assert isinstance(results[0], LibraryConflictError)
+    assert results[0].existing_name == "other"
+    assert results[1] in library.copy_methods
+    # not overwritten by the conflicting copy
+    with open(stored_path, "rb") as stored_f:
+        assert stored_f.read() == b"stored"
+    assert os.listdir(library.tmp_dir) == []
+    assert os.listdir(library.tmp_dir) == []
+
+
+def test_cleanup_scheduler(tmp_path):
+    now = [0.0]
+    scheduler = CleanupScheduler(batch_window=0.2, clock=lambda: now[0])
+    paths = []
+    for i in range(10):
+        path = tmp_path / "file{}".format(i)
+        path.write_text("data")
+        paths.append(path)
+    scheduler.schedule_many(paths[:5], 0.1)
+    scheduler.schedule(paths[5], 0.1)
+    scheduler.schedule_many(paths[6:], 60)
+    assert threading.active_count() >= 2
+    assert len(scheduler) == 10
+    now[0] = 0.5
+    assert _wait_for(lambda: not any(path.exists() for path in paths[:6]))
+    assert [path.exists() for path in paths] == [False] * 6 + [True] * 4
+    assert len(scheduler) == 4
+    scheduler.stop(remove_pending=True)
+    assert not any(path.exists() for path in paths)
+    with pytest.raises(RuntimeError):
+        scheduler.schedule(paths[0], 1)
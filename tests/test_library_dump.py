@@ -0,0 +1,61 @@
+
+import io
+import json
+
+import pytest
+
+from jajcus.sample_drawer.library_dump import LibraryDumper, LibraryDumpError
+from jajcus.sample_drawer.metadata import Metadata
+from jajcus.sample_drawer.search import SearchQuery
+
+
+def _add_items(library, count):
+    for i in range(count):
+        metadata = Metadata({"_md5": "{:032x}".format(i),
+                             "_path": "/nonexistent/item{}.wav".format(i),
+                             "_name": "item{:04d}".format(i),
+                             "_format": "WAV",
+                             "_duration": i / 10,
+                             "genre": "genre{}".format(i % 3)},
+                            ["/cat{}/sub".format(i % 2), "tag1"])
+        library.import_file(metadata, copy=False)
+
+
+def test_dump_restore(library, library_factory, tmp_path):
+    _add_items(library, 25)
+    stream = io.StringIO()
+    assert LibraryDumper(library).dump(stream) == 25
+    dump = stream.getvalue()
+    records = [json.loads(line) for line in dump.splitlines()]
+    assert records[0]["type"] == "header"
+    items = [record for record in records if record["type"] == "item"]
+    assert len(items) == 25
+    assert items[3]["tags"] == ["/cat1", "/cat1/sub", "tag1"]
+    assert items[3]["custom"] == {"genre": "genre0"}
+
+    library2 = library_factory(tmp_path / "library2")
+    stats = LibraryDumper(library2).restore(io.StringIO(dump), batch_size=10)
+    assert stats == {"restored": 25, "skipped": 0}
+    assert sorted(library2.get_tags()) == sorted(library.get_tags())
+    item = library2.get_items(SearchQuery.from_string("genre=genre2 item0005"))[0]
+    assert item.name == "item0005"
+    assert item.get_tags() == {"/cat1/sub", "tag1"}
+
+    stream2 = io.StringIO()
+    LibraryDumper(library2).dump(stream2)
+    assert stream2.getvalue() == dump
+
+    # restoring again does not create duplicates
+    stats = LibraryDumper(library2).restore(io.StringIO(dump))
+    assert stats == {"restored": 0, "skipped": 25}
+
+
+def test_restore_invalid(library):
+    dumper = LibraryDumper(library)
+    with pytest.raises(LibraryDumpError):
+        dumper.restore(io.StringIO(""))
+    with pytest.raises(LibraryDumpError):
+        dumper.restore(io.StringIO('{"type": "item"}\n'))
+    with pytest.raises(LibraryDumpError, match="line 2"):
+        dumper.restore(io.StringIO('{"type": "header", "format": "sampledrawer-dump",'
+                                   ' "version": 1}\nnot json\n'))
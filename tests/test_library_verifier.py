@@ -0,0 +1,233 @@
+
+import json
+import os
+import sqlite3
+import threading
+
+from unittest.mock import Mock
+
+import pytest
+
+from jajcus.sample_drawer.library_verifier import LibraryVerifier
+
+
+@pytest.fixture
+def add_files(library, make_sources):
+    """Import given number of source files into the library."""
+    def _add_files(count):
+        items = make_sources(count)
+        for metadata in items:
+            library.import_file(metadata)
+            metadata.path = None
+        return items
+    return _add_files
+
+
+def _run(verifier, answer="No"):
+    errors = []
+    for progress in verifier.verify():
+        if progress.error:
+            errors.append(progress.error)
+        if progress.question:
+            progress.question.answer(answer)
+    return errors
+
+
+def _verified_count(library):
+    return library.db.execute("SELECT COUNT(*) FROM item_files").fetchone()[0]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_verify_contents(library, add_files, jobs):
+    items = add_files(10)
+    app = Mock(library=library)
+    assert _run(LibraryVerifier(app, jobs=jobs)) == []
+    assert _verified_count(library) == 10
+
+    # nothing changed, nothing to verify
+    verifier = LibraryVerifier(app, jobs=jobs)
+    verifier._hash_files = Mock(wraps=verifier._hash_files)
+    assert _run(verifier) == []
+    assert len(verifier._hash_files.call_args[0][0]) == 0
+
+    # modified file
+    path = library.get_item_path(items[3])
+    with open(path, "r+b") as data_f:
+        data_f.write(b"X")
+    errors = _run(LibraryVerifier(app, jobs=jobs))
+    assert errors == ["File {!r} checksum mismatch".format(path)]
+
+    # forced verification, fixing the problem
+    verifier = LibraryVerifier(app, jobs=jobs, verify_all=True)
+    verifier._hash_files = Mock(wraps=verifier._hash_files)
+    errors = _run(verifier, answer="Yes")
+    assert len(errors) == 1
+    assert len(verifier._hash_files.call_args[0][0]) == 10
+    assert library.db.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 9
+    assert _run(LibraryVerifier(app, jobs=jobs)) == []
+
+
+def test_verify_max_age_and_sample(library, add_files):
+    add_files(20)
+    app = Mock(library=library)
+    _run(LibraryVerifier(app, jobs=1))
+
+    verifier = LibraryVerifier(app, jobs=1, sample_ratio=1.0)
+    verifier._hash_files = Mock(wraps=verifier._hash_files)
+    _run(verifier)
+    assert len(verifier._hash_files.call_args[0][0]) == 20
+
+    with library.db:
+        library.db.execute("UPDATE item_files SET verified_at = verified_at - 100"
+                           " WHERE item_id <= 5")
+    verifier = LibraryVerifier(app, jobs=1, max_age=50)
+    verifier._hash_files = Mock(wraps=verifier._hash_files)
+    _run(verifier)
+    assert len(verifier._hash_files.call_args[0][0]) == 5
+
+
+def test_reconciliation(library, add_files):
+    items = add_files(5)
+    app = Mock(library=library)
+    missing_path = library.get_item_path(items[0])
+    os.unlink(missing_path)
+    unknown_path = os.path.join(library.base_path, "a", "bc", "abc" + "0" * 29 + ".wav")
+    os.makedirs(os.path.dirname(unknown_path))
+    with open(unknown_path, "wb") as data_f:
+        data_f.write(b"unknown")
+    misplaced_path = os.path.join(library.base_path, "a", "bc", items[1].md5 + ".wav")
+    os.rename(library.get_item_path(items[1]), misplaced_path)
+
+    errors = _run(LibraryVerifier(app, jobs=1), answer="Yes")
+    assert sorted(errors) == sorted([
+        "Item #1 'item0' – file {!r} missing".format(missing_path),
+        "Item #2 'item1' – file {!r} missing".format(library.get_item_path(items[1])),
+        "File {!r} not in the database".format(unknown_path),
+        ])
+    assert not os.path.exists(unknown_path)
+    # misplaced files are only reported
+    assert os.path.exists(misplaced_path)
+    assert library.db.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 3
+    os.unlink(misplaced_path)
+    assert _run(LibraryVerifier(app, jobs=1)) == []
+
+
+def test_extension_mismatch(library, add_files):
+    items = add_files(2)
+    app = Mock(library=library)
+    path = library.get_item_path(items[0])
+    renamed_path = path[:-len(".wav")] + ".flac"
+    os.rename(path, renamed_path)
+    expected = ["File {!r} extension does not match file format from the library 'wav'"
+                .format(renamed_path)]
+
+    assert _run(LibraryVerifier(app, jobs=1), answer="No") == expected
+    assert os.path.exists(renamed_path)
+    assert library.db.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 2
+
+    assert _run(LibraryVerifier(app, jobs=1), answer="Yes") == expected
+    assert not os.path.exists(renamed_path)
+
+
+def test_concurrent_changes(library, add_files, tmp_path):
+    items = add_files(3)
+    app = Mock(library=library)
+    missing_path = library.get_item_path(items[0])
+    os.rename(missing_path, str(tmp_path / "moved"))
+    other_db = sqlite3.connect(os.path.join(library.base_path, "database.db"), timeout=0)
+    errors = []
+    for progress in LibraryVerifier(app, jobs=1).verify():
+        if progress.error:
+            errors.append(progress.error)
+        if progress.question:
+            progress.question.answer("Yes")
+        if progress.stage_name == "Verifying file contents" and not progress.stage_percent:
+            # the library is not locked during verification
+            with other_db:
+                other_db.execute("UPDATE items SET name = 'renamed' WHERE id = 2")
+            # the file re-appears before the fix is applied
+            os.rename(str(tmp_path / "moved"), missing_path)
+    other_db.close()
+    assert errors == ["Item #1 'item0' – file {!r} missing".format(missing_path)]
+    assert library.db.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 3
+    assert _verified_count(library) == 2
+
+
+def test_resume(library, add_files):
+    items = add_files(10)
+    app = Mock(library=library)
+    unknown_path = os.path.join(library.base_path, "a", "bc", "abc" + "0" * 29 + ".wav")
+    os.makedirs(os.path.dirname(unknown_path))
+    with open(unknown_path, "wb") as data_f:
+        data_f.write(b"unknown")
+    broken_path = library.get_item_path(items[5])
+    with open(broken_path, "r+b") as data_f:
+        data_f.write(b"X")
+
+    # interrupted during content verification
+    verifier = LibraryVerifier(app, jobs=1)
+    questions = 0
+    for progress in verifier.verify():
+        if progress.question:
+            progress.question.answer("Yes")
+            questions += 1
+        if progress.stage_name == "Verifying file contents" and progress.stage_percent >= 50:
+            break
+    assert questions >= 1
+    with open(verifier.checkpoint_path) as checkpoint_f:
+        checkpoint = json.load(checkpoint_f)
+    assert checkpoint["stage"] == "Checking files"
+    assert ["remove_file", unknown_path, "abc" + "0" * 29, "wav"] in checkpoint["fixes"]
+    assert os.path.exists(unknown_path)
+    verified = _verified_count(library)
+    assert 0 < verified < 10
+
+    # resumed run does not ask again nor re-verify files
+    verifier = LibraryVerifier(app, jobs=1, resume=True, verify_all=True)
+    verifier._hash_files = Mock(wraps=verifier._hash_files)
+    for progress in verifier.verify():
+        if progress.question:
+            assert progress.error == "File {!r} checksum mismatch".format(broken_path)
+            progress.question.answer("Yes")
+    assert not os.path.exists(verifier.checkpoint_path)
+    assert not os.path.exists(unknown_path)
+    assert len(verifier._hash_files.call_args[0][0]) < 10 - verified + 1
+    report = verifier.report
+    assert report["resumed"] is True
+    assert report["errors"] == ["File {!r} not in the database".format(unknown_path),
+                                "File {!r} checksum mismatch".format(broken_path)]
+    assert len(report["fixes_applied"]) == 2
+    assert library.db.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 9
+
+
+def test_other_thread(library, add_files):
+    add_files(5)
+    app = Mock(library=library)
+    sizes = []
+    result = {}
+
+    def run():
+        db = library.open_connection()
+        try:
+            verifier = LibraryVerifier(app, jobs=1, db=db, throttle=sizes.append,
+                                       checkpoint_name="test_checkpoint.json")
+            result["errors"] = _run(verifier)
+        finally:
+            db.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert result["errors"] == []
+    assert sorted(sizes) == sorted(len(b"sample data %i" % i) for i in range(5))
+    assert _verified_count(library) == 5
+
+
+def test_in_transaction(library, add_files):
+    add_files(1)
+    app = Mock(library=library)
+    library.db.execute("DELETE FROM items")
+    with pytest.raises(RuntimeError):
+        _run(LibraryVerifier(app, jobs=1))
+    library.db.rollback()
+    assert library.db.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 1
@@ -58,3 +58,89 @@ def test_lru():
     assert cache[0] == "0"
     for i in range(2, 11):
         assert cache[i] == str(i)
+
+
+def test_weight():
+    cache = lru_cache.LRUCache(maxsize=None, maxweight=10, weight=len)
+    cache.put(1, "aaaa")
+    cache.put(2, "bbbb")
+    assert cache.total_weight == 8
+    cache.put(3, "cccc")
+    assert 1 not in cache
+    assert cache[2] == "bbbb"
+    assert cache[3] == "cccc"
+    assert cache.total_weight == 8
+    # replacing a value updates the weight
+    cache.put(2, "bb")
+    assert cache.total_weight == 6
+    # too heavy to be stored at all
+    cache.put(4, "d" * 11)
+    assert 4 not in cache
+    assert len(cache) == 2
+    stats = cache.stats()
+    assert stats["evictions"] == 2
+    assert stats["weight"] == 6
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(lru_cache.time, "monotonic", lambda: now[0])
+    cache = lru_cache.LRUCache(ttl=10)
+    cache.put(1, "one")
+    cache.put(2, "two", ttl=None)
+    cache.put(3, "three", ttl=30)
+    now[0] += 20
+    assert cache.get(1) is None
+    assert cache[2] == "two"
+    assert cache[3] == "three"
+    now[0] += 20
+    assert 3 not in cache
+    with pytest.raises(KeyError):
+        cache[3]
+    stats = cache.stats()
+    assert stats == {"entries": 1, "weight": 0, "hits": 2, "misses": 2,
+                     "evictions": 0, "expirations": 2}
+
+
+def test_discard_clear():
+    cache = lru_cache.LRUCache(weight=len)
+    for i in range(5):
+        cache.put(i, str(i))
+    cache.discard(3)
+    cache.discard(7)
+    assert 3 not in cache
+    assert len(cache) == 4
+    assert cache.total_weight == 4
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.total_weight == 0
+    cache.put(1, "one")
+    assert cache[1] == "one"
+
+
+def test_sharded():
+    cache = lru_cache.ShardedLRUCache(maxsize=64, shards=4)
+    for i in range(64):
+        cache.put(i, str(i))
+    assert len(cache) == 64
+    for i in range(64):
+        assert cache[i] == str(i)
+    cache.put(64, "64")
+    assert len(cache) == 64
+    with pytest.raises(KeyError):
+        cache[0]
+    assert 64 in cache
+    stats = cache.stats()
+    assert stats["shards"] == 4
+    assert stats["hits"] == 64
+    assert stats["evictions"] == 1
+
+
+def test_sharded_weight():
+    cache = lru_cache.ShardedLRUCache(maxsize=None, maxweight=40, weight=len, shards=4)
+    for i in range(100):
+        cache.put(i, "x" * 5)
+    assert cache.total_weight <= 40
+    assert len(cache) == 8
+    with pytest.raises(ValueError):
+        lru_cache.ShardedLRUCache(shards=3)
@@ -0,0 +1,54 @@
+"""Cache throughput with concurrent threads.
+
+Not run by default, use 'pytest -m benchmark tests/test_lru_cache_benchmark.py'.
+Set BENCHMARK_OPS to run more operations per thread."""
+
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from jajcus.sample_drawer import lru_cache
+
+OPS_PER_THREAD = int(os.environ.get("BENCHMARK_OPS", "20000"))
+THREAD_COUNTS = [1, 2, 4, 8]
+KEYS = 2000
+
+
+def _worker(cache, seed, ops, barrier):
+    rand = random.Random(seed)
+    keys = [rand.randrange(KEYS) for i in range(ops)]
+    barrier.wait()
+    for i, key in enumerate(keys):
+        if cache.get(key) is None:
+            cache.put(key, i)
+
+
+def _throughput(cache, threads):
+    barrier = threading.Barrier(threads + 1)
+    workers = [threading.Thread(target=_worker, args=(cache, seed, OPS_PER_THREAD, barrier))
+               for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return threads * OPS_PER_THREAD / elapsed
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("cache_class", [lru_cache.LRUCache, lru_cache.ShardedLRUCache])
+def test_throughput(benchmark_report, cache_class):
+    for threads in THREAD_COUNTS:
+        cache = cache_class(maxsize=KEYS // 2)
+        ops = _throughput(cache, threads)
+        stats = cache.stats()
+        benchmark_report("{:16} {:2} threads: {:10.0f} ops/s, hit ratio {:.2f}"
+                         .format(cache_class.__name__, threads, ops,
+                                 stats["hits"] / (stats["hits"] + stats["misses"])))
+        assert stats["hits"] + stats["misses"] == threads * OPS_PER_THREAD
+        assert len(cache) <= KEYS // 2 + 64
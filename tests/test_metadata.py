@@ -0,0 +1,97 @@
+
+import pytest
+
+from jajcus.sample_drawer.config import DEFAULT_IMPORT_RULES
+from jajcus.sample_drawer.metadata import Metadata, RewriteRules
+
+
+def test_rewrite_default_rules():
+    metadata = Metadata({"_path": "/samples/Drum Kit/kick 1.wav", "_md5": "0" * 32},
+                        ["old"])
+    result = metadata.rewrite(DEFAULT_IMPORT_RULES, root="/samples")
+    assert result.name == "kick 1"
+    assert result.md5 == "0" * 32
+    assert result.get_tags() == {"old", "/Drum_Kit"}
+    assert "_auto_category" not in result
+    assert "_tags" not in result
+
+    result = metadata.rewrite(DEFAULT_IMPORT_RULES, root="/samples/Drum Kit")
+    assert result.get_tags() == {"old"}
+    result = metadata.rewrite(DEFAULT_IMPORT_RULES, root="/other")
+    assert result.get_tags() == {"old"}
+    result = metadata.rewrite(DEFAULT_IMPORT_RULES)
+    assert result.get_tags() == {"old"}
+
+    # source not changed
+    assert metadata.name is None
+    assert metadata.get_tags() == {"old"}
+
+
+def test_rewrite_rules_compiled():
+    rules = RewriteRules([
+        ("_path", r"^.*/(?P<pack>[^/]+)/[^/]+$", {"pack": "{pack}", "_tmp": "{1}"}),
+        ("pack", r"^(\w+) (\d+)$", {"_name": "{_tmp} #{2}",
+                                    "_tags": "{_tags} /pack/{1} bad!tag",
+                                    "_md5": "ignored",
+                                    "missing": "{no_such_key}",
+                                    "formatted": "{2:>4}"}),
+        ])
+    items = [Metadata({"_path": "/s/Bass {}/x.wav".format(i)}) for i in range(3)]
+    items.append(Metadata({"_path": "/s/Other/y.wav"}))
+    results = list(rules.apply_all(items))
+    assert [m.name for m in results] == ["Bass 0 #0", "Bass 1 #1", "Bass 2 #2", None]
+    assert results[1].get_tags() == {"/pack/Bass"}
+    assert results[1]["pack"] == "Bass 1"
+    assert results[1]["formatted"] == "   1"
+    assert results[1].md5 is None
+    # invalid key and failed substitution
+    assert "_tmp" not in results[1]
+    assert "missing" not in results[1]
+    assert results[3].get_tags() == set()
+    assert results[3]["pack"] == "Other"
+
+
+def test_metadata_fields():
+    metadata = Metadata({"_md5": "0" * 32, "_sample_rate": "44100", "_duration": None,
+                         "genre": "techno", "_bad": 1},
+                        ["/drums/kick", "bad tag", "loop", "loop"])
+    assert metadata.sample_rate == 44100
+    assert metadata.duration is None
+    assert list(metadata) == ["_md5", "_sample_rate", "genre"]
+    assert len(metadata) == 3
+    assert "_duration" not in metadata
+    assert metadata.get("_duration", 1.0) == 1.0
+    assert metadata["genre"] == "techno"
+    assert metadata.get_tags() == {"/drums/kick", "loop"}
+
+    metadata.duration = "1.5"
+    metadata["_name"] = "kick"
+    metadata["mood"] = "dark"
+    assert metadata["_duration"] == 1.5
+    assert metadata.name == "kick"
+    assert len(metadata) == 6
+    with pytest.raises(AttributeError):
+        metadata.other = 1
+    with pytest.raises(ValueError):
+        metadata["_other"] = 1
+    with pytest.raises(KeyError):
+        metadata["other"]
+
+    copy = metadata.copy()
+    copy.name = "snare"
+    copy["mood"] = "happy"
+    copy.add_tags(["snare"])
+    copy.remove_tags(["loop"])
+    assert metadata.name == "kick"
+    assert metadata["mood"] == "dark"
+    assert metadata.get_tags() == {"/drums/kick", "loop"}
+    assert copy.get_tags() == {"/drums/kick", "snare"}
+
+
+def test_metadata_trusted():
+    data = {"_md5": "0" * 32, "_name": "kick", "_duration": None, "genre": "techno"}
+    metadata = Metadata.trusted(data, ["/drums", "loop"])
+    assert list(metadata) == ["_md5", "_name", "genre"]
+    assert metadata.name == "kick"
+    assert metadata.get_tags() == {"/drums", "loop"}
+    assert Metadata.trusted({"_name": "x"}).get_tags() == set()
@@ -0,0 +1,128 @@
+
+from unittest.mock import Mock
+
+import pytest
+
+from jajcus.sample_drawer.metadata import Metadata
+from jajcus.sample_drawer.workplace import Workplace, WorkplaceConflictError
+
+
+@pytest.fixture
+def workplace(library, tmp_path):
+    app = Mock()
+    app.appdirs.user_data_dir = str(tmp_path / "data")
+    return Workplace(app, library, "test")
+
+
+def test_import_files(library, workplace, make_sources, tmp_path):
+    items = make_sources(150, tags=["/drums", "loop"], named=False)
+    results = workplace.import_files(items, folder="kit")
+    assert [result.path for result in results[:2]] == ["kit/source0.wav", "kit/source1.wav"]
+    assert results[0].source == "file:" + str(tmp_path / "source0.wav")
+    assert results[0].get_tags() == {"/drums", "loop"}
+
+    results = workplace.import_files(items[:2], folder="kit")
+    assert all(isinstance(result, WorkplaceConflictError) for result in results)
+    result = workplace.import_file(items[0], folder="kit", name="renamed")
+    assert result.path == "kit/renamed.wav"
+    with pytest.raises(WorkplaceConflictError):
+        workplace.import_file(items[0], folder="kit", name="renamed")
+
+    # more than the default search limit
+    stored = workplace.get_items()
+    assert len(stored) == 151
+    assert stored[0].path == "kit/renamed.wav"
+    assert stored[1].get_tags() == {"/drums", "loop"}
+    # not counted as library items
+    assert dict(library.get_tags())["/drums"] == 0
+
+    assert workplace.delete_items(stored[:100]) == 100
+    assert len(workplace.get_items()) == 51
+    assert workplace.delete_item(Metadata({"_path": "/abs/path.wav"})) is False
+
+
+def test_import_files_copy_error(workplace, make_sources, tmp_path):
+    items = make_sources(3, named=False)
+    (tmp_path / "source1.wav").unlink()
+    results = workplace.import_files(items, copy=True, folder="kit")
+    assert isinstance(results[1], OSError)
+    assert [result.path for result in results[::2]] == ["kit/source0.wav", "kit/source2.wav"]
+    assert [item.path for item in workplace.get_items()] == ["kit/source0.wav",
+                                                             "kit/source2.wav"]
+    base_path = tmp_path / "data" / "workplaces" / "test" / "kit"
+    assert sorted(path.name for path in base_path.iterdir()) == ["source0.wav", "source2.wav"]
+
+
+def test_import_files_conflict(workplace, make_sources, tmp_path, mocker):
+    items = make_sources(2, named=False)
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    other = make_sources(1, other_dir, named=False)[0]
+    (other_dir / "source0.wav").write_bytes(b"other data")
+    find_paths = workplace._find_paths
+    calls = []
+
+    def racing_find_paths(paths, cur):
+        result = find_paths(paths, cur)
+        if not calls:
+            calls.append(paths)
+            # imported by someone else after the first check
+            workplace.import_file(other, copy=True, folder="kit")
+        return result
+
+    mocker.patch.object(workplace, "_find_paths", side_effect=racing_find_paths)
+    results = workplace.import_files(items, copy=True, folder="kit")
+    assert isinstance(results[0], WorkplaceConflictError)
+    assert results[1].path == "kit/source1.wav"
+    base_path = tmp_path / "data" / "workplaces" / "test" / "kit"
+    assert sorted(path.name for path in base_path.iterdir()) == ["source0.wav", "source1.wav"]
+    assert (base_path / "source0.wav").read_bytes() == b"other data"
+
+
+def test_import_items(library, workplace, make_sources, tmp_path):
+    items = make_sources(3)
+    library.import_files(items)
+    lib_items = library.get_items("SELECT * FROM items WHERE workplace_id IS NULL")
+    results = workplace.import_items(lib_items, copy=True)
+    assert [result.source for result in results] == ["lib:" + m.md5 for m in lib_items]
+    for result in results:
+        assert (tmp_path / "data" / "workplaces" / "test" / result.path).exists()
+    workplace.delete_items(results)
+    for result in results:
+        assert not (tmp_path / "data" / "workplaces" / "test" / result.path).exists()
+    assert workplace.get_items() == []
+
+
+def test_materialize(library, workplace, make_sources, tmp_path):
+    items = make_sources(4)
+    library.import_files(items[:2])
+    lib_items = library.get_items("SELECT * FROM items WHERE workplace_id IS NULL"
+                                  " ORDER BY name")
+    workplace.import_items(lib_items, folder="lib")
+    workplace.import_files(items[2:], folder="a/b", copy=True)
+    (tmp_path / "source3.wav").unlink()
+    missing = Metadata({"_md5": "0" * 32, "_path": str(tmp_path / "gone.wav"),
+                        "_format": "WAV", "_name": "gone"})
+    workplace.import_file(missing)
+
+    stored = workplace.get_items()
+    paths = workplace.resolve_paths(stored)
+    assert paths == [str(tmp_path / "data" / "workplaces" / "test" / "a" / "b" / "item2.wav"),
+                     str(tmp_path / "data" / "workplaces" / "test" / "a" / "b" / "item3.wav"),
+                     str(tmp_path / "gone.wav"),
+                     library.get_item_path(lib_items[0]),
+                     library.get_item_path(lib_items[1])]
+    assert paths == [workplace.get_item_path(metadata) for metadata in stored]
+
+    target = tmp_path / "session"
+    stats = workplace.materialize(str(target), methods=["hardlink", "copy"], jobs=2)
+    assert stats["copy:hardlink"] == 4
+    assert stats["missing"] == 1
+    assert (target / "lib" / "item0.wav").read_bytes() == b"sample data 0"
+    assert (target / "a" / "b" / "item3.wav").read_bytes() == b"sample data 3"
+
+    # hard links replaced, not written through
+    stats = workplace.materialize(str(target), methods=["copy"])
+    assert stats["copy:copy"] == 4
+    (target / "lib" / "item0.wav").write_bytes(b"changed")
+    assert open(library.get_item_path(lib_items[0]), "rb").read() == b"sample data 0"